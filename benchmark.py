@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""
+Benchmark how fast images are optimized, and how much smaller they get.
+
+A corpus of JPEG, PNG, GIF, and WebP images at several resolutions is
+generated from a fixed seed, so that every run optimizes the same images.
+Each combination of backend, worker count, and mode is then run in a fresh
+Python process (so that its peak memory use can be measured on its own),
+and the results are printed as JSON, for example::
+
+    python benchmark.py --backends pillow mozjpeg+oxipng --workers 1 4 --output results.json
+
+The modes are ``buffer`` (optimize_from_buffer(), as used when an image is
+uploaded, with ``workers`` uploads at a time) and ``bulk`` (the BulkOptimizer,
+as used by optimize_legacy_images_in_model_fields()). Backends are names from
+optimized_image.backends.BACKENDS, and several names joined with ``+`` are
+chained, like in the OPTIMIZED_IMAGE_BACKENDS setting.
+
+To catch regressions, compare a run with the results of an earlier one::
+
+    python benchmark.py --compare results.json
+
+which exits with an error if the images per second or the byte savings of
+any benchmark dropped by more than ``--tolerance`` (10% by default).
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFilter, features
+
+
+DEFAULT_RESOLUTIONS = ['320x240', '1280x960', '4032x3024']
+
+# The file extension, and the options to save the corpus images with, for
+# each format. The images are saved at a high quality, like a camera or an
+# image editor would, so that there is something to optimize.
+CORPUS_FORMATS = {
+    'JPEG': ('jpg', {'quality': 95}),
+    'PNG': ('png', {}),
+    'GIF': ('gif', {}),
+    'WEBP': ('webp', {'quality': 95}),
+}
+
+
+def make_image(rng, size):
+    """Return a photo-like image: blurred shapes, with some noise on top."""
+    width, height = size
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for i in range(3)))
+    draw = ImageDraw.Draw(image)
+    for i in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(max(width, height) // 20 + 1, max(width, height) // 3 + 2)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape([x - radius, y - radius, x + radius, y + radius], fill=tuple(rng.randrange(256) for i in range(3)))
+    image = image.filter(ImageFilter.GaussianBlur(max(width, height) / 200))
+    # Without noise, the images would compress far better than real photos
+    noise = Image.frombytes('L', size, rng.getrandbits(width * height * 8).to_bytes(width * height, 'little'))
+    return Image.blend(image, noise.convert('RGB'), 0.08)
+
+
+def generate_corpus(directory, resolutions, images_per_resolution, seed):
+    """Save the benchmark images in directory, and return a description of the corpus."""
+    rng = random.Random(seed)
+    image_formats = [
+        image_format for image_format in CORPUS_FORMATS
+        if image_format != 'WEBP' or features.check('webp')
+    ]
+    for resolution in resolutions:
+        size = tuple(int(dimension) for dimension in resolution.split('x'))
+        for i in range(images_per_resolution):
+            image = make_image(rng, size)
+            for image_format in image_formats:
+                extension, save_options = CORPUS_FORMATS[image_format]
+                if image_format == 'GIF':
+                    save_image = image.convert('P', palette=Image.ADAPTIVE)
+                else:
+                    save_image = image
+                name = '{}_{}_{}.{}'.format(image_format.lower(), resolution, i, extension)
+                save_image.save(os.path.join(directory, name), format=image_format, **save_options)
+    return {
+        'seed': seed,
+        'resolutions': resolutions,
+        'images_per_resolution': images_per_resolution,
+        'formats': image_formats,
+        'images': len(os.listdir(directory)),
+    }
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def peak_rss():
+    """Return the peak resident memory of this process and of its child processes, in bytes."""
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    )
+
+
+def setup_django(scenario, directory):
+    """Configure Django to optimize images with the backend of the scenario, in directory."""
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        DATABASES={
+            'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory, 'benchmark.db')},
+        },
+        INSTALLED_APPS=('optimized_image', 'not_optimized'),
+        MEDIA_ROOT=os.path.join(directory, 'media'),
+        OPTIMIZED_IMAGE_BACKENDS=[{'BACKEND': name} for name in scenario['backend'].split('+')],
+        OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=[],
+        TINYPNG_KEY=os.environ.get('TINYPNG_KEY'),
+    )
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def run_buffer(scenario, corpus_directory):
+    """
+    Optimize every image in the corpus with optimize_from_buffer(), ``workers`` at a time.
+
+    Return a list of (name, input size, output size, duration) for each
+    image, and the total duration in seconds.
+    """
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from optimized_image.utils import optimize_from_buffer
+
+    options = {}
+    if scenario['max_dimension']:
+        options['max_dimension'] = scenario['max_dimension']
+
+    def optimize(name):
+        with open(os.path.join(corpus_directory, name), 'rb') as image_file:
+            data = SimpleUploadedFile(name, image_file.read())
+        input_size = data.size
+        start = time.perf_counter()
+        optimize_from_buffer(data, **options)
+        return name, input_size, data.size, time.perf_counter() - start
+
+    names = sorted(os.listdir(corpus_directory))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=scenario['workers']) as executor:
+        futures = [executor.submit(optimize, name) for name in names]
+        optimized = [future.result() for future in futures]
+    return optimized, time.perf_counter() - start
+
+
+def run_bulk(scenario, corpus_directory):
+    """Optimize every image in the corpus with the BulkOptimizer, like run_buffer()."""
+    from django.core.files.base import ContentFile
+    from not_optimized.models import GenericModel
+    from optimized_image.bulk import BulkOptimizer
+
+    if scenario['max_dimension']:
+        GenericModel._meta.get_field('image').max_dimension = scenario['max_dimension']
+    input_sizes = {}
+    for name in sorted(os.listdir(corpus_directory)):
+        with open(os.path.join(corpus_directory, name), 'rb') as image_file:
+            content = image_file.read()
+        instance = GenericModel.objects.create(title=name, image=ContentFile(content, name=name))
+        input_sizes[instance.image.name] = (name, len(content))
+
+    timings = []
+
+    class TimedBulkOptimizer(BulkOptimizer):
+        def optimize_field_file(self, image_file, record=None, prefetched=None):
+            original_name = image_file.name
+            start = time.perf_counter()
+            record = super().optimize_field_file(image_file, record, prefetched)
+            timings.append((original_name, image_file.size, time.perf_counter() - start))
+            return record
+
+    start = time.perf_counter()
+    TimedBulkOptimizer(workers=scenario['workers']).run([GenericModel])
+    seconds = time.perf_counter() - start
+    return [
+        (input_sizes[original_name][0], input_sizes[original_name][1], output_size, duration)
+        for original_name, output_size, duration in timings
+    ], seconds
+
+
+def run_scenario(scenario, corpus_directory):
+    """Run one benchmark, and return its results."""
+    with tempfile.TemporaryDirectory() as directory:
+        setup_django(scenario, directory)
+        run = run_buffer if scenario['mode'] == 'buffer' else run_bulk
+        optimized, seconds = run(scenario, corpus_directory)
+
+    rss, children_rss = peak_rss()
+    durations = [duration for name, input_size, output_size, duration in optimized]
+    by_format = {}
+    for name, input_size, output_size, duration in optimized:
+        format_results = by_format.setdefault(name.split('_')[0], {'images': 0, 'input_bytes': 0, 'output_bytes': 0})
+        format_results['images'] += 1
+        format_results['input_bytes'] += input_size
+        format_results['output_bytes'] += output_size
+    input_bytes = sum(input_size for name, input_size, output_size, duration in optimized)
+    output_bytes = sum(output_size for name, input_size, output_size, duration in optimized)
+    return dict(
+        scenario,
+        images=len(optimized),
+        seconds=seconds,
+        images_per_second=len(optimized) / seconds if seconds else None,
+        latency_p50=percentile(durations, 0.5),
+        latency_p99=percentile(durations, 0.99),
+        input_bytes=input_bytes,
+        output_bytes=output_bytes,
+        savings_bytes=input_bytes - output_bytes,
+        savings_ratio=1 - output_bytes / input_bytes if input_bytes else None,
+        peak_rss_bytes=rss,
+        peak_children_rss_bytes=children_rss,
+        by_format=by_format,
+    )
+
+
+def get_environment():
+    import django
+    import PIL
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of each benchmark that got worse than in the baseline."""
+    def key(result):
+        return result['backend'], result['mode'], result['workers'], result['max_dimension']
+
+    baseline_results = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        baseline_result = baseline_results.get(key(result))
+        if baseline_result is None:
+            continue
+        for metric in ('images_per_second', 'savings_ratio'):
+            if not baseline_result[metric] or result[metric] is None:
+                continue
+            change = result[metric] / baseline_result[metric] - 1
+            if change < -tolerance:
+                regressions.append('{} {} workers={}: {} went from {:.3f} to {:.3f} ({:+.0%})'.format(
+                    result['backend'], result['mode'], result['workers'], metric,
+                    baseline_result[metric], result[metric], change,
+                ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backends', nargs='+', default=['pillow'])
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, os.cpu_count() or 1])
+    parser.add_argument('--modes', nargs='+', choices=['buffer', 'bulk'], default=['buffer', 'bulk'])
+    parser.add_argument('--resolutions', nargs='+', default=DEFAULT_RESOLUTIONS)
+    parser.add_argument('--images-per-resolution', type=int, default=2)
+    parser.add_argument('--max-dimension', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', help='Use (or create) the corpus in this directory.')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.')
+    parser.add_argument('--compare', help='The JSON results of an earlier run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    # Used internally to run one benchmark in a fresh process
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        # The results are written to a file, since the optimizers may write to stdout
+        with open(args.output, 'w') as output_file:
+            json.dump(run_scenario(json.loads(args.scenario), args.corpus), output_file)
+        return
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        corpus_directory = args.corpus or os.path.join(temporary_directory, 'corpus')
+        os.makedirs(corpus_directory, exist_ok=True)
+        if os.listdir(corpus_directory):
+            corpus = {'directory': corpus_directory, 'images': len(os.listdir(corpus_directory))}
+        else:
+            corpus = generate_corpus(
+                corpus_directory, args.resolutions, args.images_per_resolution, args.seed
+            )
+
+        results = {'environment': get_environment(), 'corpus': corpus, 'results': []}
+        for backend in args.backends:
+            for workers in sorted(set(args.workers)):
+                for mode in args.modes:
+                    scenario = {
+                        'backend': backend, 'mode': mode, 'workers': workers,
+                        'max_dimension': args.max_dimension,
+                    }
+                    sys.stderr.write('Running {}\n'.format(scenario))
+                    scenario_output_path = os.path.join(temporary_directory, 'scenario.json')
+                    subprocess.run([
+                        sys.executable, __file__, '--scenario', json.dumps(scenario),
+                        '--corpus', corpus_directory, '--output', scenario_output_path,
+                    ], stdout=subprocess.DEVNULL, check=True)
+                    with open(scenario_output_path) as scenario_output_file:
+                        result = json.load(scenario_output_file)
+                    sys.stderr.write(
+                        '  {images} images, {images_per_second:.2f} images/s, p50 {latency_p50:.3f}s, '
+                        'p99 {latency_p99:.3f}s, saved {savings_ratio:.1%}, '
+                        'peak RSS {peak_rss_bytes} bytes\n'.format(**result)
+                    )
+                    results['results'].append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write('REGRESSION: {}\n'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,4 @@ from django.apps import AppConfig
 
 class NotOptimizedConfig(AppConfig):
     name = 'not_optimized'
+    default_auto_field = 'django.db.models.AutoField'
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:34
+
+from django.db import migrations, models
+import optimized_image.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('not_optimized', '0006_auto_20190307_2025'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageWithDimensions',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', optimized_image.fields.OptimizedImageField(blank=True, height_field='image_height', max_dimension=100, null=True, upload_to='static/images/', width_field='image_width')),
+                ('image_width', models.PositiveIntegerField(blank=True, null=True)),
+                ('image_height', models.PositiveIntegerField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -29,3 +29,12 @@ class GenericModel(models.Model):
     image = OptimizedImageField(blank=True, null=True, upload_to='static/images/')
     not_optimized_image = models.ImageField(blank=True, null=True, upload_to='static/images')
     not_optimized_image_ignored = models.ImageField(blank=True, null=True, upload_to='static/images')
+
+
+class ImageWithDimensions(models.Model):
+    image = OptimizedImageField(
+        blank=True, null=True, upload_to='static/images/', width_field='image_width', height_field='image_height',
+        max_dimension=100,
+    )
+    image_width = models.PositiveIntegerField(blank=True, null=True)
+    image_height = models.PositiveIntegerField(blank=True, null=True)
@@ -1 +1,15 @@
-# Admin
+from django.contrib import admin
+
+from . import models
+
+
+@admin.register(models.OptimizedImageRecord)
+class OptimizedImageRecordAdmin(admin.ModelAdmin):
+    list_display = ('name', 'method', 'original_size', 'optimized_size', 'optimized_at')
+    search_fields = ('name',)
+
+
+@admin.register(models.OptimizationJob)
+class OptimizationJobAdmin(admin.ModelAdmin):
+    list_display = ('model', 'object_pk', 'field_name', 'status', 'attempts', 'created_at')
+    list_filter = ('status',)
@@ -0,0 +1,195 @@
+from io import BytesIO
+
+from PIL import GifImagePlugin, Image, ImageChops
+
+
+def is_animated(image):
+    """Return True if image (opened, but not decoded) has more than one frame."""
+    return getattr(image, 'n_frames', 1) > 1
+
+
+def iter_frames(image, size=None, binary_alpha=True):
+    """
+    Yield (frame, duration) for each frame of image, as a new RGBA image.
+
+    Only the current frame is decoded at a time (Pillow keeps the composited
+    canvas of the previous frames, not the frames themselves). With ``size``,
+    each frame is scaled to it. With ``binary_alpha``, pixels are made either
+    opaque or transparent, since that is all that a GIF can store, and
+    transparent pixels are all (0, 0, 0, 0), so that frames can be compared
+    pixel by pixel.
+    """
+    transparent = None
+    for index in range(image.n_frames):
+        image.seek(index)
+        frame = image.convert('RGBA')
+        if size is not None and frame.size != size:
+            frame = frame.resize(size, Image.LANCZOS)
+        if binary_alpha:
+            if transparent is None:
+                transparent = Image.new('RGBA', frame.size)
+            mask = frame.getchannel('A').point(lambda alpha: 255 if alpha >= 128 else 0)
+            frame.putalpha(mask)
+            frame = Image.composite(frame, transparent, mask)
+        yield frame, image.info.get('duration', 0)
+
+
+def get_durations(image):
+    """Return the list of the durations of the frames of image, in milliseconds."""
+    durations = []
+    for index in range(image.n_frames):
+        image.seek(index)
+        durations.append(image.info.get('duration', 0))
+    image.seek(0)
+    return durations
+
+
+def get_changed_mask(frame, previous):
+    """Return an 'L' mask that is 255 where frame differs from previous."""
+    difference = ImageChops.difference(frame, previous)
+    changed = difference.getchannel(0)
+    for band in range(1, 4):
+        changed = ImageChops.lighter(changed, difference.getchannel(band))
+    return changed.point(lambda value: 255 if value else 0)
+
+
+def to_palette(frame, transparent_mask=None):
+    """
+    Return frame (RGBA) as a 'P' image with a palette of only the colors that it uses.
+
+    Palette optimization keeps the color table, which each frame stores, as
+    small as possible. Pixels where transparent_mask is 255 get an extra
+    palette entry, which is returned as the transparency index (or None).
+    """
+    image = frame.convert('RGB').quantize(colors=255, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    palette = image.getpalette()
+    used_colors = [index for index, count in enumerate(image.histogram()) if count]
+    image = image.remap_palette(used_colors)
+    palette_bytes = b''.join(bytes(palette[index * 3:index * 3 + 3]) for index in used_colors)
+    transparency = None
+    if transparent_mask is not None and transparent_mask.getbbox():
+        transparency = len(used_colors)
+        image.paste(transparency, mask=transparent_mask)
+        palette_bytes += b'\0\0\0'
+    image.putpalette(palette_bytes)
+    return image, transparency
+
+
+class _GIFFrame:
+    """A frame that is ready to be written to a GIF, but may still have its duration or disposal changed."""
+    def __init__(self, image, offset, duration, transparency, local_palette=True):
+        self.image = image
+        self.offset = offset
+        self.params = {'duration': duration, 'disposal': 1}
+        if transparency is not None:
+            self.params['transparency'] = transparency
+        if local_palette:
+            self.params['include_color_table'] = True
+
+    def write(self, output_file):
+        for data in GifImagePlugin.getdata(self.image, self.offset, **self.params):
+            output_file.write(data)
+
+
+def save_gif(frames, output_file, loop=None):
+    """
+    Write the (frame, duration) tuples from iter_frames() to output_file as an animated GIF.
+
+    The frames are written as they come: only the previous frame, and the
+    frame that is waiting to be written (in case the next frame is identical,
+    and just adds to its duration) are kept in memory. Each frame after the
+    first only stores the rectangle that changed since the previous frame,
+    with the unchanged pixels in it made transparent (which compress well),
+    and its own palette of only the colors that it uses.
+    """
+    previous = None
+    pending = None
+    for frame, duration in frames:
+        transparent = ImageChops.invert(frame.getchannel('A'))
+        if previous is None:
+            image, transparency = to_palette(frame, transparent)
+            info = {'transparency': transparency} if transparency is not None else {}
+            if loop is not None:
+                info['loop'] = loop
+            header = GifImagePlugin.getheader(image, info=info)[0]
+            for data in header:
+                output_file.write(data)
+            pending = _GIFFrame(image, (0, 0), duration, transparency, local_palette=False)
+            previous = frame
+            continue
+
+        changed = get_changed_mask(frame, previous)
+        bbox = changed.getbbox()
+        if bbox is None:
+            # An identical frame just shows the previous one for longer
+            pending.params['duration'] += duration
+            continue
+
+        if ImageChops.subtract(previous.getchannel('A'), frame.getchannel('A')).getbbox():
+            # Some pixels became transparent, which a frame drawn on top of
+            # the previous one cannot do, so the previous frame is cleared
+            # (which clears the whole canvas if it covers it), and this frame
+            # is drawn in full.
+            if pending.offset != (0, 0) or pending.image.size != frame.size:
+                image, transparency = to_palette(previous, ImageChops.invert(previous.getchannel('A')))
+                pending = _GIFFrame(image, (0, 0), pending.params['duration'], transparency)
+            pending.params['disposal'] = 2
+            pending.write(output_file)
+            image, transparency = to_palette(frame, transparent)
+            pending = _GIFFrame(image, (0, 0), duration, transparency)
+        else:
+            pending.write(output_file)
+            # Only the changed rectangle is stored, and unchanged pixels in it
+            # show the previous frame through.
+            unchanged = ImageChops.lighter(ImageChops.invert(changed), transparent)
+            image, transparency = to_palette(frame.crop(bbox), unchanged.crop(bbox))
+            pending = _GIFFrame(image, bbox[:2], duration, transparency)
+        previous = frame
+
+    pending.write(output_file)
+    output_file.write(b';')
+
+
+def compress_animation(image, image_format, size=None, output_format=None):
+    """
+    Return the bytes of the animated image (opened, but not decoded), optimized and keeping all of its frames.
+
+    GIFs are re-encoded frame by frame with save_gif(), and other formats
+    with Pillow's own encoder, which also reads the frames one at a time.
+    With ``size``, the frames are scaled to it. With ``output_format`` set to
+    'WEBP', a GIF is saved as a lossless animated WebP instead, which is
+    usually much smaller.
+    """
+    output_format = output_format or image_format
+    # GIFs without a loop count play once
+    loop = image.info.get('loop', 1)
+    output_file = BytesIO()
+    if image_format == 'GIF' and (output_format == 'GIF' or size is not None):
+        save_gif(iter_frames(image, size), output_file, loop=image.info.get('loop'))
+        if output_format == 'GIF':
+            return output_file.getvalue()
+        # The scaled down GIF is read back a frame at a time to convert it
+        image = Image.open(output_file)
+        output_file = BytesIO()
+    elif size is not None:
+        # Pillow's other encoders need all of the frames up front, so the
+        # scaled down frames are kept in memory.
+        frames, durations = zip(*iter_frames(image, size, binary_alpha=False))
+        frames[0].save(
+            output_file, format=output_format, save_all=True, append_images=frames[1:],
+            duration=list(durations), loop=loop, **get_encoder_options(image_format, output_format)
+        )
+        return output_file.getvalue()
+
+    image.save(
+        output_file, format=output_format, save_all=True, duration=get_durations(image), loop=loop,
+        **get_encoder_options(image_format, output_format)
+    )
+    return output_file.getvalue()
+
+
+def get_encoder_options(image_format, output_format):
+    if output_format == 'WEBP':
+        # GIFs have no more than 256 colors, which lossless WebP stores exactly
+        return {'lossless': image_format == 'GIF', 'minimize_size': True}
+    return {'optimize': True}
@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class OptimizedConfig(AppConfig):
     name = 'optimized_image'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        # Load the optimization backend once, instead of reading the settings
+        # for every image.
+        from .backends import get_backend
+        get_backend()
+        # Connect the receivers that export metrics
+        from . import metrics  # noqa: F401
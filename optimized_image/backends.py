@@ -0,0 +1,589 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from io import SEEK_CUR, SEEK_END, SEEK_SET, BytesIO, RawIOBase
+import mmap
+import subprocess
+import time
+
+from PIL import Image, ImageOps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .animation import compress_animation, is_animated
+from .tinypng import get_client_options, get_tinypng_client, make_tinypng_client
+
+
+# The optimized image bytes, and a dictionary of stats about the optimization:
+# the ``backend`` name, the ``input_size`` and ``output_size`` in bytes, and
+# the ``duration`` in seconds.
+OptimizationResult = namedtuple('OptimizationResult', ['content', 'stats'])
+
+# The formats whose animations Pillow can read and write
+ANIMATED_FORMATS = ('GIF', 'WEBP', 'PNG')
+
+
+# The options that set how images are encoded (see get_save_options()).
+ENCODER_OPTIONS = ('quality', 'progressive', 'subsampling', 'compress_level', 'strip_metadata', 'effort')
+
+# The values of the ``effort`` option, from the fastest to the smallest output.
+EFFORTS = ('low', 'medium', 'high')
+
+
+class BaseBackend:
+    """
+    The interface for image optimization backends.
+
+    Subclasses must implement compress(), which takes the bytes of an image
+    and its Pillow format name (for example, 'JPEG' or 'PNG'), and returns the
+    optimized bytes. The image may be passed as bytes or as a memory-mapped
+    file (mmap), and may be returned as is if it cannot be made smaller.
+    Backends that do their work in Python, rather than waiting on the network
+    or a subprocess, should set ``cpu_bound``, so that the bulk optimizer runs
+    them in a process pool.
+
+    Options for the optimization are passed to compress() as keyword
+    arguments. Backends should ignore options that they do not support.
+    The ``max_dimension`` option (the largest width or height, in pixels, to
+    keep) is handled by optimize(), which scales larger images down with
+    Pillow before compressing them, unless the backend sets ``resizes`` to
+    show that its compress() does that itself. It may come with a
+    ``max_pixels`` option, the most pixels that may be decoded to do so (see
+    scale_down()). The ENCODER_OPTIONS (like ``quality``) set how the image
+    is encoded, and backends should apply those that their encoder supports.
+    """
+    name = None
+    cpu_bound = False
+    resizes = False
+    # The OPTIONS that the backend was loaded with (see load_backend())
+    options = {}
+
+    def describe(self):
+        """Return everything about the backend that changes its output, for the keys of cached results."""
+        return {'backend': self.name, 'options': self.options}
+
+    def optimize(self, content, image_format, **options):
+        """Optimize the image bytes in content, and return an OptimizationResult."""
+        start = time.perf_counter()
+        input_size = len(content)
+        max_dimension = options.get('max_dimension')
+        if max_dimension and not self.resizes:
+            content = scale_down_content(content, image_format, max_dimension, options.get('max_pixels'))
+        optimized_content = self.compress(content, image_format, **options)
+        return OptimizationResult(optimized_content, {
+            'backend': self.name,
+            'input_size': input_size,
+            'output_size': len(optimized_content),
+            'duration': time.perf_counter() - start,
+        })
+
+    def compress(self, content, image_format, **options):
+        raise NotImplementedError
+
+
+class PillowBackend(BaseBackend):
+    """
+    Re-save the image with Pillow's ``optimize`` option.
+
+    With ``max_dimension``, the image is scaled down while it is decoded, so
+    a large JPEG is never decoded at full size.
+
+    The ENCODER_OPTIONS are applied as described in get_save_options().
+
+    Animated GIFs, WebPs, and PNGs keep all of their frames (see
+    compress_animation()). With ``animated_format='WEBP'``, animated GIFs are
+    converted to animated WebPs.
+    """
+    name = 'pillow'
+    cpu_bound = True
+    resizes = True
+
+    def __init__(self, animated_format=None):
+        if animated_format not in (None, 'WEBP'):
+            raise ImproperlyConfigured("PillowBackend's animated_format may only be 'WEBP'.")
+        self.animated_format = animated_format
+
+    def compress(self, content, image_format, max_dimension=None, max_pixels=None, **options):
+        image = open_image(content)
+        if image_format in ANIMATED_FORMATS and is_animated(image):
+            size = None
+            if max_dimension and max(image.size) > max_dimension:
+                size = get_scaled_size(image.size, max_dimension)
+            output_format = self.animated_format if image_format == 'GIF' else None
+            return compress_animation(image, image_format, size, output_format)
+        save_options = get_save_options(image, image_format, **options)
+        if max_dimension:
+            image = scale_down(image, max_dimension, max_pixels)
+        if options.get('strip_metadata'):
+            # The orientation is about to be stripped, so apply it first
+            image = ImageOps.exif_transpose(image)
+        output_file = BytesIO()
+        image.save(output_file, format=image_format, **save_options)
+        return output_file.getvalue()
+
+
+class TinyPNGBackend(BaseBackend):
+    """
+    Optimize the image with the TinyPNG API.
+
+    By default, the client for the TINYPNG_KEY setting is used (see
+    get_tinypng_client()). With a ``key`` (or a list of keys, which are used
+    in turn), or any other options for the TinyPNGClient, the backend has a
+    client of its own, for example, for a tenant with its own key. Either
+    way, the client is created once, and is shared by all of the threads
+    that optimize images.
+    """
+    name = 'tinypng'
+
+    def __init__(self, key=None, **client_options):
+        self.client = None
+        if key is not None or client_options:
+            self.client = make_tinypng_client(
+                settings.TINYPNG_KEY if key is None else key,
+                **dict(get_client_options(), **client_options)
+            )
+
+    def compress(self, content, image_format, **options):
+        client = self.client or get_tinypng_client()
+        # requests would treat a memory-mapped file as a stream, which cannot
+        # be sent again when a request is retried.
+        return client.compress(bytes(content))
+
+
+class JustTestingBackend(BaseBackend):
+    """
+    Make a tiny image and use that instead of the input image.
+
+    (justtesting is NOT a publicly allowed value, it's just for internal testing.)
+    """
+    name = 'justtesting'
+
+    def compress(self, content, image_format, **options):
+        bytes_io = BytesIO()
+        Image.new('RGB', (10, 10), "blue").save(bytes_io, format="JPEG")
+        return bytes_io.getvalue()
+
+
+class SubprocessBackend(BaseBackend):
+    """
+    Optimize the image with a command line tool.
+
+    The image is passed to the ``command`` on stdin, and the optimized image
+    is read from its stdout. Images whose format is not in ``formats`` are
+    returned unchanged, as are images for which the command exits with one of
+    the ``unchanged_returncodes`` (for example, when the tool decided that it
+    could not make the image smaller).
+    """
+    command = None
+    formats = ()
+    unchanged_returncodes = ()
+
+    def __init__(self, command=None, formats=None, unchanged_returncodes=None, timeout=60):
+        if command is not None:
+            self.command = command
+        if formats is not None:
+            self.formats = formats
+        if unchanged_returncodes is not None:
+            self.unchanged_returncodes = unchanged_returncodes
+        self.timeout = timeout
+        if not self.command:
+            raise ImproperlyConfigured('{} needs a command.'.format(self.__class__.__name__))
+        if self.name is None:
+            self.name = self.command[0]
+
+    def get_command(self, image_format, **options):
+        """Return the command to run for an image in image_format, with the given options."""
+        return self.command
+
+    def compress(self, content, image_format, **options):
+        if image_format not in self.formats:
+            return content
+        command = self.get_command(image_format, **options)
+        process = subprocess.run(
+            command, input=content, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            timeout=self.timeout,
+        )
+        if process.returncode in self.unchanged_returncodes:
+            return content
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                process.returncode, command, process.stdout, process.stderr
+            )
+        return process.stdout
+
+
+class MozJPEGBackend(SubprocessBackend):
+    """
+    Losslessly optimize JPEGs with mozjpeg's jpegtran.
+
+    Metadata is kept with ``strip_metadata=False``, and the output is not
+    progressive with ``progressive=False``.
+    """
+    name = 'mozjpeg'
+    command = ['jpegtran', '-copy', 'none', '-optimize', '-progressive']
+    formats = ('JPEG',)
+
+    def get_command(self, image_format, strip_metadata=None, progressive=None, **options):
+        command = list(self.command)
+        if strip_metadata is False:
+            command[command.index('none')] = 'all'
+        if progressive is False:
+            command.remove('-progressive')
+        return command
+
+
+class OxiPNGBackend(SubprocessBackend):
+    """
+    Losslessly optimize PNGs with oxipng.
+
+    The ``effort`` sets the optimization level, and metadata is kept with
+    ``strip_metadata=False``.
+    """
+    name = 'oxipng'
+    command = ['oxipng', '--opt', '2', '--strip', 'safe', '--stdout', '-']
+    formats = ('PNG',)
+    effort_levels = {'low': '1', 'medium': '2', 'high': '4'}
+
+    def get_command(self, image_format, effort=None, strip_metadata=None, **options):
+        command = list(self.command)
+        if effort is not None:
+            command[command.index('--opt') + 1] = self.effort_levels[effort]
+        if strip_metadata is False:
+            del command[command.index('--strip'):command.index('--strip') + 2]
+        return command
+
+
+class PngquantBackend(SubprocessBackend):
+    """
+    Lossily optimize PNGs by reducing them to 256 colors with pngquant.
+
+    The ``quality`` (0 to 100) is the highest quality to aim for, and the
+    ``effort`` sets the speed.
+    """
+    name = 'pngquant'
+    command = ['pngquant', '--skip-if-larger', '--quality', '65-90', '-']
+    formats = ('PNG',)
+    # pngquant exits with 98 if the result would be larger, and with 99 if
+    # it could not meet the minimum quality.
+    unchanged_returncodes = (98, 99)
+    effort_speeds = {'low': '10', 'medium': '4', 'high': '1'}
+
+    def get_command(self, image_format, quality=None, effort=None, **options):
+        command = list(self.command)
+        if quality is not None:
+            command[command.index('--quality') + 1] = '{}-{}'.format(max(quality - 25, 0), quality)
+        if effort is not None:
+            command[-1:-1] = ['--speed', self.effort_speeds[effort]]
+        return command
+
+
+class ChainedBackend(BaseBackend):
+    """
+    Run several backends one after another.
+
+    ``steps`` is a list of (backend, min_size) tuples. A step is skipped if the
+    image is smaller than its ``min_size`` in bytes by the time it gets there,
+    so that, for example, TinyPNG is only used for images that are still large
+    after Pillow has optimized them.
+    """
+    def __init__(self, steps):
+        self.steps = steps
+        self.name = '+'.join(backend.name for backend, min_size in steps)
+
+    def describe(self):
+        return {
+            'backend': self.name,
+            'steps': [dict(backend.describe(), min_size=min_size) for backend, min_size in self.steps],
+        }
+
+    def optimize(self, content, image_format, executor=None, **options):
+        from .utils import sniff_image_format
+
+        start = time.perf_counter()
+        optimized_content = content
+        for backend, min_size in self.steps:
+            if min_size and len(optimized_content) < min_size:
+                continue
+            optimized_content = run_backend(backend, optimized_content, image_format, executor, **options).content
+            # A step may have converted the image to another format
+            image_format = sniff_image_format(optimized_content) or image_format
+        return OptimizationResult(optimized_content, {
+            'backend': self.name,
+            'input_size': len(content),
+            'output_size': len(optimized_content),
+            'duration': time.perf_counter() - start,
+        })
+
+
+def get_save_options(image, image_format, quality=None, progressive=None, subsampling=None, compress_level=None,
+                     strip_metadata=None, effort=None, **options):
+    """
+    Return the keyword arguments for Pillow's save() to save image (as it was opened) in image_format.
+
+    ``quality`` (JPEG, WebP, and AVIF), ``progressive`` (JPEG, and interlaced
+    GIF), ``subsampling`` (JPEG and AVIF, for example '4:2:0'), and
+    ``compress_level`` (PNG, 0 to 9) are passed to the encoder. With
+    ``strip_metadata`` set to True, the EXIF, ICC profile and XMP metadata
+    are left out, and with False, they are kept; by default, Pillow keeps
+    what each format keeps. The ``effort`` (one of EFFORTS) trades the time
+    spent compressing for the size of the output; by default, it is 'high'
+    for JPEG, PNG, and GIF, and Pillow's default for WebP and AVIF.
+    """
+    save_options = {}
+    if image_format in ('JPEG', 'WEBP', 'AVIF') and quality is not None:
+        save_options['quality'] = quality
+    if image_format in ('JPEG', 'AVIF') and subsampling is not None:
+        save_options['subsampling'] = subsampling
+
+    if image_format == 'JPEG':
+        save_options['optimize'] = effort != 'low'
+        if progressive is not None:
+            save_options['progressive'] = progressive
+    elif image_format == 'PNG':
+        # optimize also sets the highest compress_level
+        save_options['optimize'] = effort == 'high' or (effort is None and compress_level is None)
+        if compress_level is None and effort is not None:
+            compress_level = {'low': 1, 'medium': 6, 'high': 9}[effort]
+        if compress_level is not None:
+            save_options['compress_level'] = compress_level
+    elif image_format == 'WEBP':
+        if effort is not None:
+            save_options['method'] = {'low': 0, 'medium': 4, 'high': 6}[effort]
+    elif image_format == 'AVIF':
+        if effort is not None:
+            save_options['speed'] = {'low': 10, 'medium': 6, 'high': 2}[effort]
+    elif image_format == 'GIF':
+        save_options['optimize'] = effort != 'low'
+        if progressive is not None:
+            save_options['interlace'] = progressive
+    else:
+        save_options['optimize'] = True
+
+    if strip_metadata:
+        save_options.update(exif=b'', icc_profile=None, xmp=b'')
+    elif strip_metadata is False:
+        save_options.update({key: image.info[key] for key in ('exif', 'icc_profile', 'xmp') if image.info.get(key)})
+    return save_options
+
+
+def run_backend(backend, content, image_format, executor=None, **options):
+    """
+    Optimize content with backend, and return an OptimizationResult.
+
+    If an ``executor`` is given (for example, a process pool), CPU-bound
+    backends are run in it. The ``options`` are passed on to the backend.
+    """
+    if isinstance(backend, ChainedBackend):
+        return backend.optimize(content, image_format, executor, **options)
+    if executor is not None and backend.cpu_bound:
+        if isinstance(content, mmap.mmap) and isinstance(executor, ProcessPoolExecutor):
+            # A memory-mapped file cannot be sent to another process
+            content = content[:]
+        return executor.submit(backend.optimize, content, image_format, **options).result()
+    return backend.optimize(content, image_format, **options)
+
+
+class MappedFile(RawIOBase):
+    """
+    A read-only file object for a memory-mapped file, which reads it without copying the rest of it.
+
+    Pillow cannot be given the mmap itself: while it works out the format of
+    an image, it may seek past the end of a small file, which files allow,
+    but an mmap rejects with a ValueError.
+    """
+    def __init__(self, content):
+        self.content = content
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.content[self.position:self.position + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self.position
+        elif whence == SEEK_END:
+            offset += len(self.content)
+        elif whence != SEEK_SET:
+            raise ValueError('Invalid whence ({})'.format(whence))
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+
+def open_file(content):
+    """Return a file object for the image bytes (or memory-mapped file) in content."""
+    if isinstance(content, mmap.mmap):
+        return MappedFile(content)
+    return BytesIO(content)
+
+
+def open_image(content):
+    """Return a Pillow image for the image bytes in content, without decoding it yet."""
+    return Image.open(open_file(content))
+
+
+def get_draft_scale(image_size, requested_size):
+    """Return the scale (1, 2, 4, or 8) that Pillow's draft mode decodes a JPEG of image_size at for requested_size."""
+    scale = min(image_size[0] // max(requested_size[0], 1), image_size[1] // max(requested_size[1], 1))
+    for draft_scale in (8, 4, 2):
+        if scale >= draft_scale:
+            return draft_scale
+    return 1
+
+
+def get_budget_scale(image_size, max_pixels):
+    """Return the smallest draft scale at which a JPEG of image_size has at most max_pixels, or None."""
+    for scale in (1, 2, 4, 8):
+        if -(-image_size[0] // scale) * -(-image_size[1] // scale) <= max_pixels:
+            return scale
+    return None
+
+
+def get_scaled_size(image_size, max_dimension):
+    """Return image_size scaled down to fit in a max_dimension pixel square, keeping the aspect ratio."""
+    scale = max_dimension / max(image_size)
+    return (max(round(image_size[0] * scale), 1), max(round(image_size[1] * scale), 1))
+
+
+def scale_down(image, max_dimension, max_pixels=None):
+    """
+    Return image scaled down to fit in a max_dimension pixel square.
+
+    The image should not have been loaded yet. A JPEG is decoded at 1/2, 1/4
+    or 1/8 of its size if that is still large enough (Pillow's draft mode
+    scales it in the DCT domain, which skips most of the decoding work), and
+    is then shrunk by a whole factor with reduce() before the final
+    resampling, so the full-size pixels are never decoded or resampled.
+    If ``max_pixels`` is given, a JPEG is decoded at a small enough scale to
+    have at most that many pixels. Images that already fit are returned as
+    they are.
+    """
+    if max(image.size) <= max_dimension:
+        return image
+    size = get_scaled_size(image.size, max_dimension)
+    # Keep at least twice the final size, so that the LANCZOS resampling
+    # still has the detail to work with.
+    draft_size = (size[0] * 2, size[1] * 2)
+    if max_pixels and image.format == 'JPEG':
+        # Give up some of that detail if it would not fit in the budget
+        draft_scale = max(get_draft_scale(image.size, draft_size), get_budget_scale(image.size, max_pixels) or 8)
+        draft_size = (image.width // draft_scale, image.height // draft_scale)
+    image.draft(image.mode, draft_size)
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    return image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+
+def scale_down_content(content, image_format, max_dimension, max_pixels=None):
+    """
+    Return the image bytes in content scaled down to fit in a max_dimension pixel square.
+
+    This is for backends that cannot resize images themselves. Only the
+    image header is read if the image already fits, in which case content
+    is returned as is.
+    """
+    image = open_image(content)
+    if max(image.size) <= max_dimension:
+        return content
+    if image_format in ANIMATED_FORMATS and is_animated(image):
+        return compress_animation(image, image_format, get_scaled_size(image.size, max_dimension))
+    output_file = BytesIO()
+    # Save at a high quality, since the backend compresses the image afterwards
+    scale_down(image, max_dimension, max_pixels).save(output_file, format=image_format, quality=95)
+    return output_file.getvalue()
+
+
+# The backends that may be used by name in the OPTIMIZED_IMAGE_METHOD and
+# OPTIMIZED_IMAGE_BACKENDS settings. Add to it with register_backend().
+BACKENDS = {
+    'pillow': PillowBackend,
+    'tinypng': TinyPNGBackend,
+    'justtesting': JustTestingBackend,
+    'mozjpeg': MozJPEGBackend,
+    'oxipng': OxiPNGBackend,
+    'pngquant': PngquantBackend,
+}
+
+
+def register_backend(name, backend_class):
+    """Allow backend_class to be used by name in the settings."""
+    BACKENDS[name] = backend_class
+
+
+def load_backend(backend_settings):
+    """
+    Return a backend for an entry of the OPTIMIZED_IMAGE_BACKENDS setting.
+
+    The ``BACKEND`` is a registered name or a dotted path to a backend class,
+    and ``OPTIONS`` are passed to the class.
+    """
+    backend_class = backend_settings['BACKEND']
+    if backend_class in BACKENDS:
+        backend_class = BACKENDS[backend_class]
+    else:
+        backend_class = import_string(backend_class)
+    options = backend_settings.get('OPTIONS', {})
+    backend = backend_class(**options)
+    backend.options = options
+    return backend
+
+
+_backend = None
+_backend_loaded = False
+
+
+def get_backend():
+    """
+    Return the backend that images should be optimized with, or None if they should not be.
+
+    If the OPTIMIZED_IMAGE_BACKENDS setting is set, its backends are chained,
+    for example::
+
+        OPTIMIZED_IMAGE_BACKENDS = [
+            {'BACKEND': 'pillow'},
+            {'BACKEND': 'tinypng', 'MIN_SIZE': 200 * 1024},
+        ]
+
+    Otherwise, the backend is the one named by OPTIMIZED_IMAGE_METHOD. Any
+    other value means that images are not optimized. The backend is loaded
+    once (when the app is ready) and then reused.
+    """
+    global _backend, _backend_loaded
+    if not _backend_loaded:
+        backends_settings = getattr(settings, 'OPTIMIZED_IMAGE_BACKENDS', None)
+        if backends_settings:
+            _backend = ChainedBackend([
+                (load_backend(backend_settings), backend_settings.get('MIN_SIZE'))
+                for backend_settings in backends_settings
+            ])
+        else:
+            method = getattr(settings, 'OPTIMIZED_IMAGE_METHOD', None)
+            if method in BACKENDS:
+                _backend = BACKENDS[method]()
+            else:
+                _backend = None
+        _backend_loaded = True
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    global _backend_loaded
+    if setting in ['OPTIMIZED_IMAGE_METHOD', 'OPTIMIZED_IMAGE_BACKENDS']:
+        _backend_loaded = False
@@ -0,0 +1,669 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import sys
+import tempfile
+import time
+import zlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .backends import get_backend, open_image
+from .fields import OptimizedImageField
+from .limits import MemoryBudget, estimate_memory, open_header
+from .models import OptimizedImageRecord
+from .tinypng import QuotaExceeded
+from .transfer import get_fingerprint, is_remote, read_file
+from .utils import get_optimized_name, is_ignored, is_testing_mode, open_content, optimize_content
+
+
+logger = logging.getLogger(__name__)
+
+
+class InlineExecutor:
+    """
+    An executor that runs each task immediately in the calling thread.
+
+    This is used when only one worker is requested, so that the bulk optimizer
+    behaves exactly like a plain serial loop.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+class Checkpoint:
+    """
+    Remember the last fully optimized primary key for each model.
+
+    The progress is stored as JSON in the file at ``path``, so that an
+    interrupted run can pick up after the last completed row instead of
+    starting over. If ``path`` is None, progress is not saved. Primary keys
+    that JSON has no type for (like UUIDs) are stored as strings, which
+    filtering on the primary key accepts too.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.progress = {}
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.progress = json.load(checkpoint_file)
+
+    def get(self, model):
+        return self.progress.get(model._meta.label)
+
+    def set(self, model, pk):
+        self.progress[model._meta.label] = pk
+        if not self.path:
+            return
+        # Write to a temporary file first, so that a run that is killed while
+        # writing does not leave a corrupt checkpoint behind.
+        temporary_path = '{}.tmp'.format(self.path)
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(self.progress, checkpoint_file, cls=DjangoJSONEncoder)
+        os.replace(temporary_path, self.path)
+
+
+class BulkProgress:
+    """The progress of a BulkOptimizer through the rows of one model."""
+    def __init__(self, model, total_rows):
+        self.model = model
+        self.total_rows = total_rows
+        self.rows = 0
+        # Images that were made smaller, that the backend could not make
+        # smaller, that were already optimized, and that failed
+        self.optimized = 0
+        self.unchanged = 0
+        self.skipped = 0
+        self.failed = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        # Whether the run stopped because the TinyPNG monthly limit was reached
+        self.quota_exceeded = False
+        self.start = time.monotonic()
+
+    @property
+    def images(self):
+        return self.optimized + self.unchanged + self.skipped + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):
+        """Return the number of images handled per second."""
+        return self.images / self.elapsed if self.elapsed else 0
+
+    @property
+    def eta(self):
+        """Return the estimated number of seconds until all rows are done, or None if unknown."""
+        if not self.rows:
+            return None
+        return max(self.total_rows - self.rows, 0) * self.elapsed / self.rows
+
+    @property
+    def saved_bytes(self):
+        return self.input_bytes - self.output_bytes
+
+    def as_dict(self):
+        return {
+            'model': self.model._meta.label,
+            'rows': self.rows,
+            'total_rows': self.total_rows,
+            'optimized': self.optimized,
+            'unchanged': self.unchanged,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'saved_bytes': self.saved_bytes,
+            'rate': self.rate,
+            'eta': self.eta,
+            'quota_exceeded': self.quota_exceeded,
+        }
+
+
+def overwrite_field_file(image_file, content):
+    """
+    Replace the file stored at image_file.name with content, keeping its name.
+
+    Files on the local disk are replaced atomically, with the permissions of
+    the original file. Storages that overwrite existing files (like the S3
+    storages of django-storages, by default) are sent the new file under the
+    same name, in one request. In other storages, content is first saved
+    under a temporary name, so that the original is only deleted once the
+    optimized image is safely stored; then the original is replaced. If the
+    storage picks a different name anyway (for example, because another file
+    took the name in the meantime), or if saving it under the original name
+    fails, image_file.name is changed to the name it was saved under.
+    """
+    image_file.close()
+    storage = image_file.storage
+    try:
+        path = storage.path(image_file.name)
+    except NotImplementedError:
+        path = None
+
+    if path is not None:
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.optimized-')
+        try:
+            with os.fdopen(descriptor, 'wb') as temporary_file:
+                temporary_file.write(content)
+            os.chmod(temporary_path, os.stat(path).st_mode & 0o777)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+    elif storage.get_available_name(image_file.name) == image_file.name:
+        image_file.name = storage.save(image_file.name, ContentFile(content))
+    else:
+        directory, base_name = posixpath.split(image_file.name)
+        temporary_name = storage.save(posixpath.join(directory, '.optimized-' + base_name), ContentFile(content))
+        try:
+            storage.delete(image_file.name)
+            image_file.name = storage.save(image_file.name, ContentFile(content))
+        except Exception:
+            logger.exception('Could not save %s, it was saved as %s instead.', image_file.name, temporary_name)
+            image_file.name = temporary_name
+        else:
+            storage.delete(temporary_name)
+    # Forget the dimensions of the original image
+    if hasattr(image_file, '_dimensions_cache'):
+        del image_file._dimensions_cache
+
+
+def get_shard(pk, shard_count):
+    """
+    Return the shard (from 0 to shard_count - 1) that the row with primary key pk belongs to.
+
+    This uses a hash that is the same in every process and on every machine,
+    unlike hash().
+    """
+    return zlib.crc32(str(pk).encode()) % shard_count
+
+
+def get_shard_checkpoint_path(path, shard):
+    """
+    Return the checkpoint path for the (index, count) shard, like 'progress.shard-2-of-4.json' for 'progress.json'.
+
+    Each shard stops at different rows, so shards that shared a checkpoint
+    would skip each other's rows when they resume.
+    """
+    root, extension = os.path.splitext(path)
+    index, count = shard
+    return '{}.shard-{}-of-{}{}'.format(root, index + 1, count, extension)
+
+
+class BulkOptimizer:
+    """
+    Optimize the images in all OptimizedImageFields of a list of models.
+
+    Pillow work is CPU-bound, so it runs in a pool of processes, while reading
+    and writing files and calling TinyPNG run in a pool of threads. With
+    ``workers`` set to 1 (the default), everything runs serially in the
+    calling thread.
+
+    Rows are loaded ``chunk_size`` at a time, and progress is recorded after
+    each chunk. If a ``progress`` function is given, it is called with the
+    BulkProgress of the current model after each chunk.
+
+    With ``shard`` set to a tuple (index, count), only the rows whose primary
+    key hashes to that index are optimized, so that ``count`` processes (on
+    any number of machines) can share the work, each with its own ``index``.
+    With ``dry_run``, images are counted, but not optimized or saved.
+
+    Optimized images are saved as new files, and the rows that point to them
+    are updated with one bulk_update() per chunk. With ``in_place`` (which
+    defaults to the OPTIMIZED_IMAGE_BULK_IN_PLACE setting), the original
+    files are overwritten instead, so that no files are left behind, and
+    rows only need to be updated if the storage could not keep the name.
+
+    ``memory_budget`` (which defaults to the OPTIMIZED_IMAGE_BULK_MEMORY_BUDGET
+    setting) is the most memory, in bytes, that the images being optimized at
+    the same time may need, as estimated from their headers. Workers wait
+    for memory to be free before they start on an image.
+
+    Files in remote storages (like S3) are downloaded and uploaded in a
+    separate pool of ``transfer_workers`` threads (which defaults to the
+    OPTIMIZED_IMAGE_BULK_TRANSFER_WORKERS setting, or ``workers``), so that
+    waiting on the network overlaps with optimizing. Up to ``prefetch``
+    (the OPTIMIZED_IMAGE_BULK_PREFETCH setting, or ``transfer_workers`` if
+    there are several) files are downloaded ahead of the image being
+    optimized, and uploads are queued without waiting for them to finish.
+    In storages with ETags, a file whose ETag and size are the ones
+    recorded when it was optimized is skipped without being downloaded.
+    """
+    def __init__(self, workers=None, checkpoint_path=None, verbosity=0, chunk_size=None, shard=None,
+                 dry_run=False, progress=None, in_place=None, memory_budget=None, transfer_workers=None,
+                 prefetch=None):
+        if workers is None:
+            workers = getattr(settings, 'OPTIMIZED_IMAGE_BULK_WORKERS', 1)
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'OPTIMIZED_IMAGE_BULK_CHUNK_SIZE', 100)
+        if checkpoint_path is None:
+            checkpoint_path = getattr(settings, 'OPTIMIZED_IMAGE_BULK_CHECKPOINT', None)
+            if checkpoint_path and shard is not None:
+                checkpoint_path = get_shard_checkpoint_path(checkpoint_path, shard)
+        if in_place is None:
+            in_place = getattr(settings, 'OPTIMIZED_IMAGE_BULK_IN_PLACE', False)
+        if memory_budget is None:
+            memory_budget = getattr(settings, 'OPTIMIZED_IMAGE_BULK_MEMORY_BUDGET', None)
+        self.workers = max(int(workers), 1)
+        if transfer_workers is None:
+            transfer_workers = getattr(settings, 'OPTIMIZED_IMAGE_BULK_TRANSFER_WORKERS', self.workers)
+        self.transfer_workers = max(int(transfer_workers), 1)
+        if prefetch is None:
+            prefetch = getattr(
+                settings, 'OPTIMIZED_IMAGE_BULK_PREFETCH', self.transfer_workers if self.transfer_workers > 1 else 0
+            )
+        self.prefetch = max(int(prefetch), 0)
+        self.in_place = in_place
+        self.chunk_size = max(int(chunk_size), 1)
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.verbosity = verbosity
+        self.shard = shard
+        self.dry_run = dry_run
+        self.progress = progress
+        self.memory_budget = MemoryBudget(memory_budget) if memory_budget else None
+
+    def run(self, list_of_models, fields=None):
+        """
+        Optimize the images of each model in list_of_models.
+
+        ``fields`` may map models to the names of the fields to optimize;
+        by default, all of a model's OptimizedImageFields are optimized.
+        """
+        fields = fields or {}
+        if self.workers == 1:
+            io_executor = InlineExecutor()
+            cpu_executor = InlineExecutor()
+        else:
+            io_executor = ThreadPoolExecutor(max_workers=self.workers)
+            cpu_executor = ProcessPoolExecutor(max_workers=self.workers)
+        if self.transfer_workers == 1:
+            transfer_executor = InlineExecutor()
+        else:
+            transfer_executor = ThreadPoolExecutor(max_workers=self.transfer_workers)
+        self.quota_exceeded = False
+        with io_executor, cpu_executor, transfer_executor:
+            self.io_executor = io_executor
+            self.cpu_executor = cpu_executor
+            self.transfer_executor = transfer_executor
+            for model in list_of_models:
+                self.optimize_model(model, fields.get(model))
+                if self.quota_exceeded:
+                    logger.warning(
+                        'The TinyPNG monthly limit was reached. Stopping; run this again '
+                        'next month to optimize the rest of the images.'
+                    )
+                    break
+
+    async def arun(self, list_of_models, fields=None):
+        """
+        Optimize the images of each model in list_of_models, from async code.
+
+        The optimizer runs in Django's thread for synchronous code (where its
+        database queries belong), with its own pools, so the event loop is
+        free in the meantime. It needs asgiref, which comes with Django 3.0
+        and later.
+        """
+        from asgiref.sync import sync_to_async
+
+        await sync_to_async(self.run)(list_of_models, fields)
+
+    def optimize_model(self, model, field_names=None):
+        if self.verbosity == 1:
+            sys.stdout.write('\nOptimizing for model: {}'.format(model))
+
+        field_names_to_optimize = []
+        for field in model._meta.get_fields():
+            if type(field) != OptimizedImageField or field.lazy:
+                # The images of lazy fields are left as they were uploaded
+                continue
+            if field_names is None or field.name in field_names:
+                field_names_to_optimize.append(field.attname)
+
+        if self.verbosity == 1:
+            sys.stdout.write('\nWill check the following fields: {}'.format(field_names_to_optimize))
+
+        if not field_names_to_optimize:
+            return
+
+        last_pk = self.checkpoint.get(model)
+        if last_pk is not None and self.verbosity == 1:
+            sys.stdout.write('\nResuming after instance id {}'.format(last_pk))
+
+        # Only load the primary key and the image columns (with their
+        # dimension fields, which ImageField reads when each row is loaded),
+        # and page through the table by primary key, so that memory use does
+        # not grow with the size of the table, and each page is a cheap index
+        # range scan.
+        loaded_field_names = list(field_names_to_optimize)
+        for field_name in field_names_to_optimize:
+            field = model._meta.get_field(field_name)
+            loaded_field_names.extend(name for name in (field.width_field, field.height_field) if name)
+        model_instances = model.objects.only(*loaded_field_names).order_by('pk')
+        remaining = model_instances if last_pk is None else model_instances.filter(pk__gt=last_pk)
+        total_rows = remaining.count()
+        if self.shard is not None:
+            # An estimate, since the rows are spread evenly over the shards
+            total_rows = -(-total_rows // self.shard[1])
+        self.stats = BulkProgress(model, total_rows)
+        while True:
+            if last_pk is None:
+                chunk = list(model_instances[:self.chunk_size])
+            else:
+                chunk = list(model_instances.filter(pk__gt=last_pk)[:self.chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            if self.shard is not None:
+                # Only the rows of this shard are optimized, but the
+                # checkpoint still moves past the whole chunk.
+                index, count = self.shard
+                shard_chunk = [instance for instance in chunk if get_shard(instance.pk, count) == index]
+            else:
+                shard_chunk = chunk
+            if shard_chunk:
+                self.optimize_batch(model, shard_chunk, field_names_to_optimize)
+            if self.quota_exceeded:
+                # The checkpoint is not moved past the interrupted chunk
+                self.stats.quota_exceeded = True
+            elif not self.dry_run:
+                self.checkpoint.set(model, last_pk)
+            if self.progress is not None:
+                self.progress(self.stats)
+            if self.quota_exceeded:
+                break
+
+    def optimize_batch(self, model, model_instances, field_names_to_optimize):
+        # Load the records of files that were already optimized for the whole
+        # chunk at once.
+        names = []
+        for model_instance in model_instances:
+            for field_name in field_names_to_optimize:
+                names.append(getattr(model_instance, field_name).name)
+        records = {
+            record.name: record
+            for record in OptimizedImageRecord.objects.filter(name__in=names)
+        }
+        self.stats.rows += len(model_instances)
+        if self.dry_run:
+            self.count_batch(model_instances, field_names_to_optimize, records)
+            return
+
+        images = []
+        for model_instance in model_instances:
+            for field_name in field_names_to_optimize:
+                if self.verbosity == 1:
+                    sys.stdout.write('\nChecking for instance id {} field {}'.format(model_instance.pk, field_name))
+
+                # If the instance's field has an image, optimize it
+                image_file = getattr(model_instance, field_name)
+                if image_file.name in [None, ''] or self.is_ignored(image_file):
+                    continue
+
+                if self.verbosity == 1:
+                    sys.stdout.write('\nImage found. Optimizing.')
+                images.append((model_instance, field_name, image_file, records.get(image_file.name)))
+
+        self.new_records = []
+        self.updated_instances = {}
+        self.updated_field_names = set()
+        # The files of remote storages are downloaded up to ``prefetch``
+        # images ahead, and at most ``workers`` images more than that are in
+        # flight, so that memory use stays bounded.
+        prefetched = {}
+        next_prefetch = 0
+        in_flight = deque()
+        for index, (model_instance, field_name, image_file, record) in enumerate(images):
+            while next_prefetch < len(images) and next_prefetch <= index + self.prefetch:
+                prefetch_file, prefetch_record = images[next_prefetch][2:]
+                if is_remote(prefetch_file.storage):
+                    prefetched[next_prefetch] = self.transfer_executor.submit(
+                        self.fetch_field_file, prefetch_file, prefetch_record
+                    )
+                next_prefetch += 1
+            if len(in_flight) >= self.workers + self.prefetch:
+                self.collect_result(*in_flight.popleft())
+
+            original_name = image_file.name
+            future = self.io_executor.submit(self.optimize_field_file, image_file, record, prefetched.pop(index, None))
+            in_flight.append((model_instance, field_name, original_name, future))
+        while in_flight:
+            self.collect_result(*in_flight.popleft())
+
+        updated_instances = list(self.updated_instances.values())
+        new_records = self.new_records
+        if updated_instances:
+            # Point the rows at the new files (and store the dimensions of
+            # images that were scaled down) with one query per chunk, instead
+            # of saving each row.
+            model.objects.bulk_update(updated_instances, sorted(self.updated_field_names))
+            if self.verbosity == 1:
+                sys.stdout.write('\nSaved {} rows with optimized images.'.format(len(updated_instances)))
+
+        if new_records:
+            OptimizedImageRecord.objects.filter(
+                name__in=[record.name for record in new_records]
+            ).delete()
+            OptimizedImageRecord.objects.bulk_create(new_records)
+
+    def collect_result(self, model_instance, field_name, original_name, future):
+        """Wait for the optimization of the image in field_name of model_instance, and count its result."""
+        image_file = getattr(model_instance, field_name)
+        changed = False
+        try:
+            record = future.result()
+            if isinstance(record, Future):
+                # The optimized image is still being uploaded
+                record = record.result()
+            if record is not None:
+                self.new_records.append(record)
+                self.stats.input_bytes += record.original_size
+                self.stats.output_bytes += record.optimized_size
+                changed = record.optimized_hash != record.original_hash
+                if changed:
+                    self.stats.optimized += 1
+                else:
+                    self.stats.unchanged += 1
+            else:
+                self.stats.skipped += 1
+                if self.verbosity == 1:
+                    sys.stdout.write('\nImage {} already optimized. Skipping.'.format(image_file.name))
+        except QuotaExceeded:
+            # Finish saving the images that were optimized, but do
+            # not mark this chunk as done.
+            self.quota_exceeded = True
+        except Exception:
+            self.stats.failed += 1
+            if is_testing_mode():
+                # This shouldn't actually happen, so if testing, let the exception continue
+                # up the call chain so it makes the test fail.
+                raise
+            # Keep going with the other images. Failures of the
+            # backend itself are also reported by the
+            # optimization_failed signal.
+            logger.exception('Optimization failed for %s.', image_file.name)
+        updated_field_names = []
+        if image_file.name != original_name:
+            updated_field_names.append(field_name)
+        field = image_file.field
+        if changed and (field.width_field or field.height_field):
+            # The image may have been scaled down
+            field.update_dimension_fields(model_instance, force=True)
+            updated_field_names.extend(name for name in (field.width_field, field.height_field) if name)
+        if updated_field_names:
+            self.updated_instances[id(model_instance)] = model_instance
+            self.updated_field_names.update(updated_field_names)
+
+    def count_batch(self, model_instances, field_names_to_optimize, records):
+        """
+        Count the images of model_instances that would be optimized, for a dry run.
+
+        Images that were optimized with the current backend before are
+        counted as skipped, without checking whether they changed since. The
+        others are counted as optimized, without any savings, since they are
+        not actually optimized.
+        """
+        backend = get_backend()
+        for model_instance in model_instances:
+            for field_name in field_names_to_optimize:
+                image_file = getattr(model_instance, field_name)
+                if image_file.name in [None, ''] or self.is_ignored(image_file):
+                    continue
+                record = records.get(image_file.name)
+                if backend is None or (record is not None and record.method == backend.name):
+                    self.stats.skipped += 1
+                else:
+                    self.stats.optimized += 1
+                    self.stats.input_bytes += image_file.size
+                    self.stats.output_bytes += image_file.size
+
+    def is_ignored(self, image_file):
+        """Return True if the image_file has an extension that should not be optimized."""
+        if is_ignored(image_file.name):
+            if self.verbosity == 1:
+                sys.stdout.write(
+                    '\nImage has extension {ext}. Ignoring.'.format(ext=image_file.name.split('.')[-1])
+                )
+            return True
+        return False
+
+    def reserve_memory(self, content):
+        """Wait until there is enough of the memory budget to optimize content, and return the bytes reserved."""
+        if self.memory_budget is None:
+            return 0
+        try:
+            size = estimate_memory(open_header(content), len(content))
+        except Exception:
+            # The optimization itself will report what is wrong with the image
+            size = len(content)
+        return self.memory_budget.acquire(size)
+
+    def fetch_field_file(self, image_file, record=None):
+        """
+        Download the file in image_file from its remote storage, and return its bytes.
+
+        This runs in the transfer pool, ahead of the optimization. Return
+        None, without downloading the file, if its ETag and size show that
+        it has not changed since it was optimized with the same method (as
+        recorded in ``record``).
+        """
+        if record is not None and record.etag:
+            backend = get_backend()
+            if backend is not None and record.method == backend.name and (
+                get_fingerprint(image_file.storage, image_file.name) == (record.etag, record.optimized_size)
+            ):
+                return None
+        return read_file(image_file.storage, image_file.name)
+
+    def optimize_field_file(self, image_file, record=None, prefetched=None):
+        """
+        Optimize the file in image_file, and save it in place of the unoptimized one.
+
+        This runs in the thread pool. The model instance itself is not saved
+        here, since that is done once per chunk by the calling thread. If the
+        file is unchanged since it was optimized with the same method (as
+        recorded in ``record``), it is skipped. ``prefetched`` is the Future
+        of fetch_field_file(), for files in remote storages.
+        Return a new (unsaved) OptimizedImageRecord if the image was
+        optimized, or None if it was not. For remote storages, the optimized
+        image is uploaded in the transfer pool, and a Future of the record
+        is returned instead.
+        """
+        backend = get_backend()
+        if backend is None:
+            return None
+
+        if prefetched is not None:
+            content = prefetched.result()
+            if content is None:
+                # The ETag shows that it is unchanged since it was optimized
+                return None
+            opened_content = nullcontext(content)
+        else:
+            opened_content = open_content(image_file)
+
+        image_file_extension = image_file.name.split('.')[-1]
+        with opened_content as content:
+            original_hash = hashlib.sha256(content).hexdigest()
+            if record is not None and record.method == backend.name and record.optimized_hash == original_hash:
+                return None
+
+            reserved = self.reserve_memory(content)
+            try:
+                result = optimize_content(
+                    content, image_file_extension, executor=self.cpu_executor, name=image_file.name,
+                    **image_file.field.get_optimization_options()
+                )
+            finally:
+                if reserved:
+                    self.memory_budget.release(reserved)
+            unchanged = result.content is content
+
+        save = partial(self.save_field_file, image_file, result, original_hash, unchanged)
+        if not unchanged and is_remote(image_file.storage):
+            # Upload it while this thread goes on to the next image
+            return self.transfer_executor.submit(save)
+        return save()
+
+    def save_field_file(self, image_file, result, original_hash, unchanged):
+        """Save the optimized image in result in place of the one in image_file, and return its record."""
+        if unchanged:
+            # The backend could not make the image smaller, so keep the
+            # original file, but record it so that it is not tried again.
+            optimized_hash = original_hash
+        else:
+            optimized_hash = hashlib.sha256(result.content).hexdigest()
+            optimized_name = get_optimized_name(image_file.name, result)
+            if self.in_place and optimized_name == image_file.name:
+                # The memory-mapped original was closed above, so it can be
+                # replaced.
+                overwrite_field_file(image_file, result.content)
+                if image_file.field.width_field or image_file.field.height_field:
+                    # Read the new dimensions now, instead of from storage
+                    # when the dimension fields are updated
+                    image_file._dimensions_cache = open_image(result.content).size
+            else:
+                # Save the image in place of the unoptimized one
+                original_name = image_file.name
+                content_file = ContentFile(result.content)
+                image_name = os.path.relpath(optimized_name, image_file.field.upload_to)
+                image_file.save(image_name, content_file, save=False)
+                if self.in_place:
+                    # The image was converted to another format, so it could
+                    # not overwrite the original, which is removed instead.
+                    image_file.storage.delete(original_name)
+        fingerprint = get_fingerprint(image_file.storage, image_file.name)
+        return OptimizedImageRecord(
+            name=image_file.name,
+            method=result.stats['backend'],
+            original_hash=original_hash,
+            optimized_hash=optimized_hash,
+            original_size=result.stats['input_size'],
+            optimized_size=result.stats['output_size'],
+            etag=fingerprint[0] if fingerprint is not None else '',
+        )
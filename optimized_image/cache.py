@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db.models import Sum
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+def make_cache_key(content, method, options=None):
+    """
+    Return a key for the optimized version of the image bytes in content.
+
+    The key is a hash of the image bytes, the optimization method, and any
+    options that change the output, so that the same image optimized in a
+    different way does not share a cache entry.
+    """
+    key = hashlib.sha256(content)
+    key.update(method.encode())
+    key.update(json.dumps(options or {}, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+class BaseCache:
+    """
+    The interface for caches of optimized images.
+
+    A cache maps a key from make_cache_key() to the optimized image bytes.
+    Subclasses must implement get() and set(), and are responsible for
+    evicting entries when they grow too large.
+    """
+    def get(self, key):
+        """Return the optimized bytes stored for key, or None if there are none."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Store the optimized bytes value for key."""
+        raise NotImplementedError
+
+
+class FileSystemCache(BaseCache):
+    """
+    Store optimized images as files in the directory at ``location``.
+
+    If ``max_size`` (in bytes) is given, the least recently used files are
+    deleted whenever the cache grows past it.
+    """
+    def __init__(self, location, max_size=None):
+        self.location = location
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = sum(size for path, size, last_used in self.entries())
+
+    def path(self, key):
+        return os.path.join(self.location, key[:2], key)
+
+    def entries(self):
+        """Yield a (path, size, last_used) tuple for every file in the cache."""
+        if not os.path.isdir(self.location):
+            return
+        for directory, dirnames, filenames in os.walk(self.location):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as cached_file:
+                value = cached_file.read()
+            # Mark the file as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary_path, 'wb') as cached_file:
+            cached_file.write(value)
+        os.replace(temporary_path, path)
+        with self.lock:
+            self.size += len(value)
+            if self.max_size is not None and self.size > self.max_size:
+                self.cull()
+
+    def cull(self):
+        """Delete the least recently used files until the cache is below 90% of max_size."""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, last_used in entries:
+            if size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.size = size
+
+
+class DjangoCache(BaseCache):
+    """
+    Store optimized images in one of the caches from the CACHES setting.
+
+    Eviction is left to the cache backend (memcached and Redis evict the least
+    recently used entries, and the local-memory cache has MAX_ENTRIES).
+    """
+    def __init__(self, alias='default', timeout=None, key_prefix='optimized_image'):
+        self.alias = alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def make_key(self, key):
+        return '{}:{}'.format(self.key_prefix, key)
+
+    def get(self, key):
+        return caches[self.alias].get(self.make_key(key))
+
+    def set(self, key, value):
+        caches[self.alias].set(self.make_key(key), value, self.timeout)
+
+
+class DatabaseCache(BaseCache):
+    """
+    Store optimized images in the CachedOptimization table.
+
+    If there are more than ``max_entries`` rows, or more than ``max_size``
+    bytes of images, the least recently used rows are deleted.
+    """
+    def __init__(self, max_entries=1000, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+    def get(self, key):
+        from .models import CachedOptimization
+
+        entry = CachedOptimization.objects.filter(key=key).first()
+        if entry is None:
+            return None
+        CachedOptimization.objects.filter(key=key).update(last_used=timezone.now())
+        return bytes(entry.content)
+
+    def set(self, key, value):
+        from .models import CachedOptimization
+
+        CachedOptimization.objects.update_or_create(
+            key=key,
+            defaults={'content': value, 'size': len(value), 'last_used': timezone.now()},
+        )
+        self.cull()
+
+    def cull(self):
+        from .models import CachedOptimization
+
+        entries = CachedOptimization.objects.order_by('-last_used')
+        if self.max_entries is not None:
+            stale_keys = entries.values_list('key', flat=True)[self.max_entries:]
+            CachedOptimization.objects.filter(key__in=list(stale_keys)).delete()
+        if self.max_size is not None:
+            total_size = entries.aggregate(total=Sum('size'))['total'] or 0
+            if total_size <= self.max_size:
+                return
+            stale_keys = []
+            for key, size in entries.reverse().values_list('key', 'size'):
+                if total_size <= self.max_size:
+                    break
+                stale_keys.append(key)
+                total_size -= size
+            CachedOptimization.objects.filter(key__in=stale_keys).delete()
+
+
+_cache = None
+
+
+def get_optimization_cache():
+    """
+    Return the cache from the OPTIMIZED_IMAGE_CACHE setting, or None if it is not set.
+
+    The setting is a dictionary like Django's CACHES entries, for example::
+
+        OPTIMIZED_IMAGE_CACHE = {
+            'BACKEND': 'optimized_image.cache.FileSystemCache',
+            'OPTIONS': {'location': '/var/cache/optimized_image', 'max_size': 2 ** 30},
+        }
+    """
+    global _cache
+    if _cache is None:
+        cache_settings = getattr(settings, 'OPTIMIZED_IMAGE_CACHE', None)
+        if not cache_settings:
+            return None
+        backend = import_string(cache_settings['BACKEND'])
+        _cache = backend(**cache_settings.get('OPTIONS', {}))
+    return _cache
+
+
+@receiver(setting_changed)
+def reset_optimization_cache(setting, **kwargs):
+    global _cache
+    if setting == 'OPTIMIZED_IMAGE_CACHE':
+        _cache = None
@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import mmap
+
+from PIL import Image
+
+from .animation import is_animated
+from .backends import ENCODER_OPTIONS, OptimizationResult, get_save_options, open_image, run_backend, scale_down
+from .variants import FORMATS_WITHOUT_ALPHA
+
+
+# The options to encode an image in each format that it may be converted to
+CONVERT_OPTIONS = {
+    'WEBP': {'quality': 80},
+    'AVIF': {'quality': 60},
+    'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+}
+
+DEFAULT_MIN_SSIM = 0.95
+
+
+def can_convert_to(image_format):
+    """Return True if Pillow can save images in image_format."""
+    Image.init()
+    return image_format in CONVERT_OPTIONS and image_format in Image.SAVE
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def decode(content, max_dimension=None, max_pixels=None):
+    """Return the image in content decoded as RGB or RGBA, scaled down like the backends would."""
+    image = open_image(content)
+    if max_dimension:
+        image = scale_down(image, max_dimension, max_pixels)
+    return image.convert('RGBA' if has_alpha(image) else 'RGB')
+
+
+def get_window_ssim(pixels, other_pixels, width, height, window=8):
+    """Return the mean SSIM over the window x window squares of two single band images of width x height."""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    if width < window or height < window:
+        # Too small for windows, so the whole image is one window
+        boxes = [(0, 0, width, height)]
+    else:
+        boxes = [
+            (x, y, x + window, y + window)
+            for y in range(0, height - window + 1, window)
+            for x in range(0, width - window + 1, window)
+        ]
+    total = 0
+    for left, top, right, bottom in boxes:
+        values = []
+        other_values = []
+        for y in range(top, bottom):
+            values.extend(pixels[y * width + left:y * width + right])
+            other_values.extend(other_pixels[y * width + left:y * width + right])
+        count = len(values)
+        mean = sum(values) / count
+        other_mean = sum(other_values) / count
+        variance = sum((value - mean) ** 2 for value in values) / count
+        other_variance = sum((value - other_mean) ** 2 for value in other_values) / count
+        covariance = sum((value - mean) * (other - other_mean) for value, other in zip(values, other_values)) / count
+        total += (
+            ((2 * mean * other_mean + c1) * (2 * covariance + c2)) /
+            ((mean ** 2 + other_mean ** 2 + c1) * (variance + other_variance + c2))
+        )
+    return total / len(boxes)
+
+
+def get_ssim(image, other, size=256):
+    """
+    Return the structural similarity (SSIM, from 0 to 1) of two RGB or RGBA images of the same size.
+
+    The brightness of the images (composited over white, since encoders may
+    change the color of transparent pixels), and their transparency, are
+    compared in 8 x 8 windows, on copies scaled to fit in a size pixel square
+    to keep this fast. The lower of the two is returned.
+    """
+    bands = []
+    for current in (image, other):
+        current = current.convert('RGBA')
+        if max(current.size) > size:
+            current.thumbnail((size, size), Image.BILINEAR)
+        white = Image.new('RGBA', current.size, (255, 255, 255, 255))
+        bands.append((Image.alpha_composite(white, current).convert('L'), current.getchannel('A')))
+
+    (luma, alpha), (other_luma, other_alpha) = bands
+    width, height = luma.size
+    ssim = get_window_ssim(luma.tobytes(), other_luma.tobytes(), width, height)
+    if has_alpha(image) or has_alpha(other):
+        ssim = min(ssim, get_window_ssim(alpha.tobytes(), other_alpha.tobytes(), width, height))
+    return ssim
+
+
+def encode_candidate(content, output_format, min_ssim, max_dimension=None, max_pixels=None, encoder_options=None):
+    """
+    Return the image bytes in content encoded in output_format, or None if that loses too much quality.
+
+    The ``encoder_options`` (see get_save_options()) override the
+    CONVERT_OPTIONS. The candidate is decoded again and compared with the
+    original (scaled down the same way), and rejected if its SSIM is below
+    min_ssim.
+    """
+    image = decode(content, max_dimension, max_pixels)
+    if output_format in FORMATS_WITHOUT_ALPHA and image.mode == 'RGBA':
+        return None
+    save_options = dict(CONVERT_OPTIONS[output_format])
+    if encoder_options:
+        save_options.update(get_save_options(open_image(content), output_format, **encoder_options))
+    output_file = BytesIO()
+    image.save(output_file, format=output_format, **save_options)
+    candidate = output_file.getvalue()
+    if min_ssim and get_ssim(image, Image.open(BytesIO(candidate))) < min_ssim:
+        return None
+    return candidate
+
+
+def optimize_and_convert(backend, content, image_format, executor=None, convert_formats=(), min_ssim=None,
+                         **options):
+    """
+    Optimize content with backend, and return the smallest of that and of content converted to convert_formats.
+
+    The conversions are encoded with Pillow at the same time as the backend
+    optimizes the image in its own format: in the ``executor`` if one is
+    given (for example, the bulk optimizer's process pool), and otherwise in
+    a thread for each format (Pillow releases the GIL while it encodes), so
+    trying more formats does not make an upload take much longer. A
+    conversion is only used if its SSIM compared to the original is at least
+    ``min_ssim`` (by default, DEFAULT_MIN_SSIM). Animated images are not
+    converted.
+    """
+    if min_ssim is None:
+        min_ssim = DEFAULT_MIN_SSIM
+    formats = [
+        output_format for output_format in convert_formats
+        if output_format != image_format and can_convert_to(output_format)
+    ]
+    if formats:
+        try:
+            if is_animated(open_image(content)):
+                formats = []
+        except (OSError, SyntaxError):
+            # Not an image that Pillow can read, so it is left to the backend
+            formats = []
+    if not formats:
+        return run_backend(backend, content, image_format, executor, **options)
+
+    encoder_options = {key: options[key] for key in ENCODER_OPTIONS if key in options}
+    candidate_args = (min_ssim, options.get('max_dimension'), options.get('max_pixels'), encoder_options)
+    # A memory-mapped file has a single read position, which the backend and
+    # the conversions would race on (and it cannot be sent to another
+    # process), so the conversions get their own copy of the bytes.
+    candidate_content = content[:] if isinstance(content, mmap.mmap) else content
+    pool = ThreadPoolExecutor(max_workers=len(formats)) if executor is None else None
+    try:
+        futures = [
+            (pool or executor).submit(encode_candidate, candidate_content, output_format, *candidate_args)
+            for output_format in formats
+        ]
+        result = run_backend(backend, content, image_format, executor, **options)
+        candidates = [future.result() for future in futures]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    best = result
+    for candidate in candidates:
+        if candidate is not None and len(candidate) < len(best.content):
+            best = OptimizationResult(candidate, dict(result.stats, output_size=len(candidate)))
+    return best
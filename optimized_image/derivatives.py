@@ -0,0 +1,154 @@
+import hashlib
+import json
+import time
+
+from PIL import Image
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+
+from .backends import get_backend, open_image
+from .limits import ImageTooLarge
+from .models import ImageDerivative
+from .utils import add_conversion_options, open_content, optimize_content, sniff_image_format
+from .variants import FORMAT_EXTENSIONS, encode_variant
+
+
+# Where derivatives are saved, in the storage of the field
+DERIVATIVE_LOCATION = 'optimized_image/derivatives'
+
+# How often, in seconds, a request that is waiting for another request to
+# make a derivative checks whether it is done
+POLL_INTERVAL = 0.1
+
+
+def get_options_key(field, width=None, image_format=None):
+    """
+    Return a hash of everything that changes the derivative of an image in field.
+
+    That is the backend (with its options, or the steps of a chain) and the
+    field's optimization options (with the conversion settings), or, for a
+    variant, its width and format. Changing
+    any of them makes new derivatives, instead of serving stale ones.
+    """
+    if width is not None:
+        options = {'width': width, 'format': image_format}
+    else:
+        backend = get_backend()
+        options = {
+            'backend': backend.describe() if backend is not None else None,
+            'options': add_conversion_options(field.get_optimization_options()),
+        }
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def get_lock_timeout():
+    return getattr(settings, 'OPTIMIZED_IMAGE_LAZY_LOCK_TIMEOUT', 60)
+
+
+def get_derivative(field, name, width=None, image_format=None):
+    """
+    Return the ImageDerivative of the image stored at name in field, making it if it does not exist yet.
+
+    Without a ``width``, the derivative is the image optimized with the
+    field's options, and with one, it is the variant of that width in
+    ``image_format``. Only one request makes a derivative at a time: it
+    takes a lock in the cache from the OPTIMIZED_IMAGE_LAZY_LOCK_CACHE
+    setting (by default, 'default'; use a cache that all of the web servers
+    share, like Redis or memcached), and other requests for the same
+    derivative wait for it to be saved, instead of all optimizing the same
+    image when it is first requested. The lock expires after
+    OPTIMIZED_IMAGE_LAZY_LOCK_TIMEOUT (default 60) seconds, in case the
+    request that holds it dies.
+    """
+    options_key = get_options_key(field, width, image_format)
+    derivative = ImageDerivative.objects.filter(name=name, options_key=options_key).first()
+    if derivative is not None:
+        return derivative
+
+    cache = caches[getattr(settings, 'OPTIMIZED_IMAGE_LAZY_LOCK_CACHE', 'default')]
+    lock_key = 'optimized_image:derivative:{}'.format(
+        hashlib.sha256('{}:{}'.format(name, options_key).encode()).hexdigest()
+    )
+    while not cache.add(lock_key, True, get_lock_timeout()):
+        time.sleep(POLL_INTERVAL)
+        derivative = ImageDerivative.objects.filter(name=name, options_key=options_key).first()
+        if derivative is not None:
+            return derivative
+    try:
+        # It may have been made between the first check and taking the lock
+        derivative = ImageDerivative.objects.filter(name=name, options_key=options_key).first()
+        if derivative is None:
+            derivative = make_derivative(field, name, options_key, width, image_format)
+        return derivative
+    finally:
+        cache.delete(lock_key)
+
+
+def make_derivative(field, name, options_key, width=None, image_format=None):
+    """
+    Make, save, and return the ImageDerivative of the image stored at name in field.
+
+    The derivative is saved under a name made from the hash of the image and
+    the options_key, so images with the same contents share it, and one that
+    is already in storage is not made again. If optimizing cannot make the
+    image any smaller, the derivative is the image itself.
+    """
+    storage = field.storage
+    with open_content(FieldFile(None, field, name)) as content:
+        source_hash = hashlib.sha256(content).hexdigest()
+        derivative_content = None
+        if width is not None:
+            derivative_content = make_variant(content, width, image_format)
+        else:
+            options = field.get_optimization_options()
+            try:
+                result = optimize_content(content, name.split('.')[-1], name=name, **options)
+            except ImageTooLarge:
+                result = None
+            if result is not None and result.content is not content:
+                derivative_content = result.content
+                image_format = sniff_image_format(derivative_content)
+        if derivative_content is None:
+            image_format = sniff_image_format(content)
+            derivative_name = name
+            size = len(content)
+        else:
+            derivative_name = '{}/{}/{}-{}.{}'.format(
+                DERIVATIVE_LOCATION, source_hash[:2], source_hash, options_key[:16],
+                FORMAT_EXTENSIONS.get(image_format, name.split('.')[-1]),
+            )
+            size = len(derivative_content)
+            if not storage.exists(derivative_name):
+                derivative_name = storage.save(derivative_name, ContentFile(derivative_content))
+
+    derivative, created = ImageDerivative.objects.get_or_create(
+        name=name,
+        options_key=options_key,
+        defaults={
+            'source_hash': source_hash,
+            'derivative_name': derivative_name,
+            'image_format': image_format or '',
+            'size': size,
+        },
+    )
+    return derivative
+
+
+def make_variant(content, width, image_format):
+    """Return the bytes of the image in content scaled down to width (if it is wider), in image_format."""
+    image = open_image(content)
+    image.load()
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    if width < image.width:
+        height = max(round(image.height * width / image.width), 1)
+        image = image.resize((width, height), Image.LANCZOS)
+    return encode_variant(image, image_format)
+
+
+def delete_derivatives(name):
+    """Forget the derivatives of the image stored at name, which has been replaced."""
+    ImageDerivative.objects.filter(name=name).delete()
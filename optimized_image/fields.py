@@ -1,14 +1,350 @@
-from django.db.models import ImageField
+from PIL import Image
+
+from django.core import checks
+from django.db import transaction
+from django.db.models import ImageField, signals
+from django.db.models.fields.files import ImageFieldFile
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from .limits import validate_image_size
+
+
+class OptimizedImageFieldFile(ImageFieldFile):
+    """An ImageFieldFile that knows about the resized variants of its image."""
+
+    @property
+    def variants(self):
+        """
+        Return the Variants of the image, from the smallest to the largest.
+
+        Only the widths that are smaller than the image have variants. The
+        image's width is read from the field's ``width_field``, so set one
+        for fields whose variants are listed for many rows: otherwise, the
+        image is opened to find its width, once for each model instance
+        (which is a download, for a remote storage).
+        """
+        from .variants import Variant, variant_name
+
+        if not self or not self.field.variant_widths:
+            return []
+        image_width = getattr(self.instance, self.field.width_field) if self.field.width_field else None
+        if image_width is None:
+            image_width = self.width
+        variants = []
+        for width in sorted(set(self.field.variant_widths)):
+            if width >= image_width:
+                continue
+            for image_format in self.field.get_variant_formats(self.name):
+                name = variant_name(self.name, width, image_format)
+                if self.field.lazy:
+                    # The variant is made when it is first requested
+                    url = '{}?{}'.format(self.get_derivative_url(), urlencode({'w': width, 'format': image_format}))
+                else:
+                    url = self.storage.url(name)
+                variants.append(Variant(width, image_format, name, url))
+        return variants
+
+    @property
+    def optimized_url(self):
+        """
+        Return the URL of the optimized image.
+
+        This is the ``url`` of the file, unless the field is lazy, in which
+        case it is the URL of the view that optimizes the image when it is
+        first requested.
+        """
+        if self.field.lazy:
+            return self.get_derivative_url()
+        return self.url
+
+    def get_derivative_url(self):
+        self._require_file()
+        return reverse('optimized_image_derivative', kwargs={
+            'field': '{}.{}'.format(self.field.model._meta.label, self.field.name),
+            'name': self.name,
+        })
+
+    def srcset(self, image_format=None):
+        """
+        Return the value of a srcset attribute for the variants in image_format.
+
+        If no image_format is given, the first of the field's variant_formats is used.
+        """
+        variants = self.variants
+        if not variants:
+            return ''
+        if image_format is None:
+            image_format = variants[0].format
+        return ', '.join(
+            '{} {}w'.format(variant.url, variant.width)
+            for variant in variants
+            if variant.format == image_format.upper()
+        )
 
 
 class OptimizedImageField(ImageField):
-    """An ImageField that gets optimized on save() using tinyPNG."""
+    """
+    An ImageField that gets optimized on save() using tinyPNG.
+
+    With ``deferred=True``, the original image is saved right away, and the
+    optimization is queued once the transaction is committed (see the
+    OPTIMIZED_IMAGE_QUEUE setting).
+
+    If ``variant_widths`` are given, a resized copy of the image is saved for
+    each width (that is smaller than the image) in each of the
+    ``variant_formats`` (by default, the image's own format, or PNG for
+    formats that variants cannot be saved in, like BMP), and they are
+    available from the ``variants`` and ``srcset()`` of the field's file.
+
+    If ``max_dimension`` is given, images that are wider or taller than that
+    many pixels are scaled down to fit when they are optimized.
+
+    With ``convert_formats`` (for example, ``['webp', 'avif']``), the image is
+    also converted to each of those formats, and saved in whichever format is
+    smallest, as long as its quality (SSIM) is at least ``min_ssim``. They
+    default to the OPTIMIZED_IMAGE_CONVERT_FORMATS and
+    OPTIMIZED_IMAGE_CONVERT_MIN_SSIM settings.
+
+    The ``quality``, ``progressive``, ``subsampling``, ``compress_level``,
+    ``strip_metadata``, and ``effort`` arguments set how the image is
+    encoded, for the backends that support them (see
+    optimized_image.backends.get_save_options()).
+
+    With ``lazy=True``, images are saved as they are uploaded, without being
+    optimized or having variants made. Instead, the ``optimized_url`` of the
+    field's file, and the URLs of its variants, point to a view that
+    optimizes the image the first time that it is requested, saves the
+    result (see optimized_image.derivatives), and serves that from then on.
+
+    Uploads that are too large to optimize within the memory limits (see the
+    OPTIMIZED_IMAGE_MAX_PIXELS setting) fail validation.
+    """
+    attr_class = OptimizedImageFieldFile
+    default_validators = ImageField.default_validators + [validate_image_size]
+
+    def __init__(self, *args, deferred=False, lazy=False, variant_widths=None, variant_formats=None, max_dimension=None,
+                 convert_formats=None, min_ssim=None, quality=None, progressive=None, subsampling=None,
+                 compress_level=None, strip_metadata=None, effort=None, **kwargs):
+        self.deferred = deferred
+        self.lazy = lazy
+        self.encoder_options = {
+            'quality': quality,
+            'progressive': progressive,
+            'subsampling': subsampling,
+            'compress_level': compress_level,
+            'strip_metadata': strip_metadata,
+            'effort': effort,
+        }
+        self.max_dimension = max_dimension
+        self.convert_formats = convert_formats
+        self.min_ssim = min_ssim
+        self.variant_widths = variant_widths
+        self.variant_formats = [image_format.upper() for image_format in variant_formats or []]
+        super().__init__(*args, **kwargs)
+
+    def check(self, **kwargs):
+        return (
+            super().check(**kwargs) + self._check_variant_formats() + self._check_convert_formats() +
+            self._check_encoder_options() + self._check_lazy()
+        )
+
+    def _check_variant_formats(self):
+        from .variants import FORMAT_EXTENSIONS
+
+        Image.init()
+        errors = []
+        for image_format in self.variant_formats:
+            if image_format not in FORMAT_EXTENSIONS or image_format not in Image.SAVE:
+                errors.append(checks.Error(
+                    "Pillow cannot save images in the variant format '{}'.".format(image_format),
+                    obj=self,
+                    id='optimized_image.E001',
+                ))
+        return errors
+
+    def _check_convert_formats(self):
+        from .conversion import can_convert_to
+        from .utils import get_image_format
+
+        return [
+            checks.Error(
+                "Pillow cannot convert images to the format '{}'.".format(image_format),
+                obj=self,
+                id='optimized_image.E002',
+            )
+            for image_format in self.convert_formats or []
+            if not can_convert_to(get_image_format(image_format))
+        ]
+
+    def _check_encoder_options(self):
+        from .backends import EFFORTS
+
+        effort = self.encoder_options['effort']
+        if effort is not None and effort not in EFFORTS:
+            return [checks.Error(
+                "'effort' must be one of: {}.".format(', '.join(EFFORTS)),
+                obj=self,
+                id='optimized_image.E003',
+            )]
+        return []
+
+    def _check_lazy(self):
+        if self.lazy and self.deferred:
+            return [checks.Error(
+                "'lazy' and 'deferred' cannot both be True.",
+                hint='Lazy images are only optimized when they are requested, so there is nothing to defer.',
+                obj=self,
+                id='optimized_image.E004',
+            )]
+        return []
+
+    def get_variant_formats(self, name):
+        """Return the formats to save the variants of the image stored at name in."""
+        from .utils import get_image_format
+        from .variants import FORMAT_EXTENSIONS
+
+        if self.variant_formats:
+            return self.variant_formats
+        image_format = get_image_format(name.split('.')[-1])
+        # Images in formats that variants are not saved in (like BMP and
+        # TIFF) get PNG variants, which keep their quality and transparency
+        return [image_format if image_format in FORMAT_EXTENSIONS else 'PNG']
+
+    def get_optimization_options(self):
+        """Return the options to pass to the optimization backend for this field."""
+        options = {}
+        if self.max_dimension:
+            options['max_dimension'] = self.max_dimension
+        if self.convert_formats is not None:
+            # An empty list turns off the conversions of the settings
+            options['convert_formats'] = self.convert_formats
+        if self.min_ssim is not None:
+            options['min_ssim'] = self.min_ssim
+        options.update((key, value) for key, value in self.encoder_options.items() if value is not None)
+        return options
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.deferred:
+            kwargs['deferred'] = True
+        if self.lazy:
+            kwargs['lazy'] = True
+        if self.variant_widths:
+            kwargs['variant_widths'] = self.variant_widths
+        if self.variant_formats:
+            kwargs['variant_formats'] = self.variant_formats
+        if self.max_dimension:
+            kwargs['max_dimension'] = self.max_dimension
+        if self.convert_formats is not None:
+            kwargs['convert_formats'] = self.convert_formats
+        if self.min_ssim is not None:
+            kwargs['min_ssim'] = self.min_ssim
+        kwargs.update((key, value) for key, value in self.encoder_options.items() if value is not None)
+        return name, path, args, kwargs
+
     def save_form_data(self, instance, data):
         """Remove the OptimizedNotOptimized object on clearing the image."""
         # Are we updating an image?
         updating_image = True if data and getattr(instance, self.name) != data else False
 
-        if updating_image:
-            from .utils import optimize_from_buffer
-            data = optimize_from_buffer(data)
+        if updating_image and not self.lazy:
+            if self.deferred:
+                # Optimize the image after it has been saved instead
+                data.optimized_image_deferred = True
+            else:
+                # Optimize the image with the other images of the instance,
+                # just before it is saved (see pre_save()).
+                data.optimized_image_options = self.get_optimization_options()
         super().save_form_data(instance, data)
+
+    def pre_save(self, model_instance, add):
+        """
+        Record or queue the optimization of the file, once it has been saved to storage.
+
+        Images from save_form_data() are optimized here, before they are
+        saved: the first field of the instance to be saved optimizes the
+        images of all of them at once (see optimize_pending_uploads()).
+
+        The variants of a newly uploaded image are generated here too, unless
+        the optimization is deferred, in which case they are generated by
+        the job, from the optimized image, or the field is lazy, in which
+        case they are made when they are requested (and the derivatives of
+        any image that was stored under the same name are forgotten).
+        """
+        file = getattr(model_instance, self.attname)
+        record = None
+        deferred = False
+        uploaded = file and not file._committed
+        if uploaded:
+            if hasattr(file.file, 'optimized_image_options'):
+                optimize_pending_uploads(model_instance)
+            record = getattr(file.file, 'optimized_image_record', None)
+            deferred = getattr(file.file, 'optimized_image_deferred', False)
+        file = super().pre_save(model_instance, add)
+        if record is not None:
+            from .models import OptimizedImageRecord
+            OptimizedImageRecord.objects.filter(name=file.name).delete()
+            record.name = file.name
+            record.save()
+        if deferred:
+            # The row may not have been written yet (or even have a primary
+            # key), so the job is queued from post_save.
+            if not hasattr(model_instance, '_optimized_image_deferred'):
+                model_instance._optimized_image_deferred = {}
+            model_instance._optimized_image_deferred[self.name] = file.name
+        elif uploaded and self.lazy:
+            from .derivatives import delete_derivatives
+            delete_derivatives(file.name)
+        elif uploaded and self.variant_widths:
+            from .variants import generate_variants
+            generate_variants(file)
+        return file
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        if not cls._meta.abstract:
+            signals.post_save.connect(self.queue_deferred_optimization, sender=cls)
+
+    def queue_deferred_optimization(self, instance, **kwargs):
+        """Queue the optimization that pre_save() deferred, once the row has been written and committed."""
+        name = getattr(instance, '_optimized_image_deferred', {}).pop(self.name, None)
+        if name is not None:
+            transaction.on_commit(lambda: self.enqueue_optimization(instance, name))
+
+    def enqueue_optimization(self, model_instance, name):
+        from .queues import get_optimization_queue
+        get_optimization_queue().enqueue({
+            'model': model_instance._meta.label,
+            'object_pk': str(model_instance.pk),
+            'field_name': self.name,
+            'name': name,
+        })
+
+
+def optimize_pending_uploads(model_instance):
+    """
+    Optimize the images from save_form_data() in all OptimizedImageFields of model_instance together.
+
+    When a form changes several images of an instance, they are optimized at
+    the same time, and identical images only once (see
+    optimized_image.utils.optimize_buffers()), so saving the instance takes
+    about as long as optimizing its slowest image.
+    """
+    from .utils import optimize_buffers
+
+    pending = []
+    for field in model_instance._meta.concrete_fields:
+        if not isinstance(field, OptimizedImageField):
+            continue
+        file = getattr(model_instance, field.attname)
+        if file and not file._committed and hasattr(file.file, 'optimized_image_options'):
+            pending.append((field, file))
+    optimize_buffers([(file.file, file.file.optimized_image_options) for field, file in pending])
+    for field, file in pending:
+        del file.file.optimized_image_options
+        # The image may have been converted to another format, or scaled down
+        file.name = file.file.name
+        if hasattr(file, '_dimensions_cache'):
+            del file._dimensions_cache
+        field.update_dimension_fields(model_instance, force=True)
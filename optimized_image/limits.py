@@ -0,0 +1,163 @@
+import mmap
+import threading
+import warnings
+
+from PIL import Image
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+
+class ImageTooLarge(Exception):
+    """Raised for images that would take more memory to decode than the settings allow."""
+    def __init__(self, width=None, height=None, max_pixels=None):
+        self.width = width
+        self.height = height
+        self.max_pixels = max_pixels
+        if width is None:
+            message = 'The image is too large to be decoded safely.'
+        else:
+            message = 'The image is {}x{} pixels, but at most {} pixels may be decoded.'.format(
+                width, height, max_pixels
+            )
+        super().__init__(message)
+
+
+def get_bytes_per_pixel(mode):
+    """Return the number of bytes that Pillow uses for each pixel of an image in mode."""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    # Pillow pads images with 3 bands (like RGB) to 4 bytes per pixel too
+    return 4
+
+
+def get_max_pixels(mode):
+    """
+    Return the most pixels that an image in mode may have to be decoded, or None if there is no limit.
+
+    This is the smallest of the OPTIMIZED_IMAGE_MAX_PIXELS setting, and of
+    the number of pixels that fit in the OPTIMIZED_IMAGE_MAX_MEMORY setting
+    (in bytes).
+    """
+    limits = []
+    max_pixels = getattr(settings, 'OPTIMIZED_IMAGE_MAX_PIXELS', None)
+    if max_pixels:
+        limits.append(max_pixels)
+    max_memory = getattr(settings, 'OPTIMIZED_IMAGE_MAX_MEMORY', None)
+    if max_memory:
+        limits.append(max_memory // get_bytes_per_pixel(mode))
+    return min(limits) if limits else None
+
+
+def has_limits():
+    return bool(getattr(settings, 'OPTIMIZED_IMAGE_MAX_PIXELS', None) or
+                getattr(settings, 'OPTIMIZED_IMAGE_MAX_MEMORY', None))
+
+
+def open_header(file):
+    """
+    Return a Pillow image for file (bytes, a memory-mapped file, or a file object) without decoding it.
+
+    Raise ImageTooLarge if even Pillow's own decompression bomb check rejects it.
+    """
+    from .backends import open_file
+
+    if isinstance(file, (bytes, mmap.mmap)):
+        file = open_file(file)
+    file.seek(0)
+    with warnings.catch_warnings():
+        # The image is checked against our own limits instead
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        try:
+            return Image.open(file)
+        except Image.DecompressionBombError:
+            raise ImageTooLarge()
+
+
+def check_image_size(image):
+    """
+    Return the options to optimize image (opened, but not decoded) within the memory limits.
+
+    The limits are the OPTIMIZED_IMAGE_MAX_PIXELS and OPTIMIZED_IMAGE_MAX_MEMORY
+    settings, and only the size and mode from the image header are used. If
+    the image is too large, and the OPTIMIZED_IMAGE_OVERSIZED setting is
+    'downscale' (the default), a JPEG is scaled down while it is decoded
+    (with the ``max_dimension`` and ``max_pixels`` options), so that it fits.
+    Otherwise (for other formats, or if the setting is 'reject'), raise
+    ImageTooLarge.
+    """
+    from .backends import get_budget_scale
+
+    max_pixels = get_max_pixels(image.mode)
+    if max_pixels is None or image.width * image.height <= max_pixels:
+        return {}
+    if getattr(settings, 'OPTIMIZED_IMAGE_OVERSIZED', 'downscale') == 'downscale' and image.format == 'JPEG':
+        scale = get_budget_scale(image.size, max_pixels)
+        if scale is not None:
+            return {
+                'max_dimension': max(image.width // scale, image.height // scale),
+                'max_pixels': max_pixels,
+            }
+    raise ImageTooLarge(image.width, image.height, max_pixels)
+
+
+def validate_image_size(value):
+    """
+    Validate that a newly uploaded image can be optimized within the memory limits.
+
+    Files that are already in storage were checked when they were uploaded,
+    so they are not downloaded to be checked again.
+    """
+    if not value or getattr(value, '_committed', True) or not has_limits():
+        return
+    file = value.file
+    position = file.tell()
+    try:
+        check_image_size(open_header(file))
+    except ImageTooLarge as error:
+        if error.width is None:
+            raise ValidationError('This image is too large.', code='image_too_large')
+        raise ValidationError(
+            'This image is too large (%(width)s x %(height)s pixels). Images may have at most %(max_pixels)s pixels.',
+            code='image_too_large',
+            params={'width': error.width, 'height': error.height, 'max_pixels': error.max_pixels},
+        )
+    except (OSError, SyntaxError):
+        # Not an image; that is reported by the ImageField itself
+        pass
+    finally:
+        file.seek(position)
+
+
+class MemoryBudget:
+    """
+    Limit the memory used by images that are optimized at the same time.
+
+    Threads acquire() the number of bytes an image needs before optimizing
+    it, and wait while that would take the total over ``limit``. An image
+    that needs more than the whole budget waits until it can run alone.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.limit)
+        with self.condition:
+            self.condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def estimate_memory(image, content_size):
+    """Return the bytes needed to optimize image (opened, but not decoded), from its header."""
+    # The decoded image, a copy of it for the output, and the file itself
+    return image.width * image.height * get_bytes_per_pixel(image.mode) * 2 + content_size
@@ -0,0 +1,149 @@
+import datetime
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
+
+from optimized_image.bulk import BulkOptimizer
+from optimized_image.fields import OptimizedImageField
+
+
+def is_optimized_image_field(field):
+    return type(field) == OptimizedImageField
+
+
+def parse_shard(value):
+    """Return the (index, count) for a --shard value like '2/4', with a 0-based index."""
+    try:
+        number, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise CommandError("--shard must look like N/M, for example '2/4'.")
+    if not 1 <= number <= count:
+        raise CommandError('--shard N/M needs N to be between 1 and M.')
+    return number - 1, count
+
+
+class Command(BaseCommand):
+    help = (
+        'Optimize the images in the OptimizedImageFields of the given apps, models '
+        '(app_label.Model), or fields (app_label.Model.field), or of all models.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('selectors', nargs='*', metavar='app_label[.Model[.field]]')
+        parser.add_argument('--workers', type=int, help='The number of processes and threads to use.')
+        parser.add_argument('--chunk-size', type=int, help='The number of rows to load at a time.')
+        parser.add_argument(
+            '--checkpoint',
+            help=(
+                'Save the progress to this file, and resume from it. Use a separate file for each shard. '
+                'Defaults to the OPTIMIZED_IMAGE_BULK_CHECKPOINT setting, with the shard added to the file name.'
+            ),
+        )
+        parser.add_argument(
+            '--shard',
+            help=(
+                "Only optimize the N-th of M shards of the rows, by primary key hash (for example, '2/4'). "
+                'Each shard still reads every row, to find its own, so this splits the optimizing, not the scan.'
+            ),
+        )
+        parser.add_argument(
+            '--in-place', action='store_true', default=None,
+            help='Overwrite the original files instead of saving the optimized images as new files.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Count the images that would be optimized, without optimizing them.',
+        )
+        parser.add_argument(
+            '--progress', choices=['text', 'json'], default='text',
+            help='Report the progress as text, or as one JSON object per line.',
+        )
+
+    def handle(self, *args, **options):
+        fields = self.get_fields(options['selectors'])
+        if not fields:
+            raise CommandError('There are no OptimizedImageFields to optimize.')
+        self.progress_format = options['progress']
+        self.dry_run = options['dry_run']
+        progress = self.report_progress if options['verbosity'] >= 1 else None
+        BulkOptimizer(
+            workers=options['workers'],
+            checkpoint_path=options['checkpoint'],
+            chunk_size=options['chunk_size'],
+            shard=parse_shard(options['shard']) if options['shard'] else None,
+            dry_run=options['dry_run'],
+            progress=progress,
+            in_place=options['in_place'],
+        ).run(list(fields), fields=fields)
+
+    def get_fields(self, selectors):
+        """
+        Return a dictionary mapping each selected model to the names of its selected fields.
+
+        The names are None if all of the model's OptimizedImageFields are selected.
+        """
+        fields = {}
+        if not selectors:
+            selectors = [app_config.label for app_config in apps.get_app_configs()]
+        for selector in selectors:
+            parts = selector.split('.')
+            try:
+                if len(parts) == 1:
+                    models = apps.get_app_config(parts[0]).get_models()
+                elif len(parts) in (2, 3):
+                    models = [apps.get_model(parts[0], parts[1])]
+                else:
+                    raise CommandError("'{}' is not an app_label[.Model[.field]].".format(selector))
+            except LookupError as error:
+                raise CommandError(error)
+
+            for model in models:
+                if len(parts) == 3:
+                    field = next((field for field in model._meta.get_fields() if field.name == parts[2]), None)
+                    if field is None or not is_optimized_image_field(field):
+                        raise CommandError("'{}' is not an OptimizedImageField.".format(selector))
+                    if model not in fields:
+                        fields[model] = []
+                    if fields[model] is not None:
+                        fields[model].append(field.name)
+                elif any(is_optimized_image_field(field) for field in model._meta.get_fields()):
+                    fields[model] = None
+        return fields
+
+    def report_progress(self, stats):
+        if self.progress_format == 'json':
+            self.stdout.write(json.dumps(dict(stats.as_dict(), dry_run=self.dry_run)))
+            return
+
+        if stats.total_rows:
+            rows = '{}/{} rows ({:.0%})'.format(stats.rows, stats.total_rows, min(stats.rows / stats.total_rows, 1))
+        else:
+            rows = '{} rows'.format(stats.rows)
+        if self.dry_run:
+            self.stdout.write('{}: {}, would optimize {} images ({}), {} already optimized'.format(
+                stats.model._meta.label, rows, stats.optimized, self.format_size(stats.input_bytes), stats.skipped,
+            ))
+            return
+
+        eta = 'unknown' if stats.eta is None else str(datetime.timedelta(seconds=round(stats.eta)))
+        saved = self.format_size(stats.saved_bytes)
+        if stats.input_bytes:
+            saved += ' ({:.1%})'.format(stats.saved_bytes / stats.input_bytes)
+        self.stdout.write(
+            '{}: {}, {:.1f} images/s, ETA {}, {} optimized, {} unchanged, {} skipped, '
+            '{} failed, saved {}'.format(
+                stats.model._meta.label, rows, stats.rate, eta, stats.optimized, stats.unchanged,
+                stats.skipped, stats.failed, saved,
+            )
+        )
+        if stats.quota_exceeded:
+            self.stdout.write(
+                'The TinyPNG monthly limit was reached. Stopping; run this again '
+                'next month to optimize the rest of the images.'
+            )
+
+    def format_size(self, size):
+        # filesizeformat uses non-breaking spaces, which are meant for HTML
+        return filesizeformat(size).replace('\xa0', ' ')
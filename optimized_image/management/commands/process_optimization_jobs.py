@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from optimized_image.queues import DatabaseQueue, get_optimization_queue
+
+
+class Command(BaseCommand):
+    help = 'Optimize the images queued by OptimizedImageFields with deferred=True.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep waiting for new jobs instead of exiting when the queue is empty.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=5,
+            help='Seconds to wait between checks for new jobs when using --loop.',
+        )
+
+    def handle(self, *args, **options):
+        queue = get_optimization_queue()
+        if not isinstance(queue, DatabaseQueue):
+            raise CommandError('OPTIMIZED_IMAGE_QUEUE must use optimized_image.queues.DatabaseQueue.')
+        while True:
+            count = queue.process_jobs()
+            if options['verbosity'] >= 1 and count:
+                self.stdout.write('Processed {} jobs.'.format(count))
+            if not options['loop']:
+                break
+            if not count:
+                time.sleep(options['sleep'])
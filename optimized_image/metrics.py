@@ -0,0 +1,164 @@
+import socket
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .signals import optimization_failed, post_optimize
+
+
+class BaseMetrics:
+    """
+    The interface for exporting metrics about optimizations.
+
+    Subclasses must implement increment(), for counters, and observe(), for
+    histograms. Both take the metric ``name`` (without a prefix), a value,
+    and a dictionary of ``tags`` (for example, the backend name).
+    """
+    def increment(self, name, value=1, tags=None):
+        raise NotImplementedError
+
+    def observe(self, name, value, tags=None):
+        raise NotImplementedError
+
+
+class StatsDMetrics(BaseMetrics):
+    """
+    Send metrics to a StatsD server over UDP.
+
+    Plain StatsD has no tags, so the tag values are added to the metric name
+    (for example, ``optimized_image.optimizations.pillow.JPEG``), unless
+    ``dogstatsd`` is set, in which case they are sent as DogStatsD tags.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='optimized_image', dogstatsd=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def increment(self, name, value=1, tags=None):
+        self.send(name, value, 'c', tags)
+
+    def observe(self, name, value, tags=None):
+        self.send(name, value, 'h', tags)
+
+    def send(self, name, value, metric_type, tags=None):
+        tags = tags or {}
+        name = '{}.{}'.format(self.prefix, name) if self.prefix else name
+        if self.dogstatsd:
+            line = '{}:{}|{}'.format(name, value, metric_type)
+            if tags:
+                line += '|#' + ','.join('{}:{}'.format(key, tags[key]) for key in sorted(tags))
+        else:
+            line = '{}:{}|{}'.format('.'.join([name] + [str(tags[key]) for key in sorted(tags)]), value, metric_type)
+        try:
+            self.socket.sendto(line.encode(), self.address)
+        except OSError:
+            # Metrics must never break the optimization itself
+            pass
+
+
+class PrometheusMetrics(BaseMetrics):
+    """
+    Record metrics with prometheus_client, to be exposed by its exporter.
+
+    Counters and histograms are created the first time they are used, with
+    the tags as labels, in the ``registry`` (by default, prometheus_client's
+    default registry).
+    """
+    # Histogram buckets for sizes in bytes: 1 KB to 256 MB
+    BYTES_BUCKETS = [1024 * 4 ** i for i in range(10)]
+
+    def __init__(self, namespace='optimized_image', registry=None):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImproperlyConfigured('PrometheusMetrics needs the prometheus_client package.')
+        self.prometheus_client = prometheus_client
+        self.namespace = namespace
+        self.registry = registry or prometheus_client.REGISTRY
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_metric(self, metric_class, name, tags, **kwargs):
+        # Images are optimized in several threads, and a metric that two of
+        # them created at once would be registered twice, which fails.
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(
+                    name, name.replace('_', ' ').capitalize(), sorted(tags),
+                    namespace=self.namespace, registry=self.registry, **kwargs
+                )
+            metric = self.metrics[name]
+        return metric.labels(**tags) if tags else metric
+
+    def increment(self, name, value=1, tags=None):
+        self.get_metric(self.prometheus_client.Counter, name, tags or {}).inc(value)
+
+    def observe(self, name, value, tags=None):
+        kwargs = {}
+        if name.endswith('_bytes'):
+            kwargs['buckets'] = self.BYTES_BUCKETS
+        self.get_metric(self.prometheus_client.Histogram, name, tags or {}, **kwargs).observe(value)
+
+
+_metrics = None
+
+
+def get_metrics():
+    """
+    Return the metrics adapter from the OPTIMIZED_IMAGE_METRICS setting, or None if it is not set.
+
+    The setting is a dictionary like the OPTIMIZED_IMAGE_CACHE setting, for example::
+
+        OPTIMIZED_IMAGE_METRICS = {
+            'BACKEND': 'optimized_image.metrics.StatsDMetrics',
+            'OPTIONS': {'host': 'statsd.example.com'},
+        }
+    """
+    global _metrics
+    if _metrics is None:
+        metrics_settings = getattr(settings, 'OPTIMIZED_IMAGE_METRICS', None)
+        if not metrics_settings:
+            return None
+        backend = import_string(metrics_settings['BACKEND'])
+        _metrics = backend(**metrics_settings.get('OPTIONS', {}))
+    return _metrics
+
+
+@receiver(setting_changed)
+def reset_metrics(setting, **kwargs):
+    global _metrics
+    if setting == 'OPTIMIZED_IMAGE_METRICS':
+        _metrics = None
+
+
+@receiver(post_optimize)
+def record_optimization(backend, image_format, result, **kwargs):
+    metrics = get_metrics()
+    if metrics is None:
+        return
+    tags = {'backend': backend.name, 'format': image_format}
+    stats = result.stats
+    metrics.increment('optimizations', tags=dict(tags, cached=bool(stats.get('cached'))))
+    if not stats.get('cached'):
+        metrics.observe('duration_seconds', stats['duration'], tags=tags)
+    metrics.observe('input_bytes', stats['input_size'], tags=tags)
+    metrics.observe('output_bytes', stats['output_size'], tags=tags)
+    if stats['output_size'] < stats['input_size']:
+        metrics.increment('saved_bytes', stats['input_size'] - stats['output_size'], tags=tags)
+
+
+@receiver(optimization_failed)
+def record_failure(backend, image_format, exception, **kwargs):
+    metrics = get_metrics()
+    if metrics is None:
+        return
+    metrics.increment('failures', tags={
+        'backend': backend.name,
+        'format': image_format,
+        'error': exception.__class__.__name__,
+    })
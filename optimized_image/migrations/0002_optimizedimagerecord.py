@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('optimized_image', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OptimizedImageRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('method', models.CharField(max_length=50)),
+                ('original_hash', models.CharField(blank=True, max_length=64)),
+                ('optimized_hash', models.CharField(max_length=64)),
+                ('original_size', models.PositiveIntegerField(null=True)),
+                ('optimized_size', models.PositiveIntegerField()),
+                ('optimized_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('optimized_image', '0003_optimizationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageDerivative',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('options_key', models.CharField(max_length=64)),
+                ('source_hash', models.CharField(max_length=64)),
+                ('derivative_name', models.CharField(max_length=255)),
+                ('image_format', models.CharField(max_length=10)),
+                ('size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('name', 'options_key')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('optimized_image', '0004_imagederivative'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='optimizedimagerecord',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
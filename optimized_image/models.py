@@ -1 +1,91 @@
-# Put any models here
+from django.db import models
+
+
+class CachedOptimization(models.Model):
+    """An optimized image stored by the optimized_image.cache.DatabaseCache."""
+    key = models.CharField(max_length=64, primary_key=True)
+    content = models.BinaryField()
+    size = models.PositiveIntegerField()
+    last_used = models.DateTimeField(db_index=True)
+
+
+class OptimizedImageRecord(models.Model):
+    """
+    A record that the file stored at ``name`` has been optimized.
+
+    The hash of the optimized file is kept, so that a file that has not
+    changed since it was optimized is not optimized again. In storages with
+    ETags, its ETag is kept too, so that the file does not even need to be
+    downloaded to tell.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    method = models.CharField(max_length=50)
+    original_hash = models.CharField(max_length=64, blank=True)
+    optimized_hash = models.CharField(max_length=64)
+    original_size = models.PositiveIntegerField(null=True)
+    optimized_size = models.PositiveIntegerField()
+    optimized_at = models.DateTimeField(auto_now=True)
+    # The ETag of the optimized file, in storages that have them (see
+    # optimized_image.transfer.get_fingerprint())
+    etag = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class OptimizationJob(models.Model):
+    """An image waiting to be optimized by the optimized_image.queues.DatabaseQueue."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    )
+
+    model = models.CharField(max_length=255)
+    object_pk = models.CharField(max_length=255)
+    field_name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When a worker started running the job
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('created_at', 'pk')
+
+    def __str__(self):
+        return '{} {} {}'.format(self.model, self.object_pk, self.field_name)
+
+
+class ImageDerivative(models.Model):
+    """
+    An optimized copy (or resized variant) of the image stored at ``name``, made the first time it was requested.
+
+    ``options_key`` is a hash of the settings that the derivative was made
+    with, and ``derivative_name`` is where it is stored, in the same storage
+    as the image (or the image's own name, if optimizing could not make it
+    any smaller).
+    """
+    name = models.CharField(max_length=255)
+    options_key = models.CharField(max_length=64)
+    source_hash = models.CharField(max_length=64)
+    derivative_name = models.CharField(max_length=255)
+    image_format = models.CharField(max_length=10)
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('name', 'options_key')
+
+    def __str__(self):
+        return self.derivative_name
+
+    @property
+    def etag(self):
+        """A strong ETag, which only changes if the image or the settings do."""
+        return '"{}-{}"'.format(self.source_hash[:32], self.options_key[:16])
@@ -0,0 +1,219 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import hashlib
+import logging
+import os
+import traceback
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_optimization_job(job):
+    """
+    Optimize an image that was saved to an OptimizedImageField without being optimized.
+
+    The ``job`` is a dictionary with the ``model`` label, the ``object_pk``,
+    the ``field_name``, and the ``name`` of the file that was saved. The
+    optimized image replaces the original file, unless the field was changed
+    to a different file in the meantime. Return True if the image was replaced.
+    """
+    from .limits import ImageTooLarge
+    from .models import OptimizedImageRecord
+    from .utils import get_optimized_name, open_content, optimize_content
+
+    model = apps.get_model(job['model'])
+    field = model._meta.get_field(job['field_name'])
+    # ImageField reads the dimension fields when the row is loaded, so they
+    # are loaded with it, instead of with a query each
+    dimension_field_names = [name for name in (field.width_field, field.height_field) if name]
+    model_instance = model._default_manager.filter(
+        pk=job['object_pk'], **{field.attname: job['name']}
+    ).only(field.attname, *dimension_field_names).first()
+    if model_instance is None:
+        # The row was deleted, or the image was changed since the job was queued
+        return False
+
+    image_file = getattr(model_instance, field.attname)
+    image_file_extension = image_file.name.split('.')[-1]
+    with open_content(image_file) as content:
+        original_hash = hashlib.sha256(content).hexdigest()
+        try:
+            result = optimize_content(
+                content, image_file_extension, name=image_file.name, **field.get_optimization_options()
+            )
+        except ImageTooLarge:
+            # Keep the original, since it cannot be optimized within the memory limits
+            result = None
+        unchanged = result is None or result.content is content
+    image_file.close()
+    if unchanged:
+        if field.variant_widths:
+            from .variants import generate_variants
+            generate_variants(image_file)
+        return False
+
+    image_name = os.path.relpath(get_optimized_name(image_file.name, result), field.upload_to)
+    image_file.save(image_name, ContentFile(result.content), save=False)
+    values = {field.attname: image_file.name}
+    if field.width_field or field.height_field:
+        # The image may have been scaled down
+        field.update_dimension_fields(model_instance, force=True)
+        values.update((name, getattr(model_instance, name)) for name in dimension_field_names)
+    # Only point the row at the optimized file if it still has the original,
+    # so that an image uploaded while this job ran is not overwritten.
+    updated = model._default_manager.filter(
+        pk=job['object_pk'], **{field.attname: job['name']}
+    ).update(**values)
+    if not updated:
+        image_file.storage.delete(image_file.name)
+        return False
+
+    image_file.storage.delete(job['name'])
+    if field.variant_widths:
+        from .variants import generate_variants
+        generate_variants(image_file)
+    OptimizedImageRecord.objects.filter(name=image_file.name).delete()
+    OptimizedImageRecord.objects.create(
+        name=image_file.name,
+        method=result.stats['backend'],
+        original_hash=original_hash,
+        optimized_hash=hashlib.sha256(result.content).hexdigest(),
+        original_size=result.stats['input_size'],
+        optimized_size=result.stats['output_size'],
+    )
+    return True
+
+
+class BaseQueue:
+    """
+    The interface for queues of deferred optimization jobs.
+
+    Subclasses must implement enqueue(), which is called after the transaction
+    that saved the original image is committed.
+    """
+    def enqueue(self, job):
+        raise NotImplementedError
+
+
+class ThreadPoolQueue(BaseQueue):
+    """Run jobs in a pool of ``max_workers`` threads in the web process."""
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def enqueue(self, job):
+        self.executor.submit(self.run, job)
+
+    def run(self, job):
+        try:
+            run_optimization_job(job)
+        except Exception:
+            # Nothing waits for the job's future, so this is the only place
+            # that the error can be reported.
+            logger.exception('Optimization failed for %s.', job['name'])
+        finally:
+            # This thread is not part of a request, so close its database
+            # connection the way the request_finished signal would.
+            close_old_connections()
+
+
+class DatabaseQueue(BaseQueue):
+    """
+    Store jobs in the OptimizationJob table.
+
+    The jobs are run by the ``process_optimization_jobs`` management command,
+    or by calling process_jobs(). A job that is still running ``timeout``
+    seconds after a worker claimed it is assumed to have been abandoned (for
+    example, because the worker was killed), and is run again.
+    """
+    def __init__(self, max_attempts=3, timeout=600):
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+    def enqueue(self, job):
+        from .models import OptimizationJob
+
+        OptimizationJob.objects.create(**job)
+
+    def reclaim_jobs(self):
+        """Make the jobs whose workers have timed out pending again, or failed if they have no attempts left."""
+        from .models import OptimizationJob
+
+        stale_jobs = OptimizationJob.objects.filter(
+            status=OptimizationJob.RUNNING,
+            claimed_at__lt=timezone.now() - timedelta(seconds=self.timeout),
+        )
+        error = 'The job did not finish within {} seconds.'.format(self.timeout)
+        stale_jobs.filter(attempts__gte=self.max_attempts).update(status=OptimizationJob.FAILED, error=error)
+        stale_jobs.update(status=OptimizationJob.PENDING, error=error)
+
+    def process_jobs(self, limit=100):
+        """Run pending jobs, and return the number of jobs that were run."""
+        from .models import OptimizationJob
+
+        self.reclaim_jobs()
+        count = 0
+        for job in OptimizationJob.objects.filter(status=OptimizationJob.PENDING)[:limit]:
+            # Claim the job, so that other workers skip it
+            claimed = OptimizationJob.objects.filter(
+                pk=job.pk, status=OptimizationJob.PENDING
+            ).update(
+                status=OptimizationJob.RUNNING, attempts=job.attempts + 1, claimed_at=timezone.now()
+            )
+            if not claimed:
+                continue
+            count += 1
+            try:
+                run_optimization_job({
+                    'model': job.model,
+                    'object_pk': job.object_pk,
+                    'field_name': job.field_name,
+                    'name': job.name,
+                })
+            except Exception:
+                if job.attempts + 1 >= self.max_attempts:
+                    status = OptimizationJob.FAILED
+                else:
+                    status = OptimizationJob.PENDING
+                OptimizationJob.objects.filter(pk=job.pk).update(
+                    status=status, error=traceback.format_exc()
+                )
+            else:
+                OptimizationJob.objects.filter(pk=job.pk).delete()
+        return count
+
+
+_queue = None
+
+
+def get_optimization_queue():
+    """
+    Return the queue from the OPTIMIZED_IMAGE_QUEUE setting.
+
+    The setting is a dictionary like the OPTIMIZED_IMAGE_CACHE setting, and
+    defaults to a ThreadPoolQueue.
+    """
+    global _queue
+    if _queue is None:
+        queue_settings = getattr(settings, 'OPTIMIZED_IMAGE_QUEUE', None) or {
+            'BACKEND': 'optimized_image.queues.ThreadPoolQueue',
+        }
+        backend = import_string(queue_settings['BACKEND'])
+        _queue = backend(**queue_settings.get('OPTIONS', {}))
+    return _queue
+
+
+@receiver(setting_changed)
+def reset_optimization_queue(setting, **kwargs):
+    global _queue
+    if setting == 'OPTIMIZED_IMAGE_QUEUE':
+        _queue = None
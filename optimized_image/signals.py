@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+
+# Sent by optimize_content() before an image is optimized, with the
+# ``backend``, the ``name`` of the file (if known), the ``image_format``, and
+# the ``input_size`` in bytes. The sender is the backend class.
+pre_optimize = Signal()
+
+# Sent by optimize_content() after an image was optimized (or found in the
+# cache), with the same arguments as pre_optimize, and the
+# OptimizationResult as ``result``.
+post_optimize = Signal()
+
+# Sent by optimize_content() when the backend raised an exception, with the
+# same arguments as pre_optimize, and the ``exception``. The exception is
+# raised again after the signal is sent.
+optimization_failed = Signal()
@@ -0,0 +1,98 @@
+from io import BytesIO
+from unittest.mock import patch
+
+from PIL import Image, ImageDraw
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from ..animation import compress_animation, iter_frames, save_gif
+from ..backends import PillowBackend
+from ..utils import optimize_from_buffer
+
+
+def make_animation(frame_count=10, size=(120, 80), image_format='GIF'):
+    """Return the bytes of an animation of a ball moving over a background that is sometimes transparent."""
+    frames = []
+    for index in range(frame_count):
+        background = (255, 255, 255, 0) if index % 4 == 3 else (255, 255, 255, 255)
+        frame = Image.new('RGBA', size, background)
+        draw = ImageDraw.Draw(frame)
+        draw.ellipse((index * 8, 20, index * 8 + 30, 50), fill=(200, 30, 30, 255))
+        draw.rectangle((0, 0, 30, 10), fill=(0, 0, 200, 255))
+        frames.append(frame)
+    output_file = BytesIO()
+    frames[0].save(
+        output_file, format=image_format, save_all=True, append_images=frames[1:],
+        duration=100, loop=0, disposal=2,
+    )
+    return output_file.getvalue()
+
+
+def get_frames(content):
+    """Return a list of (RGBA bytes, duration) for each frame in content, with transparent pixels made equal."""
+    image = Image.open(BytesIO(content))
+    frames = []
+    for index in range(image.n_frames):
+        image.seek(index)
+        frame = image.convert('RGBA')
+        transparent = Image.new('RGBA', frame.size)
+        frames.append((Image.composite(frame, transparent, frame.getchannel('A')).tobytes(), image.info['duration']))
+    return frames
+
+
+class TestAnimation(SimpleTestCase):
+    """Test case for optimizing animated images."""
+
+    def test_gif(self):
+        """All frames are kept, with only the changes between them stored."""
+        content = make_animation()
+        optimized_content = PillowBackend().compress(content, 'GIF')
+
+        self.assertLess(len(optimized_content), len(content))
+        self.assertEqual(get_frames(optimized_content), get_frames(content))
+        self.assertEqual(Image.open(BytesIO(optimized_content)).info['loop'], 0)
+
+        # An identical frame just makes the one before it last longer
+        image = Image.open(BytesIO(content))
+        frames = list(iter_frames(image))
+        output_file = BytesIO()
+        save_gif(frames + [frames[-1]], output_file)
+        optimized_frames = get_frames(output_file.getvalue())
+        self.assertEqual(len(optimized_frames), len(frames))
+        self.assertEqual(optimized_frames[-1][1], frames[-1][1] * 2)
+
+    def test_webp(self):
+        content = make_animation(image_format='WEBP')
+        optimized = Image.open(BytesIO(PillowBackend().compress(content, 'WEBP')))
+        self.assertEqual((optimized.format, optimized.n_frames), ('WEBP', 10))
+
+    def test_convert_to_webp(self):
+        """GIFs are converted to lossless animated WebPs."""
+        content = make_animation()
+        optimized_content = PillowBackend(animated_format='WEBP').compress(content, 'GIF')
+        self.assertEqual(Image.open(BytesIO(optimized_content)).format, 'WEBP')
+        self.assertEqual(
+            [frame for frame, duration in get_frames(optimized_content)],
+            [frame for frame, duration in get_frames(content)],
+        )
+
+    def test_max_dimension(self):
+        """All of the frames are scaled down."""
+        content = make_animation()
+        optimized_content = PillowBackend().optimize(content, 'GIF', max_dimension=60).content
+        optimized = Image.open(BytesIO(optimized_content))
+        self.assertEqual((optimized.size, optimized.n_frames), ((60, 40), 10))
+
+        optimized = Image.open(BytesIO(compress_animation(Image.open(BytesIO(content)), 'GIF', (60, 40), 'WEBP')))
+        self.assertEqual((optimized.format, optimized.size, optimized.n_frames), ('WEBP', (60, 40), 10))
+
+
+class TestConvertedName(TestCase):
+    @override_settings(OPTIMIZED_IMAGE_BACKENDS=[{'BACKEND': 'pillow', 'OPTIONS': {'animated_format': 'WEBP'}}])
+    @patch('optimized_image.utils.is_testing_mode', return_value=False)
+    def test_optimize_from_buffer(self, mock_is_testing_mode):
+        """An upload that is converted to another format gets the extension of that format."""
+        data = optimize_from_buffer(SimpleUploadedFile(name='dancing.gif', content=make_animation()))
+        self.assertEqual(data.name, 'dancing.webp')
+        self.assertEqual(Image.open(data).format, 'WEBP')
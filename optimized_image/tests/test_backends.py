@@ -0,0 +1,170 @@
+from io import BytesIO
+import subprocess
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.test import SimpleTestCase, override_settings
+
+from ..backends import (
+    BACKENDS, BaseBackend, ChainedBackend, MozJPEGBackend, PillowBackend, PngquantBackend, SubprocessBackend,
+    TinyPNGBackend, get_backend, register_backend,
+)
+
+
+class ReverseBackend(BaseBackend):
+    """A backend that "optimizes" an image by reversing its bytes."""
+    name = 'reverse'
+
+    def compress(self, content, image_format, **options):
+        return content[::-1]
+
+
+def make_image(size, image_format='JPEG'):
+    """Return the bytes of a new image of the given size."""
+    output_file = BytesIO()
+    Image.linear_gradient('L').resize(size).convert('RGB').save(output_file, format=image_format)
+    return output_file.getvalue()
+
+
+class TestGetBackend(SimpleTestCase):
+    """Test case for get_backend()."""
+
+    def test_method(self):
+        """Without OPTIMIZED_IMAGE_BACKENDS, the backend is the one named by OPTIMIZED_IMAGE_METHOD."""
+        with self.settings(OPTIMIZED_IMAGE_METHOD='pillow'):
+            self.assertIsInstance(get_backend(), PillowBackend)
+            # The backend is only loaded once
+            self.assertIs(get_backend(), get_backend())
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng'):
+            self.assertIsInstance(get_backend(), TinyPNGBackend)
+        with self.settings(OPTIMIZED_IMAGE_METHOD='other'):
+            self.assertIsNone(get_backend())
+
+    @override_settings(OPTIMIZED_IMAGE_BACKENDS=[
+        {'BACKEND': 'pillow'},
+        {'BACKEND': 'optimized_image.tests.test_backends.ReverseBackend', 'MIN_SIZE': 10},
+    ])
+    def test_chained(self):
+        backend = get_backend()
+        self.assertIsInstance(backend, ChainedBackend)
+        self.assertEqual(backend.name, 'pillow+reverse')
+        self.assertEqual([min_size for step, min_size in backend.steps], [None, 10])
+
+    def test_register_backend(self):
+        register_backend('reverse', ReverseBackend)
+        self.addCleanup(BACKENDS.pop, 'reverse')
+        with self.settings(OPTIMIZED_IMAGE_METHOD='reverse'):
+            self.assertIsInstance(get_backend(), ReverseBackend)
+
+
+class TestChainedBackend(SimpleTestCase):
+    def test_min_size(self):
+        """Steps are skipped for images smaller than their min_size."""
+        backend = ChainedBackend([(ReverseBackend(), None), (ReverseBackend(), 5)])
+
+        result = backend.optimize(b'abcdef', 'PNG')
+        self.assertEqual(result.content, b'abcdef')
+        self.assertEqual(result.stats['backend'], 'reverse+reverse')
+        self.assertEqual(result.stats['input_size'], 6)
+
+        result = backend.optimize(b'abc', 'PNG')
+        self.assertEqual(result.content, b'cba')
+
+
+class TestMaxDimension(SimpleTestCase):
+    """Test case for the max_dimension option."""
+
+    def test_pillow(self):
+        """Pillow scales large images down while decoding them, keeping the aspect ratio."""
+        content = make_image((2000, 1000))
+        with patch.object(Image.Image, 'resize', autospec=True, side_effect=Image.Image.resize) as mock_resize:
+            result = PillowBackend().optimize(content, 'JPEG', max_dimension=400)
+
+        self.assertEqual(Image.open(BytesIO(result.content)).size, (400, 200))
+        self.assertEqual(result.stats['input_size'], len(content))
+        # The JPEG was decoded at 1/2 of its size (the smallest that is at
+        # least twice the final size) before it was resampled.
+        self.assertEqual(mock_resize.call_args[0][0].size, (1000, 500))
+
+    def test_small_image(self):
+        """Images that already fit are not resized."""
+        content = make_image((300, 200), 'PNG')
+        result = PillowBackend().optimize(content, 'PNG', max_dimension=400)
+        self.assertEqual(Image.open(BytesIO(result.content)).size, (300, 200))
+
+        backend = SubprocessBackend(command=['cat'], formats=['PNG'])
+        self.assertEqual(backend.optimize(content, 'PNG', max_dimension=400).content, content)
+
+    def test_backend_that_does_not_resize(self):
+        """Images are scaled down with Pillow before being passed to other backends."""
+        backend = SubprocessBackend(command=['cat'], formats=['JPEG'])
+        result = backend.optimize(make_image((1000, 2000)), 'JPEG', max_dimension=500)
+        self.assertEqual(Image.open(BytesIO(result.content)).size, (250, 500))
+
+
+class TestSubprocessBackend(SimpleTestCase):
+    def test_compress(self):
+        """The image is piped through the command, if it is in one of the formats."""
+        backend = SubprocessBackend(command=['tr', 'a-z', 'A-Z'], formats=['PNG'])
+        self.assertEqual(backend.name, 'tr')
+        self.assertEqual(backend.optimize(b'image', 'PNG').content, b'IMAGE')
+        self.assertEqual(backend.optimize(b'image', 'JPEG').content, b'image')
+
+    def test_unchanged_returncodes(self):
+        backend = SubprocessBackend(
+            command=['sh', '-c', 'exit 98'], formats=['PNG'], unchanged_returncodes=[98]
+        )
+        self.assertEqual(backend.optimize(b'image', 'PNG').content, b'image')
+
+        backend = SubprocessBackend(command=['sh', '-c', 'exit 1'], formats=['PNG'])
+        with self.assertRaises(subprocess.CalledProcessError):
+            backend.optimize(b'image', 'PNG')
+
+
+class TestEncoderOptions(SimpleTestCase):
+    """Test case for the quality, effort, and other encoder options."""
+
+    def test_pillow(self):
+        image = Image.linear_gradient('L').resize((400, 300)).convert('RGB')
+        exif = image.getexif()
+        # Rotated 90 degrees
+        exif[0x0112] = 6
+        output_file = BytesIO()
+        image.save(output_file, format='JPEG', quality=95, exif=exif)
+        content = output_file.getvalue()
+
+        backend = PillowBackend()
+        low_quality = backend.compress(content, 'JPEG', quality=30)
+        self.assertLess(len(low_quality), len(backend.compress(content, 'JPEG')))
+
+        kept = Image.open(BytesIO(backend.compress(content, 'JPEG', strip_metadata=False, progressive=True)))
+        self.assertEqual(kept.getexif()[0x0112], 6)
+        self.assertTrue(kept.info.get('progressive'))
+        # The orientation is applied to the pixels before it is stripped
+        stripped = Image.open(BytesIO(backend.compress(content, 'JPEG', strip_metadata=True)))
+        self.assertEqual((dict(stripped.getexif()), stripped.size), ({}, (300, 400)))
+
+        png = make_image((400, 300), 'PNG')
+        self.assertGreater(
+            len(backend.compress(png, 'PNG', effort='low')), len(backend.compress(png, 'PNG', effort='high'))
+        )
+
+    def test_subprocess_commands(self):
+        self.assertEqual(
+            MozJPEGBackend().get_command('JPEG', strip_metadata=False, progressive=False),
+            ['jpegtran', '-copy', 'all', '-optimize'],
+        )
+        self.assertEqual(
+            PngquantBackend().get_command('PNG', quality=80, effort='low'),
+            ['pngquant', '--skip-if-larger', '--quality', '55-80', '--speed', '10', '-'],
+        )
+
+
+class TestTinyPNGBackend(SimpleTestCase):
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_compress(self, mock_get_tinypng_client):
+        mock_get_tinypng_client.return_value.compress.return_value = b'small'
+        result = TinyPNGBackend().optimize(b'large image', 'PNG')
+        self.assertEqual(result.content, b'small')
+        self.assertEqual(result.stats['output_size'], 5)
@@ -0,0 +1,438 @@
+import asyncio
+import hashlib
+from io import BytesIO, StringIO
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import DEFAULT, patch
+import uuid
+
+from PIL import Image
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from . import factories
+from ..bulk import BulkOptimizer, Checkpoint, overwrite_field_file
+from ..models import OptimizedImageRecord
+from ..tinypng import QuotaExceeded
+from not_optimized.models import GenericModel, ImageWithDimensions
+
+
+class TestBulkOptimizer(TestCase):
+    """Test case for the BulkOptimizer."""
+
+    def setUp(self):
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        self.checkpoint_path = os.path.join(checkpoint_dir.name, 'checkpoint.json')
+
+    @patch('optimized_image.backends.Image')
+    def test_resumes_from_checkpoint(self, mock_pil_image):
+        """Rows up to the primary key in the checkpoint file are not optimized again."""
+        with self.settings(OPTIMIZED_IMAGE_METHOD='pillow', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blog1 = factories.BlogPostOrSomethingFactory(title='Blog 1')
+            blog2 = factories.BlogPostOrSomethingFactory(title='Blog 2')
+            # Pretend that a previous run was interrupted after optimizing blog1
+            with open(self.checkpoint_path, 'w') as checkpoint_file:
+                json.dump({'not_optimized.BlogPostOrSomething': blog1.pk}, checkpoint_file)
+            # Record what is passed to PIL.Image.open(), since the memory-mapped
+            # input files are closed once the images have been optimized.
+            opened_contents = []
+            mock_pil_image.open.side_effect = lambda fp: opened_contents.append(fp.read()) or DEFAULT
+
+            BulkOptimizer(checkpoint_path=self.checkpoint_path).run([blog1.__class__])
+
+            # Only the 2 images of blog2 were optimized
+            self.assertEqual(mock_pil_image.open.call_count, 2)
+            expected_contents = [blog2.image1.read(), blog2.image2.read()]
+            self.assertEqual(
+                opened_contents,
+                expected_contents
+            )
+            # The checkpoint now points to the last row
+            with open(self.checkpoint_path) as checkpoint_file:
+                self.assertEqual(
+                    json.load(checkpoint_file),
+                    {'not_optimized.BlogPostOrSomething': blog2.pk}
+                )
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_several_workers(self, mock_tinypng):
+        """With several workers, every image is still optimized and saved."""
+        mock_tinypng.return_value.compress.return_value = b"optimized"
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blogs = [factories.BlogPostOrSomethingFactory() for i in range(3)]
+
+            BulkOptimizer(workers=4).run([blogs[0].__class__])
+
+            self.assertEqual(mock_tinypng.return_value.compress.call_count, 6)
+            for blog in blogs:
+                blog.refresh_from_db()
+                self.assertEqual(blog.image1.read(), b"optimized")
+                self.assertEqual(blog.image2.read(), b"optimized")
+
+    @patch('optimized_image.backends.Image')
+    def test_chunked_iteration(self, mock_pil_image):
+        """Rows are loaded in chunks of chunk_size, with only the image columns."""
+        with self.settings(OPTIMIZED_IMAGE_METHOD='pillow', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blogs = [factories.BlogPostOrSomethingFactory() for i in range(3)]
+            optimizer = BulkOptimizer(chunk_size=2)
+
+            with patch.object(optimizer, 'optimize_batch', wraps=optimizer.optimize_batch) as mock_batch:
+                optimizer.run([blogs[0].__class__])
+
+            chunks = [call[0][1] for call in mock_batch.call_args_list]
+            self.assertEqual(
+                [[instance.pk for instance in chunk] for chunk in chunks],
+                [[blogs[0].pk, blogs[1].pk], [blogs[2].pk]]
+            )
+            # Columns other than the image fields were not loaded
+            self.assertIn('title', chunks[0][0].get_deferred_fields())
+            self.assertNotIn('image1', chunks[0][0].get_deferred_fields())
+            self.assertEqual(mock_pil_image.open.call_count, 6)
+
+    def test_skips_already_optimized_images(self):
+        """Images that have not changed since they were optimized are not optimized again."""
+        with self.settings(OPTIMIZED_IMAGE_METHOD='pillow', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blog1 = factories.BlogPostOrSomethingFactory()
+            BulkOptimizer().run([blog1.__class__])
+            blog1.refresh_from_db()
+            record = OptimizedImageRecord.objects.get(name=blog1.image1.name)
+            self.assertEqual(record.method, 'pillow')
+            self.assertEqual(record.optimized_size, blog1.image1.size)
+            self.assertEqual(OptimizedImageRecord.objects.count(), 2)
+
+            # A new row is added before the next run
+            blog2 = factories.BlogPostOrSomethingFactory()
+            with patch('optimized_image.backends.Image') as mock_pil_image:
+                # Record what is passed to PIL.Image.open(), since the memory-mapped
+                # input files are closed once the images have been optimized.
+                opened_contents = []
+                mock_pil_image.open.side_effect = lambda fp: opened_contents.append(fp.read()) or DEFAULT
+                BulkOptimizer().run([blog1.__class__])
+
+            # Only the images of the new row were optimized
+            self.assertEqual(mock_pil_image.open.call_count, 2)
+            self.assertEqual(
+                opened_contents,
+                [blog2.image1.read(), blog2.image2.read()]
+            )
+
+    def test_checkpoint_uuid(self):
+        """Primary keys that are not numbers, like UUIDs, are saved as strings."""
+        pk = uuid.uuid4()
+        Checkpoint(self.checkpoint_path).set(GenericModel, pk)
+
+        self.assertEqual(Checkpoint(self.checkpoint_path).get(GenericModel), str(pk))
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_stops_when_quota_exceeded(self, mock_tinypng):
+        """When the TinyPNG monthly limit is reached, the run stops without skipping rows."""
+        mock_tinypng.return_value.compress.side_effect = [b"optimized", QuotaExceeded, QuotaExceeded]
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blog1 = factories.BlogPostOrSomethingFactory()
+            factories.BlogPostOrSomethingFactory()
+
+            with self.assertLogs('optimized_image.bulk', 'WARNING') as logs:
+                BulkOptimizer(checkpoint_path=self.checkpoint_path, chunk_size=1).run([blog1.__class__])
+
+            self.assertIn('The TinyPNG monthly limit was reached.', logs.output[-1])
+            self.assertEqual(mock_tinypng.return_value.compress.call_count, 2)
+            # The image that was optimized was saved
+            blog1.refresh_from_db()
+            self.assertEqual(blog1.image1.read(), b"optimized")
+            # The interrupted row is not marked as done
+            self.assertFalse(os.path.exists(self.checkpoint_path))
+
+
+    def test_dimension_fields(self):
+        """The width_field and height_field of images that were scaled down are updated, in place or not."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        bytes_io = BytesIO()
+        Image.new('RGB', (800, 400), 'red').save(bytes_io, format='PNG')
+        with self.settings(MEDIA_ROOT=media_root, OPTIMIZED_IMAGE_METHOD='pillow'):
+            storage = ImageWithDimensions._meta.get_field('image').storage
+            for in_place in [False, True]:
+                name = storage.save('static/images/wide.png', ContentFile(bytes_io.getvalue()))
+                image_with_dimensions = ImageWithDimensions.objects.create(image=name)
+                self.assertEqual((image_with_dimensions.image_width, image_with_dimensions.image_height), (800, 400))
+
+                BulkOptimizer(in_place=in_place).run([ImageWithDimensions])
+
+                image_with_dimensions.refresh_from_db()
+                self.assertEqual((image_with_dimensions.image_width, image_with_dimensions.image_height), (100, 50))
+                self.assertEqual(Image.open(image_with_dimensions.image.path).size, (100, 50))
+
+    def test_dimension_fields_loaded(self):
+        """The dimension fields are loaded with the image columns, instead of with queries for each row."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        bytes_io = BytesIO()
+        Image.new('RGB', (80, 40), 'red').save(bytes_io, format='PNG')
+        query_counts = []
+        with self.settings(MEDIA_ROOT=media_root, OPTIMIZED_IMAGE_METHOD='pillow'):
+            storage = ImageWithDimensions._meta.get_field('image').storage
+            for rows in [1, 4]:
+                while ImageWithDimensions.objects.count() < rows:
+                    name = storage.save('static/images/small.png', ContentFile(bytes_io.getvalue()))
+                    ImageWithDimensions.objects.create(image=name)
+                BulkOptimizer().run([ImageWithDimensions])
+                # All of the images are recorded as optimized now
+                with CaptureQueriesContext(connection) as queries:
+                    BulkOptimizer().run([ImageWithDimensions])
+                query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_tiny_webp(self):
+        """Memory-mapped images smaller than Pillow's format probes are opened, with and without size limits."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        bytes_io = BytesIO()
+        Image.new('RGB', (4, 4), 'red').save(bytes_io, format='WEBP')
+        with self.settings(MEDIA_ROOT=media_root, OPTIMIZED_IMAGE_METHOD='pillow'):
+            storage = GenericModel._meta.get_field('image').storage
+            for max_pixels in [None, 1000]:
+                name = storage.save('static/images/tiny.webp', ContentFile(bytes_io.getvalue()))
+                GenericModel.objects.create(image=name)
+                with self.settings(OPTIMIZED_IMAGE_MAX_PIXELS=max_pixels):
+                    BulkOptimizer().run([GenericModel])
+                self.assertTrue(OptimizedImageRecord.objects.filter(name=name).exists())
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_in_place(self, mock_tinypng):
+        """With in_place, the original files are overwritten, and the rows are not updated."""
+        mock_tinypng.return_value.compress.return_value = b"optimized"
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blog = factories.BlogPostOrSomethingFactory()
+            names = (blog.image1.name, blog.image2.name)
+            mode = os.stat(blog.image1.path).st_mode
+
+            with patch.object(blog.__class__.objects, 'bulk_update') as mock_bulk_update:
+                BulkOptimizer(in_place=True).run([blog.__class__])
+
+            self.assertFalse(mock_bulk_update.called)
+            blog.refresh_from_db()
+            self.assertEqual((blog.image1.name, blog.image2.name), names)
+            self.assertEqual(blog.image1.read(), b"optimized")
+            self.assertEqual(os.stat(blog.image1.path).st_mode, mode)
+            self.assertEqual(OptimizedImageRecord.objects.get(name=names[0]).optimized_size, 9)
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_rows_updated_per_chunk(self, mock_tinypng):
+        """Rows that point to new files are updated with one query per chunk."""
+        mock_tinypng.return_value.compress.return_value = b"optimized"
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blogs = [factories.BlogPostOrSomethingFactory() for i in range(3)]
+            model = blogs[0].__class__
+
+            with patch.object(model.objects, 'bulk_update', wraps=model.objects.bulk_update) as mock_bulk_update:
+                BulkOptimizer(chunk_size=2).run([model])
+
+            self.assertEqual(
+                [(len(call[0][0]), call[0][1]) for call in mock_bulk_update.call_args_list],
+                [(2, ['image1', 'image2']), (1, ['image1', 'image2'])]
+            )
+            for blog in blogs:
+                blog.refresh_from_db()
+                self.assertEqual(blog.image2.read(), b"optimized")
+
+
+class TestAsyncBulkOptimizer(TransactionTestCase):
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_arun(self, mock_tinypng):
+        """The bulk optimizer may be run from async code."""
+        mock_tinypng.return_value.compress.return_value = b"optimized"
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blog = factories.BlogPostOrSomethingFactory()
+            asyncio.run(BulkOptimizer(workers=2).arun([blog.__class__]))
+
+        blog.refresh_from_db()
+        self.assertEqual(blog.image1.read(), b"optimized")
+        self.assertEqual(OptimizedImageRecord.objects.count(), 2)
+
+
+class MemoryStorage(Storage):
+    """A remote storage that keeps its files in a dictionary, with ETags like S3's, and records downloads."""
+
+    def __init__(self):
+        self.files = {}
+        self.downloads = []
+
+    def _open(self, name, mode='rb'):
+        self.downloads.append(name)
+        return ContentFile(self.files[name], name=name)
+
+    def _save(self, name, content):
+        self.files[name] = b''.join(content.chunks())
+        return name
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def size(self, name):
+        return len(self.files[name])
+
+    def url(self, name):
+        return '/media/' + name
+
+    def get_etag(self, name):
+        return '"{}"'.format(hashlib.md5(self.files[name]).hexdigest())
+
+
+class TestRemoteStorage(TestCase):
+    """Test case for optimizing the images in a remote storage."""
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_prefetch_and_skip_by_etag(self, mock_tinypng):
+        mock_tinypng.return_value.compress.return_value = b"optimized"
+        storage = MemoryStorage()
+        for index in range(4):
+            storage.files['static/images/{}.png'.format(index)] = 'unoptimized image {}'.format(index).encode()
+            GenericModel.objects.create(image='static/images/{}.png'.format(index))
+
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng'), \
+                patch.object(GenericModel._meta.get_field('image'), 'storage', storage):
+            BulkOptimizer(workers=2, transfer_workers=3, prefetch=2).run([GenericModel])
+            names = [generic_model.image.name for generic_model in GenericModel.objects.order_by('pk')]
+            self.assertEqual([storage.files[name] for name in names], [b"optimized"] * 4)
+            self.assertEqual(len(storage.downloads), 4)
+            self.assertEqual(
+                set(OptimizedImageRecord.objects.values_list('etag', flat=True)),
+                {storage.get_etag(names[0])},
+            )
+
+            # Files that have not changed are not downloaded again
+            storage.downloads = []
+            BulkOptimizer(transfer_workers=2).run([GenericModel])
+            self.assertEqual(storage.downloads, [])
+
+            storage.files[names[1]] = b"a replaced image"
+            BulkOptimizer().run([GenericModel])
+            self.assertEqual(storage.downloads, [names[1]])
+        self.assertEqual(mock_tinypng.return_value.compress.call_count, 5)
+
+
+    def test_overwrite_failed_save(self):
+        """The original is not deleted until the optimized image has been saved."""
+        storage = MemoryStorage()
+        storage.files['static/images/photo.png'] = b"unoptimized image"
+        failing_names = set()
+        save = storage._save
+
+        def failing_save(name, content):
+            if name in failing_names:
+                raise OSError('Could not save {}'.format(name))
+            return save(name, content)
+
+        with patch.object(GenericModel._meta.get_field('image'), 'storage', storage), \
+                patch.object(storage, '_save', side_effect=failing_save):
+            image_file = GenericModel(image='static/images/photo.png').image
+            failing_names.add('static/images/.optimized-photo.png')
+            with self.assertRaises(OSError):
+                overwrite_field_file(image_file, b"optimized")
+            self.assertEqual(storage.files, {'static/images/photo.png': b"unoptimized image"})
+            self.assertEqual(image_file.name, 'static/images/photo.png')
+
+            # If only saving it under the original name fails, the optimized
+            # image is kept under the temporary name
+            failing_names = {'static/images/photo.png'}
+            overwrite_field_file(image_file, b"optimized")
+            self.assertEqual(storage.files, {'static/images/.optimized-photo.png': b"optimized"})
+            self.assertEqual(image_file.name, 'static/images/.optimized-photo.png')
+
+
+class TestOptimizeImagesCommand(TestCase):
+    """Test case for the optimize_images management command."""
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_shards(self, mock_tinypng):
+        """Each row is optimized by exactly one of the shards, which each have a checkpoint of their own."""
+        mock_tinypng.return_value.compress.return_value = b"optimized"
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        with self.settings(
+            OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif'],
+            OPTIMIZED_IMAGE_BULK_CHECKPOINT=os.path.join(checkpoint_dir.name, 'checkpoint.json'),
+        ):
+            blogs = [factories.BlogPostOrSomethingFactory() for i in range(6)]
+            optimized_names = []
+            for shard in ['1/2', '2/2']:
+                call_command('optimize_images', 'not_optimized.BlogPostOrSomething', shard=shard, stdout=StringIO())
+                names = set(OptimizedImageRecord.objects.values_list('name', flat=True)) - set(optimized_names)
+                optimized_names.extend(names)
+
+            self.assertEqual(mock_tinypng.return_value.compress.call_count, 12)
+            self.assertEqual(len(optimized_names), 12)
+            self.assertEqual(len(set(optimized_names)), 12)
+            for blog in blogs:
+                blog.refresh_from_db()
+                self.assertEqual(blog.image1.read(), b"optimized")
+            self.assertEqual(
+                sorted(os.listdir(checkpoint_dir.name)),
+                ['checkpoint.shard-1-of-2.json', 'checkpoint.shard-2-of-2.json'],
+            )
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_quota_exceeded(self, mock_tinypng):
+        """The command reports that the TinyPNG monthly limit was reached."""
+        mock_tinypng.return_value.compress.side_effect = QuotaExceeded
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            factories.BlogPostOrSomethingFactory()
+            stdout = StringIO()
+
+            with self.assertLogs('optimized_image.bulk', 'WARNING'):
+                call_command('optimize_images', 'not_optimized', stdout=stdout)
+
+            self.assertIn('The TinyPNG monthly limit was reached.', stdout.getvalue().splitlines()[-1])
+
+            stdout = StringIO()
+            with self.assertLogs('optimized_image.bulk', 'WARNING'):
+                call_command('optimize_images', 'not_optimized', progress='json', stdout=stdout)
+
+            self.assertIs(json.loads(stdout.getvalue())['quota_exceeded'], True)
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_dry_run(self, mock_tinypng):
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blog = factories.BlogPostOrSomethingFactory()
+            stdout = StringIO()
+
+            call_command('optimize_images', 'not_optimized', dry_run=True, progress='json', stdout=stdout)
+
+            self.assertFalse(mock_tinypng.return_value.compress.called)
+            self.assertFalse(OptimizedImageRecord.objects.exists())
+            progress = [json.loads(line) for line in stdout.getvalue().splitlines()]
+            self.assertEqual(
+                [(line['model'], line['rows'], line['optimized']) for line in progress],
+                [('not_optimized.BlogPostOrSomething', 1, 2)]
+            )
+            self.assertEqual(progress[0]['input_bytes'], blog.image1.size + blog.image2.size)
+
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_field_selector(self, mock_tinypng):
+        mock_tinypng.return_value.compress.return_value = b"optimized"
+        with self.settings(OPTIMIZED_IMAGE_METHOD='tinypng', OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['gif']):
+            blog = factories.BlogPostOrSomethingFactory()
+            stdout = StringIO()
+
+            call_command('optimize_images', 'not_optimized.BlogPostOrSomething.image2', stdout=stdout)
+
+            self.assertEqual(mock_tinypng.return_value.compress.call_count, 1)
+            blog.refresh_from_db()
+            self.assertEqual(blog.image2.read(), b"optimized")
+            self.assertNotEqual(blog.image1.read(), b"optimized")
+            self.assertIn('1/1 rows (100%)', stdout.getvalue())
+            self.assertIn('1 optimized', stdout.getvalue())
+
+            with self.assertRaises(CommandError):
+                call_command('optimize_images', 'not_optimized.BlogPostOrSomething.title')
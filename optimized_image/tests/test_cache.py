@@ -0,0 +1,130 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import TestCase, override_settings
+
+from ..backends import OptimizationResult
+from ..cache import DatabaseCache, FileSystemCache, make_cache_key
+from ..models import CachedOptimization
+from ..utils import optimize_from_buffer
+
+
+class TestMakeCacheKey(TestCase):
+    def test_key(self):
+        """The key changes with the image bytes, the method, and the options."""
+        key = make_cache_key(b'image', 'pillow', {'format': 'png'})
+        self.assertEqual(key, make_cache_key(b'image', 'pillow', {'format': 'png'}))
+        self.assertNotEqual(key, make_cache_key(b'other image', 'pillow', {'format': 'png'}))
+        self.assertNotEqual(key, make_cache_key(b'image', 'tinypng', {'format': 'png'}))
+        self.assertNotEqual(key, make_cache_key(b'image', 'pillow', {'format': 'jpeg'}))
+
+
+class TestFileSystemCache(TestCase):
+    def setUp(self):
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        self.location = location.name
+
+    def test_get_and_set(self):
+        cache = FileSystemCache(self.location)
+        self.assertIsNone(cache.get('abc'))
+        cache.set('abc', b'optimized')
+        self.assertEqual(cache.get('abc'), b'optimized')
+
+    def test_evicts_least_recently_used(self):
+        """When the cache grows past max_size, the least recently used files are deleted."""
+        cache = FileSystemCache(self.location, max_size=25)
+        cache.set('aa', b'0' * 10)
+        cache.set('bb', b'1' * 10)
+        # Make 'aa' older than 'bb', then use 'bb'
+        os.utime(cache.path('aa'), (1, 1))
+        cache.get('bb')
+
+        cache.set('cc', b'2' * 10)
+
+        self.assertIsNone(cache.get('aa'))
+        self.assertEqual(cache.get('bb'), b'1' * 10)
+        self.assertEqual(cache.get('cc'), b'2' * 10)
+
+
+class TestDatabaseCache(TestCase):
+    def test_evicts_least_recently_used(self):
+        """When there are more than max_entries rows, the least recently used rows are deleted."""
+        cache = DatabaseCache(max_entries=2)
+        cache.set('aa', b'a')
+        cache.set('bb', b'b')
+        cache.get('aa')
+
+        cache.set('cc', b'c')
+
+        self.assertEqual(CachedOptimization.objects.count(), 2)
+        self.assertIsNone(cache.get('bb'))
+        self.assertEqual(cache.get('aa'), b'a')
+        self.assertEqual(cache.get('cc'), b'c')
+
+
+class TestOptimizeFromBufferCache(TestCase):
+    @override_settings(
+        OPTIMIZED_IMAGE_METHOD='pillow',
+        OPTIMIZED_IMAGE_CACHE={'BACKEND': 'optimized_image.cache.DatabaseCache'},
+    )
+    @patch('optimized_image.utils.is_testing_mode')
+    def test_identical_images_optimized_once(self, mock_is_testing_mode):
+        """Optimizing the same image twice only runs the optimization once."""
+        mock_is_testing_mode.return_value = False
+        content = open('small_kitten.jpeg', 'rb').read()
+
+        with patch('optimized_image.backends.Image.open', wraps=Image.open) as mock_open:
+            first = optimize_from_buffer(SimpleUploadedFile(name='kitten.jpeg', content=content))
+            second = optimize_from_buffer(SimpleUploadedFile(name='kitten2.jpeg', content=content))
+
+        self.assertEqual(mock_open.call_count, 1)
+        first.open()
+        second.open()
+        self.assertEqual(first.read(), second.read())
+
+    @override_settings(OPTIMIZED_IMAGE_CACHE={'BACKEND': 'optimized_image.cache.DatabaseCache'})
+    @patch('optimized_image.utils.is_testing_mode')
+    def test_backend_settings_in_key(self, mock_is_testing_mode):
+        """Changing the OPTIONS of a backend, or the steps of a chain, does not reuse the cached results."""
+        mock_is_testing_mode.return_value = False
+        content = open('small_kitten.jpeg', 'rb').read()
+        backends_settings = [
+            [{'BACKEND': 'pillow'}],
+            [{'BACKEND': 'pillow', 'OPTIONS': {'animated_format': 'WEBP'}}],
+            [{'BACKEND': 'pillow', 'OPTIONS': {'animated_format': 'WEBP'}, 'MIN_SIZE': 1024}],
+        ]
+
+        with patch('optimized_image.backends.Image.open', wraps=Image.open) as mock_open:
+            for index, backends in enumerate(backends_settings * 2):
+                with self.settings(OPTIMIZED_IMAGE_BACKENDS=backends):
+                    optimize_from_buffer(SimpleUploadedFile(name='kitten{}.jpeg'.format(index), content=content))
+
+        self.assertEqual(mock_open.call_count, len(backends_settings))
+
+    @override_settings(
+        OPTIMIZED_IMAGE_METHOD='pillow',
+        OPTIMIZED_IMAGE_CACHE={'BACKEND': 'optimized_image.cache.DjangoCache'},
+    )
+    @patch('optimized_image.utils.is_testing_mode')
+    def test_memory_mapped_upload(self, mock_is_testing_mode):
+        """A result that is the memory-mapped upload itself is cached as bytes, since it cannot be pickled."""
+        mock_is_testing_mode.return_value = False
+        content = open('small_kitten.jpeg', 'rb').read()
+        upload = TemporaryUploadedFile('kitten.jpeg', 'image/jpeg', len(content), None)
+        upload.write(content)
+        upload.flush()
+        self.addCleanup(upload.close)
+
+        with patch('optimized_image.utils.run_backend', side_effect=lambda backend, content, *args, **kwargs: (
+            OptimizationResult(content, {'backend': backend.name})
+        )):
+            optimize_from_buffer(upload)
+
+        with patch('optimized_image.utils.run_backend') as mock_run_backend:
+            optimize_from_buffer(SimpleUploadedFile(name='kitten2.jpeg', content=content))
+        mock_run_backend.assert_not_called()
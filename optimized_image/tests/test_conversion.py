@@ -0,0 +1,88 @@
+from io import BytesIO
+from unittest.mock import patch
+
+from PIL import Image, ImageFilter
+
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from . import factories
+from ..conversion import get_ssim
+from ..utils import optimize_content, optimize_from_buffer
+from not_optimized.models import GenericModel
+
+
+def make_photo(size=(400, 300)):
+    """Return the bytes of a PNG that compresses about as badly as a photo does."""
+    noise = Image.effect_noise(size, 60).filter(ImageFilter.GaussianBlur(2))
+    image = Image.merge('RGB', [noise, Image.linear_gradient('L').resize(size), noise.rotate(180)])
+    output_file = BytesIO()
+    image.save(output_file, format='PNG')
+    return output_file.getvalue()
+
+
+class TestSSIM(SimpleTestCase):
+    def test_ssim(self):
+        image = Image.open(BytesIO(make_photo())).convert('RGB')
+        self.assertAlmostEqual(get_ssim(image, image.copy()), 1)
+        self.assertLess(get_ssim(image, image.quantize(colors=4).convert('RGB')), 0.9)
+
+
+@override_settings(OPTIMIZED_IMAGE_METHOD='pillow')
+class TestConversion(TestCase):
+    """Test case for converting images to other formats when that makes them smaller."""
+
+    def setUp(self):
+        self.field = GenericModel._meta.get_field('image')
+
+    def test_settings(self):
+        content = make_photo()
+        with self.settings(OPTIMIZED_IMAGE_CONVERT_FORMATS=['webp', 'jpg']):
+            result = optimize_content(content, 'png')
+        self.assertIn(result.stats['output_format'], ['WEBP', 'JPEG'])
+        self.assertLess(len(result.content), len(content) / 2)
+
+        # Conversions that lose too much quality are not used
+        with self.settings(OPTIMIZED_IMAGE_CONVERT_FORMATS=['webp', 'jpg'], OPTIMIZED_IMAGE_CONVERT_MIN_SSIM=1):
+            result = optimize_content(content, 'png')
+        self.assertNotIn('output_format', result.stats)
+
+        # A field may turn the conversions off
+        with self.settings(OPTIMIZED_IMAGE_CONVERT_FORMATS=['webp']):
+            result = optimize_content(content, 'png', convert_formats=[])
+        self.assertNotIn('output_format', result.stats)
+
+    @patch('optimized_image.utils.is_testing_mode', return_value=False)
+    def test_temporary_uploaded_file(self, mock_is_testing_mode):
+        """Large uploads, which are memory-mapped, are read by the backend and each conversion at once."""
+        content = make_photo((1600, 1200))
+        data = TemporaryUploadedFile('photo.png', 'image/png', len(content), None)
+        data.write(content)
+        data.seek(0)
+        self.addCleanup(data.close)
+
+        optimize_from_buffer(data, convert_formats=['webp', 'jpeg'])
+        data.seek(0)
+        self.assertIn(Image.open(data).format, ['WEBP', 'JPEG'])
+
+    @patch('optimized_image.utils.is_testing_mode', return_value=False)
+    def test_field(self, mock_is_testing_mode):
+        """The image is saved with the extension of the format that it was converted to."""
+        generic_model = factories.GenericModelFactory(image=None)
+        with patch.object(self.field, 'convert_formats', ['webp', 'avif']):
+            self.field.save_form_data(generic_model, SimpleUploadedFile(name='photo.png', content=make_photo()))
+            generic_model.save()
+
+        image_format = Image.open(generic_model.image).format
+        self.assertIn(image_format, ['WEBP', 'AVIF'])
+        self.assertTrue(generic_model.image.name.endswith('.' + image_format.lower()))
+
+    def test_deconstruct_and_check(self):
+        with patch.object(self.field, 'convert_formats', ['webp']), patch.object(self.field, 'min_ssim', 0.9):
+            name, path, args, kwargs = self.field.deconstruct()
+            self.assertEqual(self.field.check(), [])
+        self.assertEqual((kwargs['convert_formats'], kwargs['min_ssim']), (['webp'], 0.9))
+
+        with patch.object(self.field, 'convert_formats', ['bmpx']):
+            errors = self.field.check()
+        self.assertEqual([error.id for error in errors], ['optimized_image.E002'])
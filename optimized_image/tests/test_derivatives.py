@@ -0,0 +1,110 @@
+from io import BytesIO
+import shutil
+import tempfile
+import threading
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TransactionTestCase, override_settings
+
+from . import factories
+from .test_conversion import make_photo
+from .. import utils
+from ..models import ImageDerivative
+from not_optimized.models import GenericModel
+
+
+@override_settings(ROOT_URLCONF='optimized_image.urls', OPTIMIZED_IMAGE_METHOD='pillow')
+class TestLazyField(TransactionTestCase):
+    """Test case for optimizing the images of lazy fields when they are first requested."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = self.settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.field = GenericModel._meta.get_field('image')
+        lazy_patch = patch.object(self.field, 'lazy', True)
+        lazy_patch.start()
+        self.addCleanup(lazy_patch.stop)
+
+        self.content = make_photo()
+        self.generic_model = factories.GenericModelFactory(image=None)
+        self.field.save_form_data(self.generic_model, SimpleUploadedFile(name='photo.png', content=self.content))
+        self.generic_model.save()
+
+    def test_optimized_url(self):
+        image = self.generic_model.image
+        # The stored image is the original
+        self.assertEqual(image.read(), self.content)
+
+        response = self.client.get(image.optimized_url)
+        self.assertEqual(response.status_code, 200)
+        optimized_content = b''.join(response.streaming_content)
+        self.assertLess(len(optimized_content), len(self.content))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=86400')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+
+        # The derivative is only made once
+        with patch('optimized_image.derivatives.optimize_content') as mock_optimize_content:
+            response = self.client.get(image.optimized_url)
+            self.assertEqual(b''.join(response.streaming_content), optimized_content)
+            response = self.client.get(image.optimized_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+        mock_optimize_content.assert_not_called()
+        self.assertEqual(ImageDerivative.objects.count(), 1)
+
+    def test_variants(self):
+        with patch.object(self.field, 'variant_widths', [100]), patch.object(self.field, 'variant_formats', ['WEBP']):
+            variant, = self.generic_model.image.variants
+            response = self.client.get(variant.url)
+            self.assertEqual(response.status_code, 200)
+            image = Image.open(BytesIO(b''.join(response.streaming_content)))
+            self.assertEqual((image.format, image.width), ('WEBP', 100))
+
+            # Only the field's own variants are made
+            response = self.client.get(self.generic_model.image.optimized_url, {'w': 150, 'format': 'webp'})
+            self.assertEqual(response.status_code, 404)
+
+    def test_not_found(self):
+        url = self.generic_model.image.optimized_url
+        self.assertEqual(self.client.get(url.replace('photo', 'other')).status_code, 404)
+        with patch.object(self.field, 'lazy', False):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_stampede(self):
+        """Requests that arrive while the image is being optimized wait for it, instead of optimizing it too."""
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_optimize_content(*args, **kwargs):
+            calls.append(args)
+            started.set()
+            release.wait(5)
+            return utils.optimize_content(*args, **kwargs)
+
+        url = self.generic_model.image.optimized_url
+        responses = []
+
+        def request():
+            responses.append(self.client.get(url))
+
+        with patch('optimized_image.derivatives.optimize_content', side_effect=slow_optimize_content):
+            threads = [threading.Thread(target=request) for index in range(4)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([response.status_code for response in responses], [200] * 4)
+        self.assertEqual(len({response['ETag'] for response in responses}), 1)
@@ -1,11 +1,26 @@
 from factory.fuzzy import FuzzyText
 import io
+import threading
 from unittest.mock import patch
 
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.test import TestCase
+from django.core.files.uploadedfile import InMemoryUploadedFile, SimpleUploadedFile
+from django.test import TestCase, override_settings
 
 from . import factories
+from ..backends import BaseBackend
+from ..fields import OptimizedImageField
+from ..models import OptimizedImageRecord
+from ..utils import optimize_from_buffer
+
+
+class BarrierBackend(BaseBackend):
+    """A backend that drops the last 10 bytes of each image, once 3 images are being optimized at once."""
+    name = 'barrier'
+    barrier = threading.Barrier(3, timeout=5)
+
+    def compress(self, content, image_format, **options):
+        self.barrier.wait()
+        return content[:-10]
 
 
 class TestOptimizedImageField(TestCase):
@@ -41,7 +56,7 @@ class TestOptimizedImageField(TestCase):
 
     @patch('optimized_image.utils.optimize_from_buffer')
     def test_save_form_data(self, mock_optimize_from_buffer):
-        """Calling save_form_data() on an OptimizedImageField calls optimize_from_buffer()."""
+        """Calling save_form_data() on an OptimizedImageField optimizes the image when the instance is saved."""
         generic_model = factories.GenericModelFactory(
             title='Generic Model',
             image=None
@@ -63,10 +78,60 @@ class TestOptimizedImageField(TestCase):
 
         # Call save_form_data on the OptimizedImageField
         generic_model.image.field.save_form_data(generic_model, new_file)
+        self.assertEqual(mock_optimize_from_buffer.call_count, 0)
+        generic_model.save()
 
         # Now the mock_optimize_from_buffer has been called once
         self.assertEqual(mock_optimize_from_buffer.call_count, 1)
         self.assertEqual(mock_optimize_from_buffer.call_args[0][0], new_file)
+        self.assertEqual(mock_optimize_from_buffer.call_args[1], {})
+
+        # The field's max_dimension is passed on
+        other_file = InMemoryUploadedFile(
+            io.StringIO('something else'), 'image', 'static/images/{}.png'.format(FuzzyText().fuzz()),
+            'image/jpeg', 14, 'utf-8'
+        )
+        field = generic_model._meta.get_field('image')
+        with patch.object(field, 'max_dimension', 1024):
+            field.save_form_data(generic_model, other_file)
+        generic_model.save()
+        self.assertEqual(mock_optimize_from_buffer.call_args[1], {'max_dimension': 1024})
+
+    @override_settings(OPTIMIZED_IMAGE_BACKENDS=[{'BACKEND': 'optimized_image.tests.test_fields.BarrierBackend'}])
+    @patch('optimized_image.utils.is_testing_mode', return_value=False)
+    def test_save_form_data_batch(self, mock_is_testing_mode):
+        """The images of all of the fields of an instance are optimized together, and identical images once."""
+        blog = factories.BlogPostOrSomethingFactory(image1=None, image2=None)
+        contents = [b'first image ' * 10, b'second image ' * 10, b'third image ' * 10, b'first image ' * 10]
+        for index, content in enumerate(contents):
+            field = blog._meta.get_field('image{}'.format(index + 1))
+            field.save_form_data(blog, SimpleUploadedFile(name='image.png', content=content))
+
+        # The backend waits for 3 images to be optimized at the same time
+        with patch('optimized_image.utils.optimize_from_buffer', wraps=optimize_from_buffer) as mock_optimize:
+            blog.save()
+        self.assertEqual(mock_optimize.call_count, 3)
+
+        blog.refresh_from_db()
+        images = [blog.image1, blog.image2, blog.image3, blog.image4]
+        self.assertEqual([image.read() for image in images], [content[:-10] for content in contents])
+        self.assertEqual(len({image.name for image in images}), 4)
+        self.assertEqual(OptimizedImageRecord.objects.count(), 4)
+
+    def test_encoder_options(self):
+        """The encoder options are passed to the backends, and kept in migrations."""
+        field = OptimizedImageField(quality=60, effort='low', strip_metadata=True)
+        self.assertEqual(
+            field.get_optimization_options(), {'quality': 60, 'effort': 'low', 'strip_metadata': True}
+        )
+        name, path, args, kwargs = field.deconstruct()
+        self.assertEqual(
+            (kwargs['quality'], kwargs['effort'], kwargs['strip_metadata']), (60, 'low', True)
+        )
+        self.assertNotIn('progressive', kwargs)
+
+        field = OptimizedImageField(effort='fastest')
+        self.assertEqual([error.id for error in field._check_encoder_options()], ['optimized_image.E003'])
 
     @patch('optimized_image.utils.optimize_from_buffer')
     def test_save_form_data_no_update(self, mock_optimize_from_buffer):
@@ -109,3 +174,21 @@ class TestOptimizedImageField(TestCase):
             self.assertEqual(mock_optimize_from_buffer.call_count, 0)
             # The model still does not have an image
             self.assertEqual(generic_model.image.name, '')
+
+    @override_settings(OPTIMIZED_IMAGE_METHOD='justtesting')
+    @patch('optimized_image.utils.is_testing_mode')
+    def test_save_records_optimization(self, mock_is_testing_mode):
+        """Saving an optimized image records it, so that it is not optimized again later."""
+        mock_is_testing_mode.return_value = False
+        generic_model = factories.GenericModelFactory(title='Generic Model', image=None)
+        new_file = SimpleUploadedFile(name='kitten.jpeg', content=open('small_kitten.jpeg', 'rb').read())
+
+        generic_model.image.field.save_form_data(generic_model, new_file)
+        # Nothing is recorded until the file is saved
+        self.assertFalse(OptimizedImageRecord.objects.exists())
+        generic_model.save()
+
+        record = OptimizedImageRecord.objects.get()
+        self.assertEqual(record.name, generic_model.image.name)
+        self.assertEqual(record.method, 'justtesting')
+        self.assertEqual(record.optimized_size, generic_model.image.size)
@@ -0,0 +1,75 @@
+from io import BytesIO
+import threading
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from . import factories
+from .test_backends import make_image
+from ..limits import ImageTooLarge, MemoryBudget, check_image_size, open_header
+from ..utils import optimize_content, optimize_from_buffer
+
+
+@override_settings(OPTIMIZED_IMAGE_MAX_PIXELS=100 * 100)
+class TestSizeLimits(TestCase):
+    """Test case for the OPTIMIZED_IMAGE_MAX_PIXELS and OPTIMIZED_IMAGE_MAX_MEMORY settings."""
+
+    def test_check_image_size(self):
+        self.assertEqual(check_image_size(open_header(make_image((100, 100)))), {})
+        # A JPEG can be decoded at 1/4 of its size, which fits
+        self.assertEqual(
+            check_image_size(open_header(make_image((400, 300)))), {'max_dimension': 100, 'max_pixels': 10000}
+        )
+        with self.assertRaises(ImageTooLarge):
+            check_image_size(open_header(make_image((400, 300), 'PNG')))
+        with override_settings(OPTIMIZED_IMAGE_OVERSIZED='reject'), self.assertRaises(ImageTooLarge):
+            check_image_size(open_header(make_image((400, 300))))
+
+        # 4 bytes per RGB pixel
+        with override_settings(OPTIMIZED_IMAGE_MAX_PIXELS=None, OPTIMIZED_IMAGE_MAX_MEMORY=400 * 300 * 4):
+            self.assertEqual(check_image_size(open_header(make_image((400, 300)))), {})
+
+    @override_settings(OPTIMIZED_IMAGE_METHOD='pillow')
+    def test_downscale_on_decode(self):
+        """Oversized JPEGs are decoded at a reduced scale, and never at full size."""
+        content = make_image((800, 600))
+        with patch.object(Image.Image, 'resize', autospec=True, side_effect=Image.Image.resize) as mock_resize:
+            result = optimize_content(content, 'jpg')
+
+        self.assertEqual(Image.open(BytesIO(result.content)).size, (100, 75))
+        self.assertEqual(mock_resize.call_args[0][0].size, (100, 75))
+
+    @override_settings(OPTIMIZED_IMAGE_METHOD='pillow')
+    @patch('optimized_image.utils.is_testing_mode', return_value=False)
+    def test_reject(self, mock_is_testing_mode):
+        """Oversized images that cannot be scaled down are left as they are, and fail validation."""
+        content = make_image((400, 300), 'PNG')
+        with patch('optimized_image.backends.PillowBackend.compress') as mock_compress:
+            data = optimize_from_buffer(SimpleUploadedFile(name='large.png', content=content))
+        mock_compress.assert_not_called()
+
+        generic_model = factories.GenericModelFactory()
+        generic_model.image = data
+        with self.assertRaises(ValidationError) as context:
+            generic_model._meta.get_field('image').run_validators(generic_model.image)
+        self.assertEqual(context.exception.error_list[0].code, 'image_too_large')
+        self.assertEqual(data.file.tell(), 0)
+
+
+class TestMemoryBudget(SimpleTestCase):
+    def test_acquire(self):
+        budget = MemoryBudget(100)
+        self.assertEqual(budget.acquire(60), 60)
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(budget.acquire(500)))
+        thread.start()
+        # The image needs more than the whole budget, so it waits until it can run alone
+        thread.join(0.1)
+        self.assertEqual(acquired, [])
+        budget.release(60)
+        thread.join(5)
+        self.assertEqual(acquired, [100])
@@ -0,0 +1,110 @@
+import socket
+from unittest.mock import patch
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from . import factories
+from ..backends import JustTestingBackend
+from ..bulk import BulkOptimizer
+from ..metrics import BaseMetrics, StatsDMetrics
+from ..signals import optimization_failed, post_optimize, pre_optimize
+from ..utils import optimize_from_buffer
+
+
+class RecordingMetrics(BaseMetrics):
+    """A metrics adapter that keeps the metrics in a list."""
+    recorded = []
+
+    def increment(self, name, value=1, tags=None):
+        self.recorded.append(('increment', name, value, tags))
+
+    def observe(self, name, value, tags=None):
+        self.recorded.append(('observe', name, value, tags))
+
+
+@override_settings(
+    OPTIMIZED_IMAGE_METHOD='justtesting',
+    OPTIMIZED_IMAGE_METRICS={'BACKEND': 'optimized_image.tests.test_metrics.RecordingMetrics'},
+)
+@patch('optimized_image.utils.is_testing_mode', return_value=False)
+class TestSignals(TestCase):
+    """Test case for the optimization signals and the metrics that they record."""
+
+    def setUp(self):
+        RecordingMetrics.recorded = []
+
+    def test_optimize_from_buffer(self, mock_is_testing_mode):
+        received = []
+
+        def receiver(signal, **kwargs):
+            received.append((signal, kwargs))
+
+        pre_optimize.connect(receiver)
+        self.addCleanup(pre_optimize.disconnect, receiver)
+        post_optimize.connect(receiver)
+        self.addCleanup(post_optimize.disconnect, receiver)
+
+        data = SimpleUploadedFile(name='kitten.jpeg', content=open('small_kitten.jpeg', 'rb').read())
+        optimize_from_buffer(data)
+
+        self.assertEqual([signal for signal, kwargs in received], [pre_optimize, post_optimize])
+        kwargs = received[1][1]
+        self.assertEqual(kwargs['sender'], JustTestingBackend)
+        self.assertEqual(kwargs['name'], 'kitten.jpeg')
+        self.assertEqual(kwargs['image_format'], 'JPEG')
+        self.assertEqual(kwargs['result'].stats['output_size'], data.size)
+
+        metric_names = [(kind, name) for kind, name, value, tags in RecordingMetrics.recorded]
+        self.assertEqual(metric_names, [
+            ('increment', 'optimizations'),
+            ('observe', 'duration_seconds'),
+            ('observe', 'input_bytes'),
+            ('observe', 'output_bytes'),
+            ('increment', 'saved_bytes'),
+        ])
+        self.assertEqual(
+            RecordingMetrics.recorded[0][3], {'backend': 'justtesting', 'format': 'JPEG', 'cached': False}
+        )
+
+    @patch('optimized_image.backends.JustTestingBackend.compress', side_effect=OSError)
+    def test_bulk_failure(self, mock_compress, mock_is_testing_mode):
+        """A failure is signalled and logged, and the other images are still optimized."""
+        received = []
+
+        def receiver(**kwargs):
+            received.append(kwargs)
+
+        optimization_failed.connect(receiver)
+        self.addCleanup(optimization_failed.disconnect, receiver)
+        blog = factories.BlogPostOrSomethingFactory()
+
+        with self.assertLogs('optimized_image.bulk', 'ERROR') as logs:
+            BulkOptimizer().run([blog.__class__])
+
+        self.assertEqual([kwargs['name'] for kwargs in received], [blog.image1.name, blog.image2.name])
+        self.assertIsInstance(received[0]['exception'], OSError)
+        self.assertIn('Optimization failed for {}'.format(blog.image1.name), logs.output[0])
+        # The factory saves JPEGs under .png names, and the format comes from the contents
+        self.assertIn(
+            ('increment', 'failures', 1, {'backend': 'justtesting', 'format': 'JPEG', 'error': 'OSError'}),
+            RecordingMetrics.recorded
+        )
+
+
+class TestStatsDMetrics(SimpleTestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.addCleanup(self.server.close)
+        self.port = self.server.getsockname()[1]
+
+    def test_send(self):
+        metrics = StatsDMetrics(host='127.0.0.1', port=self.port)
+        metrics.increment('optimizations', tags={'backend': 'pillow', 'format': 'PNG'})
+        self.assertEqual(self.server.recv(1024), b'optimized_image.optimizations.pillow.PNG:1|c')
+
+        metrics = StatsDMetrics(host='127.0.0.1', port=self.port, dogstatsd=True)
+        metrics.observe('input_bytes', 2048, tags={'backend': 'pillow'})
+        self.assertEqual(self.server.recv(1024), b'optimized_image.input_bytes:2048|h|#backend:pillow')
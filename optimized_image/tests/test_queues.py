@@ -0,0 +1,221 @@
+from datetime import timedelta
+from io import BytesIO
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from not_optimized.models import GenericModel, ImageWithDimensions
+
+from . import factories
+from ..models import OptimizationJob, OptimizedImageRecord
+from ..queues import DatabaseQueue, ThreadPoolQueue, get_optimization_queue, run_optimization_job
+
+
+@override_settings(
+    OPTIMIZED_IMAGE_METHOD='pillow',
+    OPTIMIZED_IMAGE_QUEUE={'BACKEND': 'optimized_image.queues.DatabaseQueue'},
+)
+class TestDeferredOptimization(TestCase):
+    """Test case for OptimizedImageFields with deferred=True."""
+
+    def setUp(self):
+        self.field = GenericModel._meta.get_field('image')
+        patcher = patch.object(self.field, 'deferred', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save_kitten(self, generic_model):
+        content = open('small_kitten.jpeg', 'rb').read()
+        new_file = SimpleUploadedFile(name='kitten.jpeg', content=content)
+        with patch('optimized_image.utils.optimize_from_buffer') as mock_optimize_from_buffer:
+            self.field.save_form_data(generic_model, new_file)
+            with self.captureOnCommitCallbacks(execute=True):
+                generic_model.save()
+        # The image was not optimized during the save
+        self.assertFalse(mock_optimize_from_buffer.called)
+        return content
+
+    def test_deconstruct(self):
+        name, path, args, kwargs = self.field.deconstruct()
+        self.assertIs(kwargs['deferred'], True)
+
+    def test_saving_queues_job(self):
+        """The original image is saved, and a job is queued after the transaction is committed."""
+        generic_model = factories.GenericModelFactory(image=None)
+        content = self.save_kitten(generic_model)
+
+        self.assertEqual(generic_model.image.read(), content)
+        job = OptimizationJob.objects.get()
+        self.assertEqual(job.model, 'not_optimized.GenericModel')
+        self.assertEqual(job.object_pk, str(generic_model.pk))
+        self.assertEqual(job.field_name, 'image')
+        self.assertEqual(job.name, generic_model.image.name)
+
+    def test_processing_job_replaces_image(self):
+        """Running the job replaces the original image with the optimized one."""
+        generic_model = factories.GenericModelFactory(image=None)
+        content = self.save_kitten(generic_model)
+        original_name = generic_model.image.name
+
+        self.assertEqual(get_optimization_queue().process_jobs(), 1)
+
+        generic_model.refresh_from_db()
+        self.assertNotEqual(generic_model.image.name, original_name)
+        self.assertLess(generic_model.image.size, len(content))
+        self.assertFalse(generic_model.image.storage.exists(original_name))
+        self.assertFalse(OptimizationJob.objects.exists())
+        self.assertTrue(OptimizedImageRecord.objects.filter(name=generic_model.image.name).exists())
+
+    def test_job_skipped_if_image_changed(self):
+        """If the image was changed before the job ran, the new image is left alone."""
+        generic_model = factories.GenericModelFactory(image=None)
+        self.save_kitten(generic_model)
+        generic_model.image = 'static/images/other.png'
+        generic_model.save()
+
+        with patch('optimized_image.utils.optimize_content') as mock_optimize_content:
+            get_optimization_queue().process_jobs()
+
+        self.assertFalse(mock_optimize_content.called)
+        generic_model.refresh_from_db()
+        self.assertEqual(generic_model.image.name, 'static/images/other.png')
+
+    def test_dimension_fields(self):
+        """The width_field and height_field of an image that was scaled down are updated."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        bytes_io = BytesIO()
+        Image.new('RGB', (800, 400), 'red').save(bytes_io, format='PNG')
+        with self.settings(MEDIA_ROOT=media_root):
+            field = ImageWithDimensions._meta.get_field('image')
+            name = field.storage.save('static/images/wide.png', ContentFile(bytes_io.getvalue()))
+            image_with_dimensions = ImageWithDimensions.objects.create(image=name)
+
+            self.assertTrue(run_optimization_job({
+                'model': 'not_optimized.ImageWithDimensions',
+                'object_pk': str(image_with_dimensions.pk),
+                'field_name': 'image',
+                'name': name,
+            }))
+
+            image_with_dimensions.refresh_from_db()
+            self.assertEqual((image_with_dimensions.image_width, image_with_dimensions.image_height), (100, 50))
+            self.assertEqual(Image.open(image_with_dimensions.image.path).size, (100, 50))
+
+    def test_failed_job_is_retried(self):
+        """A job that fails is retried, up to max_attempts times."""
+        generic_model = factories.GenericModelFactory(image=None)
+        self.save_kitten(generic_model)
+        queue = DatabaseQueue(max_attempts=2)
+
+        with patch('optimized_image.utils.optimize_content', side_effect=ValueError):
+            queue.process_jobs()
+            job = OptimizationJob.objects.get()
+            self.assertEqual(job.status, OptimizationJob.PENDING)
+            self.assertIn('ValueError', job.error)
+
+            queue.process_jobs()
+            job.refresh_from_db()
+            self.assertEqual(job.status, OptimizationJob.FAILED)
+            self.assertEqual(job.attempts, 2)
+
+
+    def test_abandoned_job_is_reclaimed(self):
+        """A job whose worker died while running it is run again once it times out."""
+        generic_model = factories.GenericModelFactory(image=None)
+        self.save_kitten(generic_model)
+        queue = DatabaseQueue(max_attempts=2, timeout=60)
+        # A worker claimed the job, and was killed
+        OptimizationJob.objects.update(status=OptimizationJob.RUNNING, attempts=1, claimed_at=timezone.now())
+
+        self.assertEqual(queue.process_jobs(), 0)
+        self.assertEqual(OptimizationJob.objects.get().status, OptimizationJob.RUNNING)
+
+        OptimizationJob.objects.update(claimed_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(queue.process_jobs(), 1)
+        self.assertFalse(OptimizationJob.objects.exists())
+
+    def test_abandoned_job_fails_without_attempts_left(self):
+        generic_model = factories.GenericModelFactory(image=None)
+        self.save_kitten(generic_model)
+        queue = DatabaseQueue(max_attempts=2, timeout=60)
+        OptimizationJob.objects.update(
+            status=OptimizationJob.RUNNING, attempts=2, claimed_at=timezone.now() - timedelta(seconds=61)
+        )
+
+        self.assertEqual(queue.process_jobs(), 0)
+        job = OptimizationJob.objects.get()
+        self.assertEqual(job.status, OptimizationJob.FAILED)
+        self.assertIn('did not finish', job.error)
+
+@override_settings(
+    OPTIMIZED_IMAGE_METHOD='pillow',
+    OPTIMIZED_IMAGE_QUEUE={'BACKEND': 'optimized_image.queues.DatabaseQueue'},
+)
+class TestDeferredOptimizationAutocommit(TransactionTestCase):
+    """Test case for saving deferred images outside of a transaction, where on_commit() callbacks run at once."""
+
+    def setUp(self):
+        self.field = GenericModel._meta.get_field('image')
+        patcher = patch.object(self.field, 'deferred', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_new_instance(self):
+        """The job of a new row is queued once the row has been inserted, with its primary key."""
+        content = open('small_kitten.jpeg', 'rb').read()
+        generic_model = GenericModel()
+        self.field.save_form_data(generic_model, SimpleUploadedFile(name='kitten.jpeg', content=content))
+        generic_model.save()
+
+        job = OptimizationJob.objects.get()
+        self.assertEqual(job.object_pk, str(generic_model.pk))
+        self.assertEqual(get_optimization_queue().process_jobs(), 1)
+        self.assertFalse(OptimizationJob.objects.exists())
+        generic_model.refresh_from_db()
+        self.assertLess(generic_model.image.size, len(content))
+
+    def test_existing_instance(self):
+        """The job of a changed image runs after the row points to the image."""
+        content = open('small_kitten.jpeg', 'rb').read()
+        generic_model = GenericModel.objects.create()
+        self.field.save_form_data(generic_model, SimpleUploadedFile(name='kitten.jpeg', content=content))
+        generic_model.save()
+
+        self.assertEqual(get_optimization_queue().process_jobs(), 1)
+        generic_model.refresh_from_db()
+        self.assertLess(generic_model.image.size, len(content))
+
+
+class TestThreadPoolQueue(TestCase):
+    @patch('optimized_image.queues.run_optimization_job')
+    def test_enqueue(self, mock_run_optimization_job):
+        """Jobs are run in the thread pool."""
+        queue = ThreadPoolQueue(max_workers=1)
+        job = {'model': 'not_optimized.GenericModel', 'object_pk': '1', 'field_name': 'image', 'name': 'a.png'}
+
+        with patch('optimized_image.queues.close_old_connections'):
+            queue.enqueue(job)
+            queue.executor.shutdown(wait=True)
+
+        mock_run_optimization_job.assert_called_once_with(job)
+
+    @patch('optimized_image.queues.run_optimization_job', side_effect=ValueError)
+    def test_failed_job_is_logged(self, mock_run_optimization_job):
+        queue = ThreadPoolQueue(max_workers=1)
+        job = {'model': 'not_optimized.GenericModel', 'object_pk': '1', 'field_name': 'image', 'name': 'a.png'}
+
+        with patch('optimized_image.queues.close_old_connections'), \
+                self.assertLogs('optimized_image.queues', 'ERROR') as logs:
+            queue.enqueue(job)
+            queue.executor.shutdown(wait=True)
+
+        self.assertIn('Optimization failed for a.png.', logs.output[0])
+        self.assertIn('ValueError', logs.output[0])
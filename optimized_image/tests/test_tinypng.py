@@ -0,0 +1,168 @@
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from django.test import SimpleTestCase, override_settings
+
+from ..backends import TinyPNGBackend, get_backend
+from ..tinypng import QuotaExceeded, TinyPNGClient, TinyPNGError, TinyPNGKeyPool, get_tinypng_client
+
+
+class StubTinyPNGHandler(BaseHTTPRequestHandler):
+    """A stand-in for the TinyPNG API, which "optimizes" an image by reversing its bytes."""
+
+    def do_POST(self):
+        server = self.server
+        content = self.rfile.read(int(self.headers['Content-Length']))
+        server.requests.append(('POST', self.path, self.headers['Authorization']))
+        if server.responses:
+            # A status, or a status and its headers
+            response = server.responses.pop(0)
+            status, headers = response if isinstance(response, tuple) else (response, {})
+            self.send_response(status)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{"error": "Error", "message": "Stub error"}')
+            return
+        server.compression_count += 1
+        server.outputs.append(content[::-1])
+        self.send_response(201)
+        self.send_header('Location', '/output/{}'.format(len(server.outputs) - 1))
+        self.send_header('Compression-Count', str(server.compression_count))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(('GET', self.path, self.headers['Authorization']))
+        output = server.outputs[int(self.path.split('/')[-1])]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTinyPNGClient(SimpleTestCase):
+    """Test case for the TinyPNGClient, against a local stub server."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubTinyPNGHandler)
+        self.server.requests = []
+        self.server.responses = []
+        self.server.outputs = []
+        self.server.compression_count = 0
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def make_client(self, **kwargs):
+        return TinyPNGClient('secretkey', base_url=self.base_url, backoff=0, **kwargs)
+
+    def test_compress(self):
+        client = self.make_client()
+
+        self.assertEqual(client.compress(b'image'), b'egami')
+
+        self.assertEqual([request[:2] for request in self.server.requests], [
+            ('POST', '/shrink'), ('GET', '/output/0'),
+        ])
+        # The key is sent with HTTP basic authentication
+        self.assertEqual(self.server.requests[0][2], 'Basic YXBpOnNlY3JldGtleQ==')
+        self.assertEqual(client.compression_count, 1)
+
+    def test_concurrent_compress(self):
+        """The client can be shared by several threads."""
+        client = self.make_client(max_concurrency=2)
+        results = {}
+
+        def compress(i):
+            results[i] = client.compress(str(i).encode())
+
+        threads = [threading.Thread(target=compress, args=(i,)) for i in range(10, 20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {i: str(i).encode()[::-1] for i in range(10, 20)})
+        self.assertEqual(client.compression_count, 10)
+
+    def test_retries(self):
+        """Rate-limited and failed requests are retried."""
+        self.server.responses = [(429, {'Retry-After': '0'}), 503]
+        client = self.make_client(max_retries=2)
+
+        self.assertEqual(client.compress(b'image'), b'egami')
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_retries_exhausted(self):
+        self.server.responses = [503, 503]
+        client = self.make_client(max_retries=1)
+        with self.assertRaises(TinyPNGError):
+            client.compress(b'image')
+
+        self.server.responses = [(429, {'Retry-After': '0'})] * 2
+        with self.assertRaises(QuotaExceeded):
+            client.compress(b'image')
+
+    def test_quota_exceeded_not_retried(self):
+        """A 429 response without Retry-After means the monthly limit was reached, which retrying cannot help."""
+        self.server.responses = [429]
+        client = self.make_client(max_retries=2)
+        with self.assertRaises(QuotaExceeded):
+            client.compress(b'image')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_client_error_not_retried(self):
+        self.server.responses = [401]
+        client = self.make_client(max_retries=2)
+        with self.assertRaisesMessage(TinyPNGError, 'Stub error'):
+            client.compress(b'image')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_monthly_limit(self):
+        """Once the monthly limit is reached, no more requests are made."""
+        client = self.make_client(monthly_limit=1)
+        client.compress(b'image')
+
+        with self.assertRaises(QuotaExceeded):
+            client.compress(b'image')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_key_pool(self):
+        """The keys of a pool are used in turn, and keys that are out of compressions are skipped."""
+        pool = TinyPNGKeyPool(['key1', 'key2'], base_url=self.base_url, backoff=0, max_retries=0)
+        for i in range(4):
+            self.assertEqual(pool.compress(b'image'), b'egami')
+        keys = [base64.b64decode(request[2].split()[1]).decode() for request in self.server.requests[::2]]
+        self.assertEqual(keys, ['api:key1', 'api:key2', 'api:key1', 'api:key2'])
+
+        self.server.requests = []
+        self.server.responses = [429]
+        self.assertEqual(pool.compress(b'image'), b'egami')
+        pool.compress(b'image')
+        keys = [base64.b64decode(request[2].split()[1]).decode() for request in self.server.requests[::2]]
+        self.assertEqual(keys[-2:], ['api:key2', 'api:key2'])
+
+        self.server.responses = [429]
+        with self.assertRaises(QuotaExceeded):
+            pool.compress(b'image')
+
+
+class TestTinyPNGBackend(SimpleTestCase):
+    @override_settings(TINYPNG_KEY=['key1', 'key2'], OPTIMIZED_IMAGE_BACKENDS=[
+        {'BACKEND': 'tinypng', 'OPTIONS': {'key': 'tenantkey', 'max_concurrency': 8}},
+    ])
+    def test_client_per_backend(self):
+        """A backend with its own key has its own client, and the shared client may have several keys."""
+        backend, min_size = get_backend().steps[0]
+        self.assertEqual(backend.client.key, 'tenantkey')
+        self.assertIsInstance(get_tinypng_client(), TinyPNGKeyPool)
+        self.assertIsNone(TinyPNGBackend().client)
@@ -1,11 +1,25 @@
+import asyncio
 import io
-from unittest.mock import patch, Mock
+import mmap
+from unittest.mock import DEFAULT, patch, Mock
 
-from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
 
 from . import factories
-from ..utils import optimize_from_buffer, optimize_legacy_images_in_model_fields
+from ..backends import BaseBackend
+from ..utils import (
+    aoptimize_from_buffer, get_async_executor, is_ignored, open_content, optimize_content, optimize_from_buffer,
+    optimize_legacy_images_in_model_fields, sniff_image_format,
+)
+
+
+class TruncateBackend(BaseBackend):
+    """A backend that "optimizes" an image by dropping its last 10 bytes."""
+    name = 'truncate'
+
+    def compress(self, content, image_format, **options):
+        return content[:-10]
 
 
 class TestOptimizeFromBuffer(TestCase):
@@ -30,10 +44,30 @@ class TestOptimizeFromBuffer(TestCase):
             msg="Test not valid - image was not reduced"
         )
 
+    @override_settings(OPTIMIZED_IMAGE_METHOD='pillow', OPTIMIZED_IMAGE_ASYNC_WORKERS=2)
+    @patch('optimized_image.utils.is_testing_mode', return_value=False)
+    def test_async(self, mock_is_testing_mode):
+        """Several images may be optimized at once, with Pillow running in the shared process pool."""
+        with open('small_kitten.jpeg', 'rb') as image_file:
+            content = image_file.read()
+        uploads = [SimpleUploadedFile(name='kitten{}.jpeg'.format(i), content=content) for i in range(3)]
+
+        async def optimize_all():
+            return await asyncio.gather(*(aoptimize_from_buffer(upload) for upload in uploads))
+
+        with patch('optimized_image.utils.optimize_content', wraps=optimize_content) as mock_optimize_content:
+            self.assertEqual(asyncio.run(optimize_all()), uploads)
+        for upload in uploads:
+            self.assertLess(upload.size, len(content))
+        self.assertEqual(
+            {call.kwargs['executor'] for call in mock_optimize_content.call_args_list},
+            {get_async_executor()},
+        )
+
     @patch('optimized_image.utils.is_testing_mode')
-    @patch('optimized_image.utils.Image')
-    @patch('optimized_image.utils.tinify')
-    def test_settings(self, mock_tinify, mock_pil_image, mock_is_testing_mode):
+    @patch('optimized_image.backends.Image')
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_settings(self, mock_tinypng, mock_pil_image, mock_is_testing_mode):
         """
         Calling optimize_from_buffer() only optimizes images if not in testing mode.
 
@@ -42,6 +76,10 @@ class TestOptimizeFromBuffer(TestCase):
         """
         mock_obj = Mock()
         mock_obj.name = 'test_image.png'
+        mock_obj.read.return_value = b"image"
+        mock_tinypng.return_value.compress.return_value = b""
+        # A still image, not an animation
+        mock_pil_image.open.return_value.n_frames = 1
 
         ignore_obj = Mock()
         ignore_obj.name = 'ignore_image.gif'
@@ -68,7 +106,7 @@ class TestOptimizeFromBuffer(TestCase):
                 ):
                     optimize_from_buffer(mock_obj)
                     optimize_from_buffer(ignore_obj)
-                    self.assertFalse(mock_tinify.called)
+                    self.assertFalse(mock_tinypng.called)
 
         for testing_mode, optimized_image_method in non_testing_mode_subtests:
             with self.subTest(testing_mode=testing_mode, optimized_image_method=optimized_image_method):
@@ -79,7 +117,7 @@ class TestOptimizeFromBuffer(TestCase):
                     mock_is_testing_mode.return_value = testing_mode
 
                     start_pil_image_call_count = mock_pil_image.open.call_count
-                    start_tinify_from_buffer_call_count = mock_tinify.from_buffer.call_count
+                    start_tinypng_compress_call_count = mock_tinypng.return_value.compress.call_count
 
                     optimize_from_buffer(mock_obj)
                     optimize_from_buffer(ignore_obj)
@@ -89,23 +127,120 @@ class TestOptimizeFromBuffer(TestCase):
                     else:
                         expected_pil_calls = start_pil_image_call_count
                     if optimized_image_method == 'tinypng':
-                        expected_tinify_calls = start_tinify_from_buffer_call_count + 1
+                        expected_tinypng_calls = start_tinypng_compress_call_count + 1
                     else:
-                        expected_tinify_calls = start_tinify_from_buffer_call_count
+                        expected_tinypng_calls = start_tinypng_compress_call_count
 
                     # Assert the expected number of calls
                     self.assertEqual(mock_pil_image.open.call_count, expected_pil_calls)
-                    self.assertEqual(mock_tinify.from_buffer.call_count, expected_tinify_calls)
+                    self.assertEqual(mock_tinypng.return_value.compress.call_count, expected_tinypng_calls)
+
+
+@override_settings(OPTIMIZED_IMAGE_BACKENDS=[{'BACKEND': 'optimized_image.tests.test_utils.TruncateBackend'}])
+class TestOptimizeContent(TestCase):
+    """Test case for the optimize_content() function."""
+
+    @patch.object(TruncateBackend, 'compress', return_value=b'larger image')
+    def test_keeps_larger_original(self, mock_compress):
+        """If the backend does not make the image smaller, the original is returned."""
+        content = b'image'
+        result = optimize_content(content, 'png')
+        self.assertIs(result.content, content)
+        self.assertEqual(result.stats['output_size'], 5)
+
+    def test_min_savings(self):
+        content = b'x' * 100
+        with self.settings(OPTIMIZED_IMAGE_MIN_SAVINGS_RATIO=0.2):
+            result = optimize_content(content, 'png')
+            self.assertIs(result.content, content)
+            self.assertEqual(result.stats['discarded_size'], 90)
+        with self.settings(OPTIMIZED_IMAGE_MIN_SAVINGS_BYTES=11):
+            self.assertIs(optimize_content(content, 'png').content, content)
+        with self.settings(OPTIMIZED_IMAGE_MIN_SAVINGS_RATIO=0.1, OPTIMIZED_IMAGE_MIN_SAVINGS_BYTES=10):
+            self.assertEqual(optimize_content(content, 'png').content, b'x' * 90)
+
+    @patch.object(TruncateBackend, 'compress')
+    def test_min_file_size(self, mock_compress):
+        """Files smaller than OPTIMIZED_IMAGE_MIN_FILE_SIZE are not optimized at all."""
+        content = b'x' * 100
+        with self.settings(OPTIMIZED_IMAGE_MIN_FILE_SIZE=101):
+            result = optimize_content(content, 'png')
+        self.assertIs(result.content, content)
+        self.assertTrue(result.stats['skipped'])
+        self.assertFalse(mock_compress.called)
+
+
+class TestSniffImageFormat(SimpleTestCase):
+    def test_formats(self):
+        self.assertEqual(sniff_image_format(open('small_kitten.jpeg', 'rb').read()), 'JPEG')
+        self.assertEqual(sniff_image_format(b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR'), 'PNG')
+        self.assertEqual(sniff_image_format(b'GIF89a\x01\x00'), 'GIF')
+        self.assertEqual(sniff_image_format(b'RIFF\x10\x00\x00\x00WEBPVP8 '), 'WEBP')
+        self.assertEqual(sniff_image_format(b'\x00\x00\x00\x1cftypavif'), 'AVIF')
+        self.assertIsNone(sniff_image_format(b'image'))
+
+    @override_settings(OPTIMIZED_IMAGE_BACKENDS=[{'BACKEND': 'optimized_image.tests.test_utils.TruncateBackend'}])
+    def test_misnamed_file(self):
+        """The format of the contents is used, and is ignored even under another extension."""
+        content = b'GIF89a' + b'x' * 100
+        with patch.object(TruncateBackend, 'compress', return_value=b'GIF') as mock_compress:
+            optimize_content(content, 'jpg')
+        self.assertEqual(mock_compress.call_args[0][1], 'GIF')
+
+        with self.settings(OPTIMIZED_IMAGE_IGNORE_EXTENSIONS=['GIF']):
+            self.assertIs(optimize_content(content, 'jpg').content, content)
+            self.assertTrue(is_ignored('image.gif'))
+            self.assertFalse(is_ignored('image.jpg'))
+        self.assertFalse(is_ignored('image.gif'))
+
+
+class TestOpenContent(TestCase):
+    """Test case for the open_content() function."""
+
+    def test_temporary_uploaded_file(self):
+        """Uploads that Django wrote to a temporary file are memory-mapped instead of read."""
+        data = TemporaryUploadedFile('kitten.jpeg', 'image/jpeg', 0, None)
+        data.write(open('small_kitten.jpeg', 'rb').read())
+        data.flush()
+        self.addCleanup(data.close)
+
+        with open_content(data) as content:
+            self.assertIsInstance(content, mmap.mmap)
+            self.assertEqual(content[:], open('small_kitten.jpeg', 'rb').read())
+
+    def test_in_memory_file(self):
+        data = SimpleUploadedFile(name='kitten.jpeg', content=b'image')
+        data.read()
+        with open_content(data) as content:
+            self.assertEqual(content, b'image')
+
+    @override_settings(OPTIMIZED_IMAGE_METHOD='pillow')
+    @patch('optimized_image.utils.is_testing_mode')
+    def test_optimize_temporary_uploaded_file(self, mock_is_testing_mode):
+        """optimize_from_buffer() writes the optimized image back to the temporary file."""
+        mock_is_testing_mode.return_value = False
+        initial_content = open('small_kitten.jpeg', 'rb').read()
+        data = TemporaryUploadedFile('kitten.jpeg', 'image/jpeg', len(initial_content), None)
+        data.write(initial_content)
+        data.seek(0)
+        self.addCleanup(data.close)
+
+        optimize_from_buffer(data)
+
+        with open(data.temporary_file_path(), 'rb') as optimized_file:
+            optimized_content = optimized_file.read()
+        self.assertEqual(data.size, len(optimized_content))
+        self.assertLess(len(optimized_content), len(initial_content))
 
 
 class TestOptimizeLegacyImagesInModelFields(TestCase):
-    @patch('optimized_image.utils.Image')
-    @patch('optimized_image.utils.tinify')
-    def test_settings(self, mock_tinify, mock_pil_image):
+    @patch('optimized_image.backends.Image')
+    @patch('optimized_image.backends.get_tinypng_client')
+    def test_settings(self, mock_tinypng, mock_pil_image):
         """The OPTIMIZED_IMAGE_METHOD is used to determine whether Pillow or TinyPNG is used."""
         generic_model = factories.GenericModelFactory()
 
-        mock_tinify.from_buffer.return_value.to_buffer.return_value = b""
+        mock_tinypng.return_value.compress.return_value = b""
 
         with self.subTest(OPTIMIZED_IMAGE_METHOD='pillow'):
             with self.settings(
@@ -114,13 +249,13 @@ class TestOptimizeLegacyImagesInModelFields(TestCase):
             ):
                 # So far neither Pillow nor TinyPNG have been called
                 self.assertFalse(mock_pil_image.open.called)
-                self.assertFalse(mock_tinify.from_buffer.called)
+                self.assertFalse(mock_tinypng.return_value.compress.called)
 
                 optimize_legacy_images_in_model_fields([generic_model.__class__])
 
                 # Now the Pillow method has been called once
                 self.assertEqual(mock_pil_image.open.call_count, 1)
-                self.assertFalse(mock_tinify.from_buffer.called)
+                self.assertFalse(mock_tinypng.return_value.compress.called)
 
         with self.subTest(OPTIMIZED_IMAGE_METHOD='tinypng'):
             with self.settings(
@@ -130,15 +265,15 @@ class TestOptimizeLegacyImagesInModelFields(TestCase):
                 # So far Pillow has been called once (in the other subTest), but
                 # TinyPNG has not been called.
                 self.assertEqual(mock_pil_image.open.call_count, 1)
-                self.assertFalse(mock_tinify.from_buffer.called)
+                self.assertFalse(mock_tinypng.return_value.compress.called)
 
                 optimize_legacy_images_in_model_fields([generic_model.__class__])
 
                 # Now the Pillow and TinyPNG methods have each been called once.
                 self.assertEqual(mock_pil_image.open.call_count, 1)
-                self.assertTrue(mock_tinify.from_buffer.call_count, 1)
+                self.assertTrue(mock_tinypng.return_value.compress.call_count, 1)
 
-    @patch('optimized_image.utils.Image')
+    @patch('optimized_image.backends.Image')
     def test_class_optimizes_all_instances(self, mock_pil_image):
         """Calling the funciton with a class optimizes all images for all instance of that class."""
         # We use the Pillow optimization for this test
@@ -154,6 +289,10 @@ class TestOptimizeLegacyImagesInModelFields(TestCase):
                 self.assertNotEqual(blogpost.image2.name, '')
             # So far the Pillow method has not been called
             self.assertFalse(mock_pil_image.open.called)
+            # Record what is passed to PIL.Image.open(), since the memory-mapped
+            # input files are closed once the images have been optimized.
+            opened_contents = []
+            mock_pil_image.open.side_effect = lambda fp: opened_contents.append(fp.read()) or DEFAULT
 
             # Call optimize_legacy_images_in_model_fields(), passing in the class of
             # the blog objects
@@ -166,7 +305,4 @@ class TestOptimizeLegacyImagesInModelFields(TestCase):
                 io.BytesIO(image.read()).getvalue() for image in images
             ]
             self.assertEqual(mock_pil_image.open.call_count, len(images))
-            pil_image_open_calls = [
-                call[0][0].getvalue() for call in mock_pil_image.open.call_args_list
-            ]
-            self.assertEqual(expected_pil_image_open_calls, pil_image_open_calls)
+            self.assertEqual(expected_pil_image_open_calls, opened_contents)
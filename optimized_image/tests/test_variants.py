@@ -0,0 +1,111 @@
+from io import BytesIO
+from unittest.mock import patch
+
+from PIL import Image
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+
+from . import factories
+from not_optimized.models import GenericModel
+from ..variants import resize_pyramid, variant_name
+
+
+def make_image_file(name, size=(800, 600), image_format='PNG'):
+    bytes_io = BytesIO()
+    Image.new('RGBA', size, 'blue').save(bytes_io, format=image_format)
+    return SimpleUploadedFile(name=name, content=bytes_io.getvalue())
+
+
+class TestVariantHelpers(TestCase):
+    def test_variant_name(self):
+        self.assertEqual(variant_name('images/cat.png', 640, 'WEBP'), 'images/cat.640w.webp')
+        self.assertEqual(variant_name('images/cat.png', 320, 'JPEG'), 'images/cat.320w.jpg')
+
+    def test_resize_pyramid(self):
+        """Each width is resized from the previous, larger one, and widths that are too large are skipped."""
+        image = Image.new('RGB', (800, 600))
+        with patch.object(Image.Image, 'resize', autospec=True, side_effect=Image.Image.resize) as mock_resize:
+            sizes = [(width, resized.size) for width, resized in resize_pyramid(image, [200, 1000, 400])]
+
+        self.assertEqual(sizes, [(400, (400, 300)), (200, (200, 150))])
+        # The 200 pixel wide image was made from the 400 pixel wide one
+        self.assertEqual(mock_resize.call_args_list[1][0][0].size, (400, 300))
+
+
+class TestOptimizedImageFieldVariants(TestCase):
+    """Test case for the variant_widths and variant_formats of OptimizedImageField."""
+
+    def setUp(self):
+        self.field = GenericModel._meta.get_field('image')
+        for attribute, value in [('variant_widths', [200, 400, 1000]), ('variant_formats', ['WEBP', 'JPEG'])]:
+            patcher = patch.object(self.field, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_deconstruct(self):
+        name, path, args, kwargs = self.field.deconstruct()
+        self.assertEqual(kwargs['variant_widths'], [200, 400, 1000])
+        self.assertEqual(kwargs['variant_formats'], ['WEBP', 'JPEG'])
+
+    @patch('optimized_image.utils.optimize_from_buffer', side_effect=lambda data: data)
+    def test_variants_saved(self, mock_optimize_from_buffer):
+        generic_model = factories.GenericModelFactory(image=None)
+        self.field.save_form_data(generic_model, make_image_file('photo.png'))
+        generic_model.save()
+
+        variants = generic_model.image.variants
+        self.assertEqual(
+            [(variant.width, variant.format) for variant in variants],
+            [(200, 'WEBP'), (200, 'JPEG'), (400, 'WEBP'), (400, 'JPEG')]
+        )
+        storage = generic_model.image.storage
+        for variant in variants:
+            self.assertEqual(variant.name, variant_name(generic_model.image.name, variant.width, variant.format))
+            with storage.open(variant.name) as variant_file:
+                image = Image.open(variant_file)
+                self.assertEqual(image.format, variant.format)
+                self.assertEqual(image.width, variant.width)
+
+        self.assertEqual(
+            generic_model.image.srcset(),
+            '{} 200w, {} 400w'.format(variants[0].url, variants[2].url)
+        )
+        self.assertEqual(
+            generic_model.image.srcset('jpeg'),
+            '{} 200w, {} 400w'.format(variants[1].url, variants[3].url)
+        )
+
+    def test_variants_use_width_field(self):
+        """The width of the image is read from the width_field, instead of opening the image."""
+        generic_model = GenericModel(image='static/images/photo.png')
+        generic_model.image_width = 300
+        with patch.object(self.field, 'width_field', 'image_width'), \
+                patch('optimized_image.fields.OptimizedImageFieldFile._get_image_dimensions') as mock_dimensions:
+            variants = generic_model.image.variants
+
+        self.assertEqual([(variant.width, variant.format) for variant in variants], [(200, 'WEBP'), (200, 'JPEG')])
+        mock_dimensions.assert_not_called()
+
+    @patch('optimized_image.utils.optimize_from_buffer', side_effect=lambda data: data)
+    def test_default_format_not_supported(self, mock_optimize_from_buffer):
+        """Images in formats that variants are not saved in get PNG variants."""
+        generic_model = factories.GenericModelFactory(image=None)
+        with patch.object(self.field, 'variant_formats', []):
+            self.field.save_form_data(generic_model, make_image_file('photo.bmp', image_format='BMP'))
+            generic_model.save()
+
+            variants = generic_model.image.variants
+            self.assertEqual([(variant.width, variant.format) for variant in variants], [(200, 'PNG'), (400, 'PNG')])
+            self.assertTrue(generic_model.image.storage.exists(variants[0].name))
+            self.assertEqual(generic_model.image.srcset(), '{} 200w, {} 400w'.format(variants[0].url, variants[1].url))
+
+    def test_srcset_without_variants(self):
+        generic_model = GenericModel(image='static/images/photo.png')
+        with patch.object(self.field, 'variant_widths', []):
+            self.assertEqual(generic_model.image.srcset(), '')
+
+    def test_check_variant_formats(self):
+        with patch.object(self.field, 'variant_formats', ['BMPX']):
+            errors = self.field.check()
+        self.assertEqual([error.id for error in errors], ['optimized_image.E001'])
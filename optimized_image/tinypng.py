@@ -0,0 +1,208 @@
+from urllib.parse import urljoin
+import datetime
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+class TinyPNGError(Exception):
+    """TinyPNG could not optimize an image."""
+
+
+class QuotaExceeded(TinyPNGError):
+    """The TinyPNG API key has used up its compressions for the month."""
+
+
+class TinyPNGClient:
+    """
+    A client for the TinyPNG API.
+
+    The client keeps a pool of HTTP connections, so that it is reused across
+    images, and allows at most ``max_concurrency`` requests to be in flight at
+    once, however many threads share it. Requests that fail with a 5xx
+    response, or with a 429 response that says when to retry (with
+    Retry-After), are retried ``max_retries`` times, waiting exponentially
+    longer (starting at ``backoff`` seconds) between attempts. A 429 response
+    without Retry-After means that the monthly limit of the key has been
+    reached, so QuotaExceeded is raised right away.
+
+    The number of compressions used this month is read from each response. If
+    a ``monthly_limit`` is given, QuotaExceeded is raised instead of making a
+    request once the limit has been reached.
+    """
+    def __init__(self, key, base_url='https://api.tinify.com', max_concurrency=4, max_retries=3,
+                 backoff=1.0, monthly_limit=None, timeout=60):
+        self.key = key
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.monthly_limit = monthly_limit
+        self.timeout = timeout
+        self.compression_count = None
+        self.compression_month = None
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.auth = ('api', key)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def compress(self, content):
+        """Optimize the image bytes in content, and return the optimized bytes."""
+        with self.lock:
+            if (
+                self.monthly_limit is not None and self.compression_count is not None
+                and self.compression_count >= self.monthly_limit
+            ):
+                raise QuotaExceeded(
+                    'The monthly limit of {} compressions has been reached.'.format(self.monthly_limit)
+                )
+        with self.semaphore:
+            response = self.request('POST', '/shrink', data=content)
+            output = self.request('GET', response.headers['Location'])
+        return output.content
+
+    def request(self, method, url, **kwargs):
+        """Make a request to the API, retrying rate-limited and failed requests."""
+        url = urljoin(self.base_url, url)
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.ConnectionError:
+                if is_last_attempt:
+                    raise
+                self.wait(attempt)
+                continue
+            self.update_compression_count(response)
+            if response.status_code == 429 and 'Retry-After' not in response.headers:
+                raise QuotaExceeded(self.error_message(response))
+            if response.status_code == 429 or response.status_code >= 500:
+                if is_last_attempt:
+                    break
+                self.wait(attempt, response.headers.get('Retry-After'))
+                continue
+            if response.status_code >= 400:
+                raise TinyPNGError(self.error_message(response))
+            return response
+        if response.status_code == 429:
+            raise QuotaExceeded(self.error_message(response))
+        raise TinyPNGError(self.error_message(response))
+
+    def wait(self, attempt, retry_after=None):
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self.backoff * 2 ** attempt
+        time.sleep(delay)
+
+    def update_compression_count(self, response):
+        compression_count = response.headers.get('Compression-Count')
+        if compression_count is not None:
+            month = get_month()
+            with self.lock:
+                # Responses to concurrent requests may arrive out of order,
+                # so an older count must not replace a newer one, except
+                # when a new month has started it over.
+                if self.compression_count is None or month != self.compression_month:
+                    self.compression_count = int(compression_count)
+                else:
+                    self.compression_count = max(self.compression_count, int(compression_count))
+                self.compression_month = month
+
+    def error_message(self, response):
+        try:
+            return response.json()['message']
+        except (ValueError, KeyError):
+            return 'TinyPNG returned HTTP {}.'.format(response.status_code)
+
+
+class TinyPNGKeyPool:
+    """
+    Spread compressions over several TinyPNG API keys, each with its own TinyPNGClient.
+
+    Images are sent with each key in turn, so that the compressions (and the
+    ``max_concurrency`` of each client) of all of the keys add up. A key that
+    has used up its compressions for the month is skipped until the next
+    month, and QuotaExceeded is only raised once all of them have. The
+    ``options`` are passed to each client.
+    """
+    def __init__(self, keys, **options):
+        if not keys:
+            raise ValueError('TinyPNGKeyPool needs at least one key.')
+        self.clients = [TinyPNGClient(key, **options) for key in keys]
+        self.exhausted = {}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def get_clients(self):
+        """Return the clients whose keys have compressions left, starting with the next one in turn."""
+        month = get_month()
+        with self.lock:
+            start = self.next_index
+            self.next_index = (self.next_index + 1) % len(self.clients)
+            return [
+                client
+                for client in self.clients[start:] + self.clients[:start]
+                if self.exhausted.get(client.key) != month
+            ]
+
+    def compress(self, content):
+        """Optimize the image bytes in content with the next key that has compressions left."""
+        for client in self.get_clients():
+            try:
+                return client.compress(content)
+            except QuotaExceeded:
+                with self.lock:
+                    self.exhausted[client.key] = get_month()
+        raise QuotaExceeded('All {} TinyPNG API keys have used up their compressions.'.format(len(self.clients)))
+
+
+def get_month():
+    today = datetime.date.today()
+    return today.year, today.month
+
+
+def make_tinypng_client(key, **options):
+    """Return a TinyPNGClient for key, or a TinyPNGKeyPool if key is a list of keys."""
+    if isinstance(key, (list, tuple)):
+        return TinyPNGKeyPool(key, **options)
+    return TinyPNGClient(key, **options)
+
+
+_client = None
+
+
+def get_tinypng_client():
+    """
+    Return the TinyPNGClient for the TINYPNG_KEY setting.
+
+    The client is created once, with any options in the OPTIMIZED_IMAGE_TINYPNG
+    setting, for example::
+
+        OPTIMIZED_IMAGE_TINYPNG = {'max_concurrency': 8, 'monthly_limit': 500}
+
+    If TINYPNG_KEY is a list of keys, a TinyPNGKeyPool is returned instead.
+    """
+    global _client
+    if _client is None:
+        _client = make_tinypng_client(settings.TINYPNG_KEY, **get_client_options())
+    return _client
+
+
+def get_client_options():
+    return getattr(settings, 'OPTIMIZED_IMAGE_TINYPNG', {})
+
+
+@receiver(setting_changed)
+def reset_tinypng_client(setting, **kwargs):
+    global _client
+    if setting in ['TINYPNG_KEY', 'OPTIMIZED_IMAGE_TINYPNG']:
+        _client = None
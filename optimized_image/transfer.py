@@ -0,0 +1,36 @@
+def is_remote(storage):
+    """Return True if the files of storage are not on the local disk (for example, in S3)."""
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return True
+    return False
+
+
+def get_fingerprint(storage, name):
+    """
+    Return the (ETag, size) of the file stored at name, or None if the storage does not have ETags.
+
+    Only the file's metadata is requested (a HEAD request, for S3), not its
+    contents. Storages may define a ``get_etag(name)`` method; the S3
+    storages of django-storages are supported as they are.
+    """
+    if hasattr(storage, 'get_etag'):
+        etag = storage.get_etag(name)
+        return (etag, storage.size(name)) if etag else None
+    if hasattr(storage, 'bucket'):
+        # django-storages only loads the object's metadata, not its body
+        stored_file = storage.open(name)
+        try:
+            return stored_file.obj.e_tag, stored_file.obj.content_length
+        except AttributeError:
+            return None
+        finally:
+            stored_file.close()
+    return None
+
+
+def read_file(storage, name):
+    """Return the bytes of the file stored at name."""
+    with storage.open(name, 'rb') as stored_file:
+        return stored_file.read()
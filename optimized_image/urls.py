@@ -5,4 +5,9 @@ from . import views
 
 urlpatterns = [
     url(r'^optimized$', views.index, name='optimized_index'),
+    url(
+        r'^optimized-images/(?P<field>\w+\.\w+\.\w+)/(?P<name>.+)$',
+        views.derivative,
+        name='optimized_image_derivative',
+    ),
 ]
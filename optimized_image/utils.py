@@ -1,65 +1,183 @@
-from io import BytesIO
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import json
+import mmap
 import os
 import sys
-import tinify
 
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.signals import setting_changed
+from django.db import connections
+from django.db.models.fields.files import FieldFile
+from django.dispatch import receiver
 
-from .fields import OptimizedImageField
+from . import signals
+from .backends import OptimizationResult, get_backend, run_backend
+from .cache import get_optimization_cache, make_cache_key
+from .conversion import DEFAULT_MIN_SSIM, optimize_and_convert
+from .limits import ImageTooLarge, check_image_size, has_limits, open_header
+from .models import OptimizedImageRecord
 
 
-def optimize_from_buffer(data):
-    """Optimize an image that has not been saved to a file."""
-    # NOTE: this optional setting defines image file extensions that should
-    # be ignored during optimization. If it is not set or is set to an
-    # empty list, all file types will be optimized.
-    IGNORED_EXTENSIONS = getattr(settings, 'OPTIMIZED_IMAGE_IGNORE_EXTENSIONS', [])
+def optimize_from_buffer(data, **options):
+    """
+    Optimize an image that has not been saved to a file.
+
+    The ``options`` are passed to the backend. For example, with
+    ``max_dimension=2048``, images that are wider or taller than 2048 pixels
+    are scaled down to fit. With an ``executor``, CPU-bound backends are run
+    in it (see optimize_content()).
+    """
     if not is_testing_mode():
         base_extension = data.name.split('.')[-1]
 
         # If this file's extension is in the list of file extensions
         # that should be ignored, just return the data unmodified,
         # the same as we do if ``is_testing_mode()`` is True.
-        if base_extension.lower() in [ext.lower() for ext in IGNORED_EXTENSIONS]:
+        if is_ignored(data.name):
             return data
 
-        if settings.OPTIMIZED_IMAGE_METHOD == 'pillow':
-            image = Image.open(data)
-            bytes_io = BytesIO()
-            if base_extension.lower() != 'jpg':
-                extension = base_extension.upper()
-            else:
-                extension = 'JPEG'
-            image.save(bytes_io, format=extension, optimize=True)
-            data.seek(0)
-            data.file.write(bytes_io.getvalue())
-            data.file.truncate()
-        elif settings.OPTIMIZED_IMAGE_METHOD == 'tinypng':
-            tinify.key = settings.TINYPNG_KEY
-            optimized_buffer = tinify.from_buffer(data.file.read()).to_buffer()
+        with open_content(data) as content:
+            try:
+                result = optimize_content(content, base_extension, name=data.name, **options)
+            except ImageTooLarge:
+                # Leave it to the field's validation to reject the image
+                result = None
+            # The backend may hand back the input itself if it could not
+            # make it any smaller, in which case there is nothing to write.
+            unchanged = result is None or result.content is content
+        if unchanged:
+            # Else - just don't change it
             data.seek(0)
-            data.file.write(optimized_buffer)
-            data.file.truncate()
-        elif settings.OPTIMIZED_IMAGE_METHOD == 'justtesting':
-            # Make a tiny image and use that instead of the input image.
-            # (justtesting is NOT a publicly allowed value, it's just for internal testing.)
-            bytes_io = BytesIO()
-            Image.new('RGB', (10, 10), "blue").save(bytes_io, format="JPEG")
-            data.seek(0)
-            data.file.write(bytes_io.getvalue())
-            data.file.truncate()
-        # Else - just don't change it
-        else:
             return data
 
+        data.seek(0)
+        data.file.write(result.content)
+        data.file.truncate()
+        data.name = get_optimized_name(data.name, result)
+        # Remember that this file was optimized, so that the record can be
+        # saved by the OptimizedImageField once the file has a name in storage.
+        data.optimized_image_record = OptimizedImageRecord(
+            method=result.stats['backend'],
+            optimized_hash=hashlib.sha256(result.content).hexdigest(),
+            original_size=result.stats['input_size'],
+            optimized_size=result.stats['output_size'],
+        )
+
         # We optimized it - fix the computed size
         data.size = data.file.tell()
     return data
 
 
-def optimize_legacy_images_in_model_fields(list_of_models, verbosity=0):
+def optimize_buffers(buffers):
+    """
+    Optimize several images that have not been saved to files at the same time.
+
+    ``buffers`` is a list of (data, options) tuples, each optimized as by
+    optimize_from_buffer(data, **options). The images are optimized in a
+    thread each (up to OPTIMIZED_IMAGE_BATCH_WORKERS, 8 by default; Pillow
+    releases the GIL while it encodes, and TinyPNG is waited on), so the
+    batch takes about as long as its slowest image, instead of all of them
+    added up. Identical images with the same options are only optimized
+    once, and the others are made copies of the result.
+    Return the list of the data.
+    """
+    if len(buffers) <= 1 or is_testing_mode():
+        return [optimize_from_buffer(data, **options) for data, options in buffers]
+
+    groups = {}
+    for data, options in buffers:
+        with open_content(data) as content:
+            key = (hashlib.sha256(content).hexdigest(), json.dumps(options, sort_keys=True))
+        groups.setdefault(key, (options, []))[1].append(data)
+    max_workers = min(len(groups), getattr(settings, 'OPTIMIZED_IMAGE_BATCH_WORKERS', 8))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            (duplicates, pool.submit(optimize_buffer_in_thread, duplicates[0], options))
+            for options, duplicates in groups.values()
+        ]
+        for duplicates, future in futures:
+            future.result()
+            for data in duplicates[1:]:
+                copy_optimized_buffer(duplicates[0], data)
+    return [data for data, options in buffers]
+
+
+def optimize_buffer_in_thread(data, options):
+    try:
+        return optimize_from_buffer(data, **options)
+    finally:
+        # The thread's database connections are not used again
+        connections.close_all()
+
+
+def copy_optimized_buffer(source, data):
+    """Make data a copy of source, an identical image that optimize_from_buffer() has optimized."""
+    record = getattr(source, 'optimized_image_record', None)
+    if record is None:
+        # The image was not changed
+        return
+    source.seek(0)
+    content = source.read()
+    source.seek(0)
+    data.seek(0)
+    data.file.write(content)
+    data.file.truncate()
+    # With the extension of the format that it may have been converted to
+    data.name = os.path.splitext(data.name)[0] + os.path.splitext(source.name)[1]
+    data.optimized_image_record = OptimizedImageRecord(
+        method=record.method,
+        optimized_hash=record.optimized_hash,
+        original_size=record.original_size,
+        optimized_size=record.optimized_size,
+    )
+    data.size = data.file.tell()
+
+
+async def aoptimize_from_buffer(data, **options):
+    """
+    Optimize an image that has not been saved to a file, without blocking the event loop.
+
+    This is the async counterpart of optimize_from_buffer(), for async views.
+    The optimization runs in a thread, and CPU-bound backends (like Pillow)
+    run in the process pool from get_async_executor(), which all of the
+    calls share, so many images may be optimized at once with
+    asyncio.gather(). It needs asgiref, which comes with Django 3.0 and later.
+    """
+    from asgiref.sync import sync_to_async
+
+    options.setdefault('executor', get_async_executor())
+    return await sync_to_async(optimize_from_buffer, thread_sensitive=False)(data, **options)
+
+
+_async_executor = None
+
+
+def get_async_executor():
+    """
+    Return the process pool that aoptimize_from_buffer() runs CPU-bound backends in.
+
+    It is created on first use, with OPTIMIZED_IMAGE_ASYNC_WORKERS processes
+    (by default, one for each CPU).
+    """
+    global _async_executor
+    if _async_executor is None:
+        _async_executor = ProcessPoolExecutor(max_workers=getattr(settings, 'OPTIMIZED_IMAGE_ASYNC_WORKERS', None))
+    return _async_executor
+
+
+@receiver(setting_changed)
+def reset_async_executor(setting, **kwargs):
+    global _async_executor
+    if setting == 'OPTIMIZED_IMAGE_ASYNC_WORKERS' and _async_executor is not None:
+        _async_executor.shutdown(wait=False)
+        _async_executor = None
+
+
+def optimize_legacy_images_in_model_fields(list_of_models, verbosity=0, workers=None, checkpoint_path=None,
+                                           chunk_size=None, in_place=None):
     """
     Call this function to go through models and optimize images.
 
@@ -68,84 +186,323 @@ def optimize_legacy_images_in_model_fields(list_of_models, verbosity=0):
     the list_of_models in the params, finds all of their OptimizedImageFields,
     and optimizes the images in those fields. Note: there is a 500 image/month
     limit on a free TinyPNG API key, so use this function wisely.
+
+    The work is done by a BulkOptimizer, which uses ``workers`` processes for
+    Pillow and ``workers`` threads for reading, writing, and TinyPNG (defaults
+    to the OPTIMIZED_IMAGE_BULK_WORKERS setting, or 1). If a
+    ``checkpoint_path`` is given (or the OPTIMIZED_IMAGE_BULK_CHECKPOINT
+    setting is set), progress is saved to that file, and an interrupted run
+    resumes after the last row that was completed. Rows are loaded
+    ``chunk_size`` at a time (defaults to the OPTIMIZED_IMAGE_BULK_CHUNK_SIZE
+    setting, or 100), and only their primary key and image columns are
+    fetched, so memory use stays flat for large tables. With ``in_place``
+    (defaults to the OPTIMIZED_IMAGE_BULK_IN_PLACE setting, or False), the
+    original files are overwritten instead of being left behind.
+    """
+    from .bulk import BulkOptimizer
+
+    BulkOptimizer(
+        workers=workers,
+        checkpoint_path=checkpoint_path,
+        verbosity=verbosity,
+        chunk_size=chunk_size,
+        in_place=in_place,
+    ).run(list_of_models)
+
+
+def optimize_content(content, image_file_extension, executor=None, name=None, **options):
     """
-    # NOTE: this optional setting defines image file extensions that should
-    # be ignored during optimization. If it is not set or is set to an
-    # empty list, all file types will be optimized.
-    IGNORED_EXTENSIONS = getattr(settings, 'OPTIMIZED_IMAGE_IGNORE_EXTENSIONS', [])
-    for model in list_of_models:
-        if verbosity == 1:
-            sys.stdout.write('\nOptimizing for model: {}'.format(model))
-
-        field_names_to_optimize = []
-        for field in model._meta.get_fields():
-            if type(field) == OptimizedImageField:
-                field_names_to_optimize.append(field.attname)
-
-        if verbosity == 1:
-            sys.stdout.write('\nWill check the following fields: {}'.format(field_names_to_optimize))
-
-        model_instances = model.objects.all()
-        for model_instance in model_instances:
-            for field_name in field_names_to_optimize:
-                if verbosity == 1:
-                    sys.stdout.write('\nChecking for instance id {} field {}'.format(model_instance.pk, field_name))
-
-                # If the instance's field has an image, optimize it
-                image_file = getattr(model_instance, field_name)
-                image_file_extension = image_file.name.split('.')[-1]
-
-                # If the file extension is in the list of file extensions
-                # that should be ignored for optimization, exit this iteration
-                # of the inner ``for`` loop, skipping the file.
-                if image_file_extension.lower() in [ext.lower() for ext in IGNORED_EXTENSIONS]:
-                    sys.stdout.write(
-                        '\nImage has extension {ext}. Ignoring.'.format(ext=image_file_extension)
-                    )
-                    continue
-
-                if image_file.name not in [None, '']:
-                    if verbosity == 1:
-                        sys.stdout.write('\nImage found. Optimizing.')
-
-                    try:
-                        # Use the OPTIMIZED_IMAGE_METHOD from settings to determine
-                        # which way to optimize the image file.
-                        if settings.OPTIMIZED_IMAGE_METHOD == 'pillow':
-                            # Open the image
-                            input_file = BytesIO(image_file.read())
-                            image = Image.open(input_file)
-                            output_file = BytesIO()
-                            # Find the extension of the file to pass to PIL.Image.save()
-                            if image_file_extension.lower() != 'jpg':
-                                extension = image_file_extension.upper()
-                            else:
-                                extension = 'JPEG'
-                            # Optimize the image
-                            image.save(output_file, format=extension, optimize=True)
-                            # Save the image in place of the unoptimized one
-                            content_file = ContentFile(output_file.getvalue())
-                            image_name = os.path.relpath(image_file.name, image_file.field.upload_to)
-                            image_file.save(image_name, content_file)
-                        elif settings.OPTIMIZED_IMAGE_METHOD == 'tinypng':
-                            tinify.key = settings.TINYPNG_KEY
-                            # Use TinyPNG to optimize the file from a buffer
-                            optimized_buffer = tinify.from_buffer(image_file.read()).to_buffer()
-                            # Save the image in place of the unoptimized one
-                            content_file = ContentFile(optimized_buffer)
-                            image_name = os.path.relpath(image_file.name, image_file.field.upload_to)
-                            image_file.save(image_name, content_file)
-                    except:
-                        if is_testing_mode():
-                            # This shouldn't actually happen, so if testing, let the exception continue
-                            # up the call chain so it makes the test fail.
-                            raise
-                        # If the optimization failed for any reason, write this
-                        # to stdout.
-                        sys.stdout.write('\nOptimization failed for {}.'.format(image_file.name))
-
-                    if verbosity == 1:
-                        sys.stdout.write('\nOptimized and saved image.')
+    Optimize the image bytes in content, and return an OptimizationResult.
+
+    The backend from the OPTIMIZED_IMAGE_BACKENDS or OPTIMIZED_IMAGE_METHOD
+    setting determines how the image is optimized, and the ``options`` (for
+    example, ``max_dimension``) are passed to it. If images should not be
+    optimized, return None. If an ``executor`` is given (for example, a
+    process pool), CPU-bound work is submitted to it.
+
+    The pre_optimize, post_optimize, and optimization_failed signals are sent
+    with the ``name`` of the file that the content came from.
+
+    The format of the image is sniffed from its first bytes, and only if it
+    is not recognized, taken from the image_file_extension.
+
+    If the backend converted the image to another format, the result has an
+    ``output_format`` stat, and the file should be renamed to match it (see
+    get_optimized_name()).
+
+    The original content is returned in the result (so that callers can
+    tell, with ``result.content is content``, that there is nothing to save)
+    if its format is ignored, if it is smaller than the
+    OPTIMIZED_IMAGE_MIN_FILE_SIZE setting, or if
+    the optimized image is not smaller by at least the
+    OPTIMIZED_IMAGE_MIN_SAVINGS_BYTES and OPTIMIZED_IMAGE_MIN_SAVINGS_RATIO
+    settings (see keep_original_unless_smaller()).
+    """
+    backend = get_backend()
+    if backend is None:
+        return None
+    # Trust the file's contents over its name, which may be wrong
+    image_format = sniff_image_format(content) or get_image_format(image_file_extension)
+    if is_ignored(image_format=image_format) or len(content) < getattr(settings, 'OPTIMIZED_IMAGE_MIN_FILE_SIZE', 0):
+        # An ignored format under another extension, or too small to be worth
+        # optimizing, or even hashing for the cache
+        return OptimizationResult(content, {
+            'backend': backend.name,
+            'input_size': len(content),
+            'output_size': len(content),
+            'duration': 0,
+            'skipped': True,
+        })
+    signal_kwargs = {
+        'backend': backend,
+        'name': name,
+        'image_format': image_format,
+        'input_size': len(content),
+    }
+    signals.pre_optimize.send(sender=backend.__class__, **signal_kwargs)
+
+    if has_limits():
+        try:
+            options = apply_size_limits(content, options)
+        except ImageTooLarge as exception:
+            signals.optimization_failed.send(sender=backend.__class__, exception=exception, **signal_kwargs)
+            raise
+
+    options = add_conversion_options(options)
+
+    # If an identical image has been optimized the same way before, use
+    # the cached result instead of optimizing it again.
+    cache = get_optimization_cache()
+    if cache is not None:
+        cache_key = make_cache_key(
+            content, backend.name, dict(options, format=image_format, backend=backend.describe())
+        )
+        optimized_content = cache.get(cache_key)
+        if optimized_content is not None:
+            result = OptimizationResult(optimized_content, {
+                'backend': backend.name,
+                'input_size': len(content),
+                'output_size': len(optimized_content),
+                'duration': 0,
+                'cached': True,
+            })
+            result = add_output_format(keep_original_unless_smaller(content, result), image_format)
+            signals.post_optimize.send(sender=backend.__class__, result=result, **signal_kwargs)
+            return result
+
+    try:
+        if 'convert_formats' in options:
+            result = optimize_and_convert(backend, content, image_format, executor, **options)
+        else:
+            result = run_backend(backend, content, image_format, executor, **options)
+    except Exception as exception:
+        signals.optimization_failed.send(sender=backend.__class__, exception=exception, **signal_kwargs)
+        raise
+    if cache is not None:
+        # The result may be the memory-mapped input itself, which cannot be
+        # pickled or outlive the file
+        cache.set(cache_key, bytes(result.content))
+    result = add_output_format(keep_original_unless_smaller(content, result), image_format)
+    signals.post_optimize.send(sender=backend.__class__, result=result, **signal_kwargs)
+    return result
+
+
+def add_conversion_options(options):
+    """
+    Return options with the format conversion policy of the settings, unless they have their own.
+
+    The OPTIMIZED_IMAGE_CONVERT_FORMATS setting lists the formats (for
+    example, ``['webp', 'avif']``) to try converting every image to, and
+    OPTIMIZED_IMAGE_CONVERT_MIN_SSIM is the lowest quality (SSIM) that a
+    conversion may have. See optimize_and_convert().
+    """
+    if 'convert_formats' not in options:
+        convert_formats = getattr(settings, 'OPTIMIZED_IMAGE_CONVERT_FORMATS', None)
+        if not convert_formats:
+            return options
+        options = dict(options, convert_formats=convert_formats)
+    options['convert_formats'] = [get_image_format(image_format) for image_format in options['convert_formats']]
+    if 'min_ssim' not in options:
+        options['min_ssim'] = getattr(settings, 'OPTIMIZED_IMAGE_CONVERT_MIN_SSIM', DEFAULT_MIN_SSIM)
+    return options
+
+
+def add_output_format(result, image_format):
+    """Add an ``output_format`` stat to result if the backend converted the image from image_format."""
+    output_format = sniff_image_format(result.content)
+    if output_format is not None and output_format != image_format:
+        result.stats['output_format'] = output_format
+    return result
+
+
+def get_optimized_name(name, result):
+    """
+    Return the name to save the image in result under, for an image that was named name.
+
+    This is name itself, unless the image was converted to another format,
+    in which case the extension is changed to match it (for example,
+    ``cat.gif`` to ``cat.webp``).
+    """
+    from .variants import FORMAT_EXTENSIONS
+
+    output_format = result.stats.get('output_format')
+    if output_format is None or output_format not in FORMAT_EXTENSIONS:
+        return name
+    root, extension = os.path.splitext(name)
+    return '{}.{}'.format(root, FORMAT_EXTENSIONS[output_format])
+
+
+def apply_size_limits(content, options):
+    """
+    Return options, changed so that the image in content is decoded within the memory limits.
+
+    Only the image header is read. Raise ImageTooLarge if the image cannot
+    be optimized within the limits (see check_image_size()).
+    """
+    try:
+        image = open_header(content)
+    except (OSError, SyntaxError):
+        # Not an image that Pillow recognizes, so it is left to the backend
+        return options
+    size_options = check_image_size(image)
+    if not size_options:
+        return options
+    max_dimension = size_options['max_dimension']
+    if options.get('max_dimension'):
+        max_dimension = min(max_dimension, options['max_dimension'])
+    return dict(options, max_dimension=max_dimension, max_pixels=size_options['max_pixels'])
+
+
+def keep_original_unless_smaller(content, result):
+    """
+    Return result, or a result with the original content if the savings are too small.
+
+    Writing an image that is no smaller (which Pillow often produces for
+    images that were already compressed), or only slightly smaller, costs a
+    storage write and invalidates CDN caches for nothing. The optimized image
+    is only kept if it saves at least OPTIMIZED_IMAGE_MIN_SAVINGS_BYTES
+    (default 1) bytes and at least OPTIMIZED_IMAGE_MIN_SAVINGS_RATIO (default
+    0) of the original size. The size of the discarded image is kept in the
+    ``discarded_size`` stat.
+    """
+    if result.content is content:
+        return result
+    min_savings_bytes = max(getattr(settings, 'OPTIMIZED_IMAGE_MIN_SAVINGS_BYTES', 1), 1)
+    min_savings_ratio = getattr(settings, 'OPTIMIZED_IMAGE_MIN_SAVINGS_RATIO', 0)
+    savings = len(content) - len(result.content)
+    if savings >= min_savings_bytes and savings >= min_savings_ratio * len(content):
+        return result
+    return OptimizationResult(content, dict(
+        result.stats, output_size=len(content), discarded_size=len(result.content)
+    ))
+
+
+@contextmanager
+def open_content(file):
+    """
+    Yield the bytes of an uploaded or stored file, without copying them if possible.
+
+    Files that are on the local disk (uploads that Django wrote to a temporary
+    file, and files in a FileSystemStorage) are memory-mapped, so that a large
+    image is not read into memory, and is shared by the hashing and decoding
+    steps. Other files (small uploads that are already in memory, and remote
+    storages) are read into bytes.
+    """
+    path = None
+    if isinstance(file, TemporaryUploadedFile):
+        path = file.temporary_file_path()
+    elif isinstance(file, FieldFile):
+        try:
+            path = file.path
+        except NotImplementedError:
+            pass
+
+    if path is not None and os.path.getsize(path) > 0:
+        with open(path, 'rb') as input_file:
+            with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                yield content
+    else:
+        file.seek(0)
+        yield file.read()
+
+
+# Pillow format names for the file extensions that are not just the format
+# name in lower case.
+EXTENSION_FORMATS = {
+    'jpg': 'JPEG',
+    'jpe': 'JPEG',
+    'tif': 'TIFF',
+}
+
+
+def get_image_format(image_file_extension):
+    """Return the Pillow format name for a file extension."""
+    # Find the extension of the file to pass to PIL.Image.save()
+    image_file_extension = image_file_extension.lower()
+    return EXTENSION_FORMATS.get(image_file_extension, image_file_extension.upper())
+
+
+def sniff_image_format(content):
+    """
+    Return the Pillow format name of the image bytes in content, or None if it is not recognized.
+
+    Only the first few bytes (the "magic number" of each format) are looked
+    at, so the image is not decoded, and a memory-mapped file is not read
+    any further.
+    """
+    header = content[:16]
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP'
+    if header[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'AVIF'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'TIFF'
+    if header[:2] == b'BM':
+        return 'BMP'
+    return None
+
+
+_ignored = None
+
+
+def get_ignored():
+    """
+    Return the frozensets of the extensions and the formats that should not be optimized.
+
+    They are built once from the OPTIMIZED_IMAGE_IGNORE_EXTENSIONS setting,
+    instead of for every file.
+    """
+    global _ignored
+    if _ignored is None:
+        # NOTE: this optional setting defines image file extensions that should
+        # be ignored during optimization. If it is not set or is set to an
+        # empty list, all file types will be optimized.
+        extensions = frozenset(
+            extension.lower() for extension in getattr(settings, 'OPTIMIZED_IMAGE_IGNORE_EXTENSIONS', [])
+        )
+        _ignored = (extensions, frozenset(get_image_format(extension) for extension in extensions))
+    return _ignored
+
+
+@receiver(setting_changed)
+def reset_ignored(setting, **kwargs):
+    global _ignored
+    if setting == 'OPTIMIZED_IMAGE_IGNORE_EXTENSIONS':
+        _ignored = None
+
+
+def is_ignored(name=None, image_format=None):
+    """Return True if a file with this name, or an image in this Pillow format, should not be optimized."""
+    extensions, formats = get_ignored()
+    if name is not None and name.rsplit('.', 1)[-1].lower() in extensions:
+        return True
+    return image_format is not None and image_format in formats
 
 
 def is_testing_mode():
@@ -0,0 +1,90 @@
+from collections import namedtuple
+from io import BytesIO
+import os
+
+from PIL import Image
+
+from django.core.files.base import ContentFile
+
+
+# The file extension to use for each Pillow format that variants may be saved in.
+FORMAT_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'WEBP': 'webp',
+    'AVIF': 'avif',
+    'GIF': 'gif',
+}
+
+# Formats that cannot store an alpha channel, so images are converted to RGB.
+FORMATS_WITHOUT_ALPHA = ('JPEG',)
+
+Variant = namedtuple('Variant', ['width', 'format', 'name', 'url'])
+
+
+def variant_name(name, width, image_format):
+    """
+    Return the storage name of a variant of the image stored at name.
+
+    For example, the 640 pixel wide WebP variant of ``images/cat.png`` is
+    ``images/cat.640w.webp``.
+    """
+    root, extension = os.path.splitext(name)
+    return '{}.{}w.{}'.format(root, width, FORMAT_EXTENSIONS[image_format])
+
+
+def resize_pyramid(image, widths):
+    """
+    Yield (width, image) for each of the widths that is smaller than the image.
+
+    The image is scaled down step by step, from the largest width to the
+    smallest, so that each step only resamples the previous, already smaller
+    image, instead of the full-size original.
+    """
+    current = image
+    for width in sorted(set(widths), reverse=True):
+        if width >= image.width:
+            continue
+        height = max(round(image.height * width / image.width), 1)
+        current = current.resize((width, height), Image.LANCZOS)
+        yield width, current
+
+
+def encode_variant(image, image_format):
+    """Return the bytes of image saved in image_format."""
+    if image_format in FORMATS_WITHOUT_ALPHA and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output_file = BytesIO()
+    image.save(output_file, format=image_format, optimize=True)
+    return output_file.getvalue()
+
+
+def generate_variants(field_file):
+    """
+    Save the resized variants of the image in field_file that its field declares.
+
+    The image is decoded once, and each variant is saved to the same storage
+    under a name from variant_name(), replacing any previous file with that
+    name. Widths that are not smaller than the image are skipped, since
+    images are never scaled up. Return the list of Variants that were saved.
+    """
+    from .backends import open_image
+    from .utils import open_content
+
+    field = field_file.field
+    image_formats = field.get_variant_formats(field_file.name)
+    storage = field_file.storage
+    variants = []
+    with open_content(field_file) as content:
+        image = open_image(content)
+        image.load()
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    for width, resized_image in resize_pyramid(image, field.variant_widths):
+        for image_format in image_formats:
+            name = variant_name(field_file.name, width, image_format)
+            if storage.exists(name):
+                storage.delete(name)
+            name = storage.save(name, ContentFile(encode_variant(resized_image, image_format)))
+            variants.append(Variant(width, image_format, name, storage.url(name)))
+    return variants
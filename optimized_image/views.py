@@ -1,5 +1,65 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.http import FileResponse, Http404, HttpResponseNotModified
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_safe
 
 
 def index(request):
     return render(request, 'optimized/index.html')
+
+
+def get_lazy_field(label):
+    """Return the OptimizedImageField with lazy=True for a label like 'app_label.Model.field', or raise Http404."""
+    from .fields import OptimizedImageField
+
+    app_label, model_name, field_name = label.split('.')
+    try:
+        field = apps.get_model(app_label, model_name)._meta.get_field(field_name)
+    except (LookupError, FieldDoesNotExist):
+        raise Http404('No such field.')
+    if not isinstance(field, OptimizedImageField) or not field.lazy:
+        raise Http404('Not an OptimizedImageField with lazy=True.')
+    return field
+
+
+@require_safe
+def derivative(request, field, name):
+    """
+    Serve the optimized image (or, with the ``w`` and ``format`` parameters, the variant) of name in field.
+
+    The derivative is made on the first request for it (see
+    optimized_image.derivatives.get_derivative()). Responses have a strong
+    ETag, which only changes if the image or the options do, so a client
+    that has the image gets a 304, and may be cached for
+    OPTIMIZED_IMAGE_LAZY_MAX_AGE (default 86400) seconds.
+    """
+    from .derivatives import get_derivative
+    from .utils import get_image_format
+
+    field = get_lazy_field(field)
+    # Only the images in the field are served, not any file in its storage
+    if not field.model._default_manager.filter(**{field.attname: name}).exists():
+        raise Http404('No such image.')
+    width = request.GET.get('w')
+    image_format = None
+    if width is not None:
+        try:
+            width = int(width)
+        except ValueError:
+            raise Http404('No such variant.')
+        image_format = get_image_format(request.GET.get('format', ''))
+        if width not in (field.variant_widths or []) or image_format not in field.get_variant_formats(name):
+            raise Http404('No such variant.')
+
+    image_derivative = get_derivative(field, name, width, image_format)
+    etag = image_derivative.etag
+    if etag in (tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(field.storage.open(image_derivative.derivative_name))
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'OPTIMIZED_IMAGE_LAZY_MAX_AGE', 86400))
+    return response
@@ -15,7 +15,8 @@ setup(
     license='BSD License',
     description='A simple Django app that allows for optimization of images.',
     long_description=README,
-    install_requires=['tinify'],
+    install_requires=['Django>=3.2', 'Pillow>=9.1', 'requests'],
+    python_requires='>=3.7',
     url='https://github.com/dchukhin/django_optimized_image',
     download_url='https://github.com/dchukhin/django_optimized_image/tarball/0.3.0',
     author='Dmitriy Chukhin',
@@ -29,9 +30,10 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],